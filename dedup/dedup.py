@@ -8,6 +8,12 @@
 import os
 import sys
 import hashlib
+import mmap
+import Queue
+import sqlite3
+import threading
+import time
+import zlib
 
 ###
 # SETTINGS - DEFAULTS
@@ -20,24 +26,94 @@ verbose = False
 dir_with_dupes = '/tmp'
 # the directory where the duplicates should be moved
 dir_dupes_target = '/var/tmp'
+# bytes hashed at the start and at the end of files of the same size,
+# before they are hashed whole
+partial_hash_size = 64 * 1024
+# bytes read at once when hashing a whole file, and how many buffers of
+# this size each thread reading files fills ahead of the threads hashing
+# them, no matter how large the files are
+read_size = 1024 * 1024
+read_ahead = 4
+# wether to hash whole files through mmap instead of reading them, and the
+# bytes mapped at once. Must be a multiple of mmap.ALLOCATIONGRANULARITY
+use_mmap = False
+mmap_window_size = 64 * 1024 * 1024
+# number of threads hashing files, and how many threads read from the same
+# device while they do. More than one per device only helps on SSDs and
+# RAIDs, on a single disk it makes the heads seek back and forth
+jobs = 1
+jobs_per_device = 1
+# SQLite file caching the checksums of files, None for no cache
+cache_file = None
+# checksum algorithm, one of algorithms below
+algorithm = 'sha256'
+# wether to compare files of the same checksum byte by byte. Always done for
+# algorithms that are not cryptographic hashes
+verify = False
 ###
 # END SETTINGS
 ###
 
+# the opened cache_file
+cache = None
+
+class ZlibChecksum(object):
+    """
+    A zlib checksum function (crc32 or adler32) with the interface of hashlib
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.value = function('')
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+# checksum algorithms: name -> (function creating a hashlib like object,
+# wether files with the same checksum must be compared to be sure)
+algorithms = {}
+for name in hashlib.algorithms:
+    algorithms[name] = (getattr(hashlib, name), False)
+if hasattr(hashlib, 'blake2b'):
+    algorithms['blake2b'] = (hashlib.blake2b, False)
+else:
+    try:
+        import pyblake2
+        algorithms['blake2b'] = (pyblake2.blake2b, False)
+    except ImportError:
+        pass
+try:
+    import xxhash
+    algorithms['xxh64'] = (xxhash.xxh64, True)
+except ImportError:
+    pass
+algorithms['crc32'] = (lambda: ZlibChecksum(zlib.crc32), True)
+algorithms['adler32'] = (lambda: ZlibChecksum(zlib.adler32), True)
+
 def print_help():
     """
     print help message
 
     """
-    print """ dedup.py is a small file duplicator. It works on all sorts of files, 
-but could choke on files which exceed or come close to the maximum amount
-of memory available.
+    print """ dedup.py is a small file duplicator. It works on all sorts of files.
+Only files of the same size are compared, by their first and last """ + str(partial_hash_size / 1024) + """ KiB
+first, and read whole only if those are the same.
 
 Usage: dedup.py [-n|--no-simulate] [-v|--verbose] [-h|--help]
 
 Options:
     -n|--no-simulate       - do not simulate, really move files (simulate is default)
     -v|--verbose           - be verbose
+    -m|--mmap              - hash files through mmap instead of reading them into a buffer
+    -j|--jobs <n>          - number of threads hashing files, disks are read in parallel. Defaults to """ + str(jobs) + """
+    --jobs-per-device <n>  - number of threads reading from the same disk. Defaults to """ + str(jobs_per_device) + """
+    -c|--cache <file>      - keep checksums in this SQLite file, later runs only hash new and changed files
+    -a|--algorithm <name>  - checksum algorithm, one of """ + ', '.join(sorted(algorithms)) + """. Defaults to """ + algorithm + """
+    --verify               - compare files with the same checksum byte by byte (always done for crc32, adler32 and xxh64)
+    -b|--benchmark         - print how fast each algorithm is and exit
     -h|--help              - display this message
     -d|--duplicates <dir>  - directory which is to be deduplified. Defaults to """ + dir_with_dupes + """
     -t|--target <dir>      - directory where duplicates are to be moved. Defaults to """ + dir_dupes_target 
@@ -65,34 +141,364 @@ def get_recursive_file_list(root_dir):
             dir_list.append(root + '/' + dir)
     return (file_list, dir_list)
 
-def get_duplicates(file_list):
+def group_by_size(file_list):
     """
-    Identify duplicates by calculating a checksum of all files in 
+    Group files by size, dropping files of a size no other file has
 
     file_list: list of filenames
+    returns: list of (size, files) tuples, files in the order of file_list
 
-    NOTE: this will cause memory problems for large files. There is a suggested solution for this:
-    http://stackoverflow.com/questions/3431825/generating-a-md5-checksum-of-a-file
-    but at least in mobaxterm, this yielded wrong checksums ...
     """
-    print 'Checking files for duplicates'
-    checksums = {}
-    duplicates = []
+    sizes = {}
+    order = []
     for file in file_list:
         try:
-            checksum = hashlib.sha256(open(file, 'rb').read()).hexdigest()
-        except IOError:
-            print 'ERROR: could not calculate checksum for ' + file
+            size = os.path.getsize(file)
+        except OSError:
+            print 'ERROR: could not get size of ' + file
             continue
+        if size not in sizes:
+            sizes[size] = []
+            order.append(size)
+        sizes[size].append(file)
+    return [ (size, sizes[size]) for size in order if len(sizes[size]) > 1 ]
+
+def read_chunks(f, length, pool):
+    """
+    Read length bytes (or until the end) of the open file f, read_size
+    bytes at a time, into buffers taken from pool
+
+    pool: Queue.Queue of bytearrays of read_size bytes
+    yields: (buffer, data) tuples, buffer must be put back into pool once
+            data was hashed
+
+    """
+    while length > 0:
+        data = pool.get()
         try:
+            count = f.readinto(memoryview(data)[:min(length, read_size)])
+        except:
+            pool.put(data)
+            raise
+        if not count:
+            pool.put(data)
+            break
+        # zlib only takes buffers, not memoryviews
+        yield data, buffer(data, 0, count)
+        length -= count
+
+def partial_chunks(f, size, pool):
+    """
+    Read the first and last partial_hash_size bytes of the open file f.
+    For files of up to twice that size, this is the whole file.
+    See read_chunks
+
+    f: file, opened unbuffered
+    size: int, size of f
+
+    """
+    if size <= 2 * partial_hash_size:
+        for chunk in read_chunks(f, sys.maxint, pool):
+            yield chunk
+    else:
+        for chunk in read_chunks(f, partial_hash_size, pool):
+            yield chunk
+        f.seek(-partial_hash_size, 2)
+        for chunk in read_chunks(f, partial_hash_size, pool):
+            yield chunk
+
+def full_chunks(f, size, pool):
+    """
+    Read the whole open file f, through mmap if use_mmap is set.
+    See read_chunks
+
+    f: file, opened unbuffered
+    size: int, size of f
+
+    """
+    if not use_mmap:
+        for chunk in read_chunks(f, sys.maxint, pool):
+            yield chunk
+        return
+    # the file might have changed since its size was taken
+    size = os.fstat(f.fileno()).st_size
+    # map a window at a time, so no more than that is mapped at once
+    for offset in range(0, size, mmap_window_size):
+        mapped = mmap.mmap(f.fileno(), min(mmap_window_size, size - offset),
+                           access=mmap.ACCESS_READ, offset=offset)
+        try:
+            for pos in range(0, len(mapped), read_size):
+                # slicing reads the pages into a new string, the buffer
+                # taken from pool only limits how many are held at once
+                data = pool.get()
+                yield data, mapped[pos:pos + read_size]
+        finally:
+            mapped.close()
+
+def open_cache(path):
+    """
+    Open the checksum cache, creating it if needed
+
+    path: string, path of the SQLite file
+    returns: sqlite3.Connection
+
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("""CREATE TABLE IF NOT EXISTS checksums (
+        device INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        checksum TEXT NOT NULL,
+        PRIMARY KEY (device, inode, kind))""")
+    connection.commit()
+    return connection
+
+def checksum_kind(read_function):
+    """
+    Name what checksums of the data read by read_function are, so checksums
+    cached by one function are not taken for those of another
+
+    """
+    if read_function is partial_chunks:
+        return algorithm + ' partial ' + str(partial_hash_size)
+    return algorithm + ' full'
+
+def calculate_checksums(tasks, read_function):
+    """
+    Calculate the checksums of files. Every device is read by
+    jobs_per_device threads, one file after the other, which pass what
+    they read on to jobs threads hashing it, so a disk never waits for
+    hashing and is never read at more places at once than it is told to.
+    Checksums of files that did not change since they were cached are
+    taken from the cache, if there is one.
+
+    tasks: list of (file, size) tuples
+    read_function: partial_chunks or full_chunks, what to read of the files
+    returns: dict, file -> checksum, without files that could not be read
+
+    """
+    checksums = {}
+    kind = checksum_kind(read_function)
+    stats = {}
+    devices = {}
+    for file, size in tasks:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            print 'ERROR: could not calculate checksum for ' + file
+            continue
+        stats[file] = stat
+        if cache is not None:
+            row = cache.execute('SELECT size, mtime, checksum FROM checksums WHERE device=? AND inode=? AND kind=?',
+                                (stat.st_dev, stat.st_ino, kind)).fetchone()
+            if row is not None and row[:2] == (stat.st_size, stat.st_mtime):
+                checksums[file] = str(row[2])
+                continue
+        if stat.st_dev not in devices:
+            devices[stat.st_dev] = Queue.Queue()
+        devices[stat.st_dev].put((file, size))
+    calculated = {}
+    # (file, chunks, pool) of the files being read, in the order reading
+    # them started. chunks ends with True once the file was read, False if
+    # it could not be
+    files = Queue.Queue()
+    def read(device_tasks):
+        # the buffers this thread reads into, each chunks queue only holds
+        # buffers of the thread reading the file, so hashing a file never
+        # waits for buffers held by files nobody hashes yet
+        pool = Queue.Queue()
+        for i in range(read_ahead):
+            pool.put(bytearray(read_size))
+        while True:
+            try:
+                file, size = device_tasks.get_nowait()
+            except Queue.Empty:
+                return
+            chunks = Queue.Queue()
+            files.put((file, chunks, pool))
+            complete = False
+            try:
+                with open(file, 'rb', 0) as f:
+                    for chunk in read_function(f, size, pool):
+                        chunks.put(chunk)
+                complete = True
+            except EnvironmentError:
+                print 'ERROR: could not calculate checksum for ' + file
+            finally:
+                chunks.put(complete)
+    def hash_files():
+        while True:
+            task = files.get()
+            if task is None:
+                return
+            file, chunks, pool = task
+            checksum = algorithms[algorithm][0]()
+            while True:
+                chunk = chunks.get()
+                if isinstance(chunk, bool):
+                    break
+                data, view = chunk
+                checksum.update(view)
+                pool.put(data)
+            if chunk:
+                calculated[file] = checksum.hexdigest()
+    readers = []
+    for device_tasks in devices.values():
+        for i in range(jobs_per_device):
+            thread = threading.Thread(target=read, args=(device_tasks,))
+            thread.start()
+            readers.append(thread)
+    hashers = []
+    for i in range(jobs):
+        thread = threading.Thread(target=hash_files)
+        thread.start()
+        hashers.append(thread)
+    for thread in readers:
+        thread.join()
+    for thread in hashers:
+        files.put(None)
+    for thread in hashers:
+        thread.join()
+    if cache is not None and calculated:
+        iprint('Caching ' + str(len(calculated)) + ' new checksums')
+        cache.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+            [ (stats[file].st_dev, stats[file].st_ino, kind, stats[file].st_size, stats[file].st_mtime, checksum)
+              for file, checksum in calculated.items() ])
+        cache.commit()
+    checksums.update(calculated)
+    return checksums
+
+def split_groups(groups, read_function):
+    """
+    Split groups of files by checksum, dropping files with a checksum no
+    other file of the group has
+
+    groups: list of (size, files) tuples
+    read_function: partial_chunks or full_chunks, what to read of the files
+    returns: list of (size, files) tuples
+
+    """
+    file_checksums = calculate_checksums([ (file, size) for size, files in groups for file in files ],
+                                         read_function)
+    new_groups = []
+    for size, files in groups:
+        checksums = {}
+        order = []
+        for file in files:
+            if file not in file_checksums:
+                continue
+            checksum = file_checksums[file]
+            if checksum not in checksums:
+                checksums[checksum] = []
+                order.append(checksum)
             checksums[checksum].append(file)
-            duplicates.append(file)
-        except KeyError:
-            checksums[checksum] = [file]
+        new_groups.extend([ (size, checksums[checksum]) for checksum in order if len(checksums[checksum]) > 1 ])
+    return new_groups
+
+def count_files(groups):
+    """
+    Count the files in groups
+
+    groups: list of (size, files) tuples
+
+    """
+    return sum([ len(files) for size, files in groups ])
+
+def same_content(file1, file2):
+    """
+    Compare two files byte by byte, read_size bytes at a time
+
+    file1, file2: string, filenames
+
+    """
+    with open(file1, 'rb') as f1:
+        with open(file2, 'rb') as f2:
+            while True:
+                data1 = f1.read(read_size)
+                data2 = f2.read(read_size)
+                if data1 != data2:
+                    return False
+                if not data1:
+                    return True
+
+def verify_groups(groups):
+    """
+    Split groups of files with the same checksum into groups of files
+    with the same content, dropping files no other file of the group equals
+
+    groups: list of (size, files) tuples
+    returns: list of (size, files) tuples
+
+    """
+    new_groups = []
+    for size, files in groups:
+        while len(files) > 1:
+            same = [files[0]]
+            different = []
+            for file in files[1:]:
+                try:
+                    if same_content(files[0], file):
+                        same.append(file)
+                    else:
+                        different.append(file)
+                except IOError:
+                    print 'ERROR: could not compare ' + files[0] + ' and ' + file
+            if len(same) > 1:
+                new_groups.append((size, same))
+            files = different
+    return new_groups
+
+def benchmark(megabytes=256):
+    """
+    Print how many MB per second each algorithm hashes, from memory
+
+    megabytes: int, amount of data hashed by each algorithm
+
+    """
+    data = bytearray(os.urandom(read_size))
+    print 'Hashing ' + str(megabytes) + ' MB from memory, ' + str(read_size / 1024) + ' KiB at a time'
+    for name in sorted(algorithms):
+        checksum = algorithms[name][0]()
+        start = time.time()
+        for i in range(megabytes * 1024 * 1024 / read_size):
+            checksum.update(buffer(data))
+        elapsed = time.time() - start
+        print '%-10s %8.1f MB/s%s' % (name, megabytes / max(elapsed, 0.001),
+                                      ', verified' if algorithms[name][1] else '')
+
+def get_duplicates(file_list):
+    """
+    Identify duplicates in stages, each only looking at the files the
+    previous one could not tell apart:
+    1. the size of files
+    2. a checksum of the first and last partial_hash_size bytes
+    3. a checksum of the whole file, if stage 2 did not read all of it
+    4. the content of files, byte by byte, if verify is set or the algorithm
+       is no cryptographic hash
+    The first file of every group of duplicates is kept, the others are returned.
+
+    file_list: list of filenames
+
+    """
+    print 'Checking files for duplicates'
+    groups = group_by_size(file_list)
+    iprint(str(count_files(groups)) + ' files have the size of another file')
+    groups = split_groups(groups, partial_chunks)
+    iprint(str(count_files(groups)) + ' files have the start and end of another file')
+    read_whole = [ (size, files) for size, files in groups if size <= 2 * partial_hash_size ]
+    groups = read_whole + split_groups([ (size, files) for size, files in groups
+                                         if size > 2 * partial_hash_size ], full_chunks)
+    if verify or algorithms[algorithm][1]:
+        iprint('Comparing ' + str(count_files(groups)) + ' files with the same checksum byte by byte')
+        groups = verify_groups(groups)
+    duplicates = []
+    for size, files in groups:
+        duplicates.extend(files[1:])
     if verbose or simulate:
-        all_dup_files = [ dups for dups in checksums.values() if len(dups) > 1 ]
-        for dups in all_dup_files:
-            for file in dups:
+        for size, files in groups:
+            for file in files:
                 print file
             print
     return duplicates
@@ -156,8 +562,22 @@ if __name__ == "__main__":
             simulate = False
         if arg == '-v' or arg == '--verbose':
             verbose = True
+        if arg == '-m' or arg == '--mmap':
+            use_mmap = True
         if arg == '-h' or arg == '--help':
             print_help()
+        if arg == '-j' or arg == '--jobs' or arg == '--jobs-per-device':
+            try:
+                number = int(sys.argv[i + 1])
+            except (IndexError, ValueError):
+                number = 0
+            if number < 1:
+                print arg + ' needs a positive number as argument'
+                exit(0)
+            if arg == '--jobs-per-device':
+                jobs_per_device = number
+            else:
+                jobs = number
         if arg == '-d' or arg == '--duplicates':
             try:
                 dir_with_dupes = sys.argv[i + 1]
@@ -166,6 +586,27 @@ if __name__ == "__main__":
             if dir_with_dupes.startswith('-') or dir_with_dupes == '':
                 print '-d|--duplicates needs an argument'
                 exit(0)
+        if arg == '-a' or arg == '--algorithm':
+            try:
+                algorithm = sys.argv[i + 1]
+            except IndexError:
+                algorithm = ''
+            if algorithm not in algorithms:
+                print '-a|--algorithm needs one of ' + ', '.join(sorted(algorithms)) + ' as argument'
+                exit(0)
+        if arg == '--verify':
+            verify = True
+        if arg == '-b' or arg == '--benchmark':
+            benchmark()
+            exit(0)
+        if arg == '-c' or arg == '--cache':
+            try:
+                cache_file = sys.argv[i + 1]
+            except IndexError:
+                cache_file = ''
+            if cache_file.startswith('-') or cache_file == '':
+                print '-c|--cache needs an argument'
+                exit(0)
         if arg == '-t' or arg == '--target':
             try:
                 dir_dupes_target = sys.argv[i + 1]
@@ -174,6 +615,8 @@ if __name__ == "__main__":
             if dir_dupes_target.startswith('-') or dir_dupes_target == '':
                 print '-t|--target needs an argument'
                 exit(0)
+    if cache_file:
+        cache = open_cache(cache_file)
     # actual dedup
     (recursive_file_list, dir_list) = get_recursive_file_list(dir_with_dupes)
     duplicates = get_duplicates(recursive_file_list)
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+"""
+Compare mud's fingerprint engine with dejavu's on the same files.
+
+usage: dev/bench_fingerprint.py [-l SECONDS] [-r REPEAT] FILE [FILE ...]
+
+Every file is decoded once, then both engines fingerprint every channel.
+Prints the seconds each engine needed and whether the hashes are the same.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dejavu import decoder, fingerprint
+import mud_fingerprint
+
+
+def best_time(function, samples, fs, repeat):
+    """Return the hashes and the fastest of repeat runs in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        hashes = [(h, int(offset)) for h, offset in function(samples, Fs=fs)]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return hashes, best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fingerprinting with mud against dejavu.')
+    parser.add_argument('files', nargs='+', help='Audio files to fingerprint.')
+    parser.add_argument('-l', '--limit', type=int, default=None,
+                        help='Seconds of every file to fingerprint, like fingerprint_limit. Default is all.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per file and engine, the fastest counts. Default is 3.')
+    args = parser.parse_args()
+    totals = {'dejavu': 0., 'mud': 0.}
+    different = 0
+    for path in args.files:
+        channels, fs, file_hash = decoder.read(path, args.limit)
+        for channel in channels:
+            expected, dejavu_time = best_time(fingerprint.fingerprint, channel, fs, args.repeat)
+            hashes, mud_time = best_time(mud_fingerprint.fingerprint, channel, fs, args.repeat)
+            totals['dejavu'] += dejavu_time
+            totals['mud'] += mud_time
+            same = hashes == expected
+            if not same:
+                different += 1
+            print('%-60s %7d hashes  dejavu %6.2fs  mud %6.2fs  %s' % (
+                os.path.basename(path)[-60:], len(expected), dejavu_time, mud_time,
+                'same' if same else 'DIFFERENT'))
+    print('total: dejavu %.2fs, mud %.2fs, %.1fx faster, %d channels with different hashes' % (
+        totals['dejavu'], totals['mud'], totals['dejavu'] / max(totals['mud'], 0.001), different))
+    return 1 if different else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,18 +14,35 @@ VERSION = '0.3.0'  # MAR-2016 | isaac | finding duplicate albums
 
 import argparse
 import collections
+import errno
+import itertools
 import logging
-from MySQLdb import IntegrityError
+from MySQLdb import IntegrityError, OperationalError
+from MySQLdb.cursors import SSCursor, SSDictCursor
 import os
+import Queue
 import settings
+import socket
+import sqlite3
 import sys
+import threading
+import time
 import warnings
 
-from dejavu import Dejavu
-from dejavu.database_sql import SQLDatabase, cursor_factory, DictCursor
-from dejavu.recognize import FileRecognizer
+from dejavu import Dejavu, decoder, fingerprint
+from dejavu.database_sql import SQLDatabase, Cursor, DictCursor
 import pydub
+import mud_decoder
+import mud_fingerprint
+import mud_index
+import mud_scanner
+import mud_segments
+import mud_sketch
+import mud_sqlite
+import mud_tags
+import mud_watch
 from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
 from multiprocessing import Queue as MPQueue 
 
 # unset eyed3 global log configuration
@@ -71,8 +88,68 @@ LOG_LEVELS = {
 ERROR_CODES = {
     'CouldntDecodeError': -1,
     'SongObjectIsNone': -2,
+    'WorkerCrashed': -3,
+    'PoisonFile': -4,
     }
 
+# number of rows written per statement, if not set in settings.insert_batch_size
+DEFAULT_INSERT_BATCH_SIZE = 1000
+
+# number of rows read per query when paging through the songfiles table
+DEFAULT_PAGE_SIZE = 10000
+
+# LIMIT for queries that may be paged, but aren't
+NO_LIMIT = 2 ** 63 - 1
+
+# directories changed less than this many seconds before an incremental scan
+# are listed again by the next one, a change within the same mtime tick
+# would go unnoticed otherwise
+DIR_MTIME_MARGIN = 2
+
+# number of times a file may take down a fingerprint worker before it is
+# marked with ERROR_CODES['WorkerCrashed'] instead of being handed out again
+MAX_WORKER_CRASHES = 2
+
+# number of threads reading tags while building the collection, if not set
+# in settings.tag_threads
+DEFAULT_TAG_THREADS = 4
+
+# batches of rows read ahead while copying between databases
+DEFAULT_PREFETCH_BATCHES = 4
+
+# seconds fingerprint results are buffered at most before they are written
+DEFAULT_WRITE_INTERVAL = 10
+
+# seconds a claimed file belongs to a mud process, if not set in
+# settings.claim_lease_time. After that, other processes may claim it again.
+DEFAULT_CLAIM_LEASE_TIME = 1800
+
+# number of times a file may be claimed without being finished, before it is
+# marked with ERROR_CODES['PoisonFile'], if not set in settings.max_claim_attempts
+DEFAULT_MAX_CLAIM_ATTEMPTS = 3
+
+# seconds run_tiers waits before looking again at a file another process claimed
+TIER_CLAIM_WAIT = 5
+
+# sketch_verdict of files the sketch stage (-k) found to have no possible
+# duplicate, they are not fingerprinted. Other sketched files are candidates.
+SKETCH_UNIQUE = 0
+SKETCH_CANDIDATE = 1
+
+# number of files sketched at the same time, if not set in settings.sketch_threads
+DEFAULT_SKETCH_THREADS = 4
+
+# functions computing the hashes of a channel, selected by settings.fingerprint_engine.
+# Both produce the same hashes, mud's is faster.
+FINGERPRINT_ENGINES = {
+    'dejavu': fingerprint.fingerprint,
+    'mud': mud_fingerprint.fingerprint,
+    }
+DEFAULT_FINGERPRINT_ENGINE = 'mud'
+
+# samples between two columns of the spectrogram, hash offsets count in these
+FINGERPRINT_STEP = fingerprint.DEFAULT_WINDOW_SIZE - int(fingerprint.DEFAULT_WINDOW_SIZE * fingerprint.DEFAULT_OVERLAP_RATIO)
+
 
 class MudDatabase(SQLDatabase):
     """
@@ -80,6 +157,7 @@ class MudDatabase(SQLDatabase):
     """
     # tables
     SONGFILES_TABLENAME = "songfiles"
+    SONGDIRS_TABLENAME = "songdirs"
 
     # fields
     FIELD_FILE_ID = 'file_id'  # primary key, autoincrement
@@ -89,6 +167,18 @@ class MudDatabase(SQLDatabase):
     FIELD_SONG_ARTIST = 'song_artist'
     FIELD_SONG_TITLE = 'song_title'
     FIELD_SONG_ALBUM = 'song_album'
+    FIELD_FILE_SIZE = 'file_size'
+    FIELD_FILE_MTIME = 'file_mtime'
+    FIELD_FILE_INODE = 'file_inode'
+    FIELD_CLAIM_WORKER = 'claim_worker'  # host:pid of the process fingerprinting the file
+    FIELD_CLAIM_EXPIRES = 'claim_expires'
+    FIELD_CLAIM_ATTEMPTS = 'claim_attempts'
+    FIELD_FILE_DURATION = 'file_duration'
+    FIELD_SKETCH = 'sketch'  # see mud_sketch
+    FIELD_SKETCH_VERDICT = 'sketch_verdict'  # SKETCH_UNIQUE or SKETCH_CANDIDATE
+    FIELD_DIR_PATH = 'dir_path'
+    FIELD_DIR_MTIME = 'dir_mtime'  # NULL if the directory must be listed again
+    FIELD_DIR_DEVICE = 'dir_device'
 
     # creates
     CREATE_SONGFILES_TABLE = """
@@ -118,25 +208,194 @@ class MudDatabase(SQLDatabase):
 
     )
 
+    # directories as last listed by scan_files_incremental
+    CREATE_SONGDIRS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+             `%s` varchar(500) not null,
+             `%s` double,
+             `%s` bigint unsigned,
+         PRIMARY KEY (%s)
+    ) ENGINE=INNODB;""" % (
+        SONGDIRS_TABLENAME,
+        FIELD_DIR_PATH,
+        FIELD_DIR_MTIME,
+        FIELD_DIR_DEVICE,
+        FIELD_DIR_PATH,
+    )
+
+    # columns that came later, so existing tables get them as well
+    ADD_SONGFILES_COLUMNS = """
+        ALTER TABLE `%s`
+         ADD COLUMN IF NOT EXISTS `%s` bigint unsigned,
+         ADD COLUMN IF NOT EXISTS `%s` double,
+         ADD COLUMN IF NOT EXISTS `%s` bigint unsigned,
+         ADD COLUMN IF NOT EXISTS `%s` varchar(100),
+         ADD COLUMN IF NOT EXISTS `%s` datetime,
+         ADD COLUMN IF NOT EXISTS `%s` smallint unsigned not null default '0',
+         ADD COLUMN IF NOT EXISTS `%s` double,
+         ADD COLUMN IF NOT EXISTS `%s` blob,
+         ADD COLUMN IF NOT EXISTS `%s` tinyint,
+         ADD INDEX IF NOT EXISTS `claim_index` (%s, %s, %s);""" % (
+        SONGFILES_TABLENAME,
+        FIELD_FILE_SIZE,
+        FIELD_FILE_MTIME,
+        FIELD_FILE_INODE,
+        FIELD_CLAIM_WORKER,
+        FIELD_CLAIM_EXPIRES,
+        FIELD_CLAIM_ATTEMPTS,
+        FIELD_FILE_DURATION,
+        FIELD_SKETCH,
+        FIELD_SKETCH_VERDICT,
+        FIELD_SONG_ID, FIELD_FILE_ERROR, FIELD_CLAIM_EXPIRES,  # claim index
+    )
+
     # inserts
     INSERT_SONGFILE = """
         INSERT INTO %s (%s) values
         (%%s); """ % (SONGFILES_TABLENAME, FIELD_FILE_PATH)
 
+    INSERT_IGNORE_SONGFILE = """
+        INSERT IGNORE INTO %s (%s, %s, %s, %s) values
+        (%%s, %%s, %%s, %%s); """ % (SONGFILES_TABLENAME, FIELD_FILE_PATH,
+                                FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_INODE)
+
+    REPLACE_SONGDIR = """
+        REPLACE INTO %s (%s, %s, %s) values
+        (%%s, %%s, %%s); """ % (SONGDIRS_TABLENAME, FIELD_DIR_PATH,
+                               FIELD_DIR_MTIME, FIELD_DIR_DEVICE)
+
     # updates
     UPDATE_SONGFILE = """
         UPDATE %s SET %s=%%s,
-        %s=%%s, %s=%%s, %s=%%s
+        %s=%%s, %s=%%s, %s=%%s,
+        %s=NULL, %s=NULL
         WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_SONG_ID,
                             FIELD_SONG_ARTIST, FIELD_SONG_TITLE,
-                            FIELD_SONG_ALBUM, FIELD_FILE_PATH)
+                            FIELD_SONG_ALBUM, FIELD_CLAIM_WORKER,
+                            FIELD_CLAIM_EXPIRES, FIELD_FILE_PATH)
 
     UPDATE_ERROR_SONGFILE = """
         UPDATE %s SET %s=%%s,
-        %s=%%s, %s=%%s, %s=%%s
+        %s=%%s, %s=%%s, %s=%%s,
+        %s=NULL, %s=NULL
         WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_FILE_ERROR,
                             FIELD_SONG_ARTIST, FIELD_SONG_TITLE,
-                            FIELD_SONG_ALBUM, FIELD_FILE_PATH)
+                            FIELD_SONG_ALBUM, FIELD_CLAIM_WORKER,
+                            FIELD_CLAIM_EXPIRES, FIELD_FILE_PATH)
+
+    UPDATE_FILE_STATS = """
+        UPDATE %s SET %s=%%s, %s=%%s, %s=%%s
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_FILE_SIZE,
+                             FIELD_FILE_MTIME, FIELD_FILE_INODE, FIELD_FILE_ID)
+
+    UPDATE_CHANGED_SONGFILE = """
+        UPDATE %s SET %s=%%s, %s=%%s, %s=%%s,
+        %s=NULL, %s=0, %s=NULL, %s=NULL, %s=0,
+        %s=NULL, %s=NULL, %s=NULL
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_FILE_SIZE,
+                             FIELD_FILE_MTIME, FIELD_FILE_INODE,
+                             FIELD_SONG_ID, FIELD_FILE_ERROR, FIELD_CLAIM_WORKER,
+                             FIELD_CLAIM_EXPIRES, FIELD_CLAIM_ATTEMPTS,
+                             FIELD_FILE_DURATION, FIELD_SKETCH, FIELD_SKETCH_VERDICT,
+                             FIELD_FILE_ID)
+
+    UPDATE_SONGFILE_PATH = """
+        UPDATE %s SET %s=%%s
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_FILE_PATH, FIELD_FILE_PATH)
+
+    UPDATE_MOVED_SONGFILE = """
+        UPDATE %s SET %s=%%s, %s=%%s, %s=%%s, %s=%%s
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_FILE_PATH,
+                             FIELD_FILE_SIZE, FIELD_FILE_MTIME,
+                             FIELD_FILE_INODE, FIELD_FILE_ID)
+
+    # claims
+    # files nobody works on and the sketch stage didn't find unique, the
+    # rows stay locked until the claim is written
+    SELECT_CLAIMABLE_FILES = """
+        SELECT %s, %s FROM %s
+        WHERE %s IS NULL AND %s=0 AND %s<%%s
+        AND (%s IS NULL OR %s<NOW())
+        AND (%s IS NULL OR %s<>%d)
+        ORDER BY %s LIMIT %%s FOR UPDATE;""" % (
+            FIELD_FILE_ID, FIELD_FILE_PATH, SONGFILES_TABLENAME,
+            FIELD_SONG_ID, FIELD_FILE_ERROR, FIELD_CLAIM_ATTEMPTS,
+            FIELD_CLAIM_EXPIRES, FIELD_CLAIM_EXPIRES,
+            FIELD_SKETCH_VERDICT, FIELD_SKETCH_VERDICT, SKETCH_UNIQUE, FIELD_FILE_ID)
+
+    UPDATE_CLAIM = """
+        UPDATE %s SET %s=%%s, %s=NOW() + INTERVAL %%s SECOND, %s=%s+1
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_CLAIM_WORKER,
+                             FIELD_CLAIM_EXPIRES, FIELD_CLAIM_ATTEMPTS,
+                             FIELD_CLAIM_ATTEMPTS, FIELD_FILE_ID)
+
+    # a file of a given path, unless somebody else claimed it
+    CLAIM_SONGFILE = """
+        UPDATE %s SET %s=%%s, %s=NOW() + INTERVAL %%s SECOND, %s=%s+1
+        WHERE %s=%%s AND %s IS NULL AND %s=0
+        AND (%s IS NULL OR %s<NOW() OR %s=%%s);""" % (
+            SONGFILES_TABLENAME, FIELD_CLAIM_WORKER, FIELD_CLAIM_EXPIRES,
+            FIELD_CLAIM_ATTEMPTS, FIELD_CLAIM_ATTEMPTS, FIELD_FILE_PATH,
+            FIELD_SONG_ID, FIELD_FILE_ERROR, FIELD_CLAIM_EXPIRES,
+            FIELD_CLAIM_EXPIRES, FIELD_CLAIM_WORKER)
+
+    # unfinished claims given back, the attempt does not count
+    RELEASE_CLAIMS = """
+        UPDATE %s SET %s=NULL, %s=NULL, %s=%s-1
+        WHERE %s=%%s AND %s IS NULL AND %s=0;""" % (
+            SONGFILES_TABLENAME, FIELD_CLAIM_WORKER, FIELD_CLAIM_EXPIRES,
+            FIELD_CLAIM_ATTEMPTS, FIELD_CLAIM_ATTEMPTS, FIELD_CLAIM_WORKER,
+            FIELD_SONG_ID, FIELD_FILE_ERROR)
+
+    # unfinished claims of a process that is gone, the attempt counts
+    EXPIRE_CLAIMS = """
+        UPDATE %s SET %s=NOW() - INTERVAL 1 SECOND
+        WHERE %s=%%s AND %s IS NULL AND %s=0;""" % (
+            SONGFILES_TABLENAME, FIELD_CLAIM_EXPIRES, FIELD_CLAIM_WORKER,
+            FIELD_SONG_ID, FIELD_FILE_ERROR)
+
+    PARK_POISON_FILES = """
+        UPDATE %s SET %s=%%s, %s=NULL, %s=NULL
+        WHERE %s IS NULL AND %s=0 AND %s>=%%s
+        AND (%s IS NULL OR %s<NOW());""" % (
+            SONGFILES_TABLENAME, FIELD_FILE_ERROR, FIELD_CLAIM_WORKER,
+            FIELD_CLAIM_EXPIRES, FIELD_SONG_ID, FIELD_FILE_ERROR,
+            FIELD_CLAIM_ATTEMPTS, FIELD_CLAIM_EXPIRES, FIELD_CLAIM_EXPIRES)
+
+    SELECT_CLAIM_WORKERS = """
+        SELECT DISTINCT %s FROM %s
+        WHERE %s IS NOT NULL AND %s IS NULL AND %s=0 AND %s>=NOW()
+        ORDER BY %s;""" % (
+            FIELD_CLAIM_WORKER, SONGFILES_TABLENAME, FIELD_CLAIM_WORKER,
+            FIELD_SONG_ID, FIELD_FILE_ERROR, FIELD_CLAIM_EXPIRES,
+            FIELD_CLAIM_WORKER)
+
+    # sketches
+    SELECT_FILES_TO_SKETCH = """
+        SELECT %s, %s FROM %s
+        WHERE %s IS NULL AND %s=0 ORDER BY %s;""" % (
+            FIELD_FILE_ID, FIELD_FILE_PATH, SONGFILES_TABLENAME,
+            FIELD_SKETCH, FIELD_FILE_ERROR, FIELD_FILE_ID)
+
+    UPDATE_SKETCH = """
+        UPDATE %s SET %s=%%s, %s=%%s
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_FILE_DURATION,
+                             FIELD_SKETCH, FIELD_FILE_ID)
+
+    SELECT_SKETCHES = """
+        SELECT %s, %s, %s, %s FROM %s
+        WHERE %s IS NOT NULL AND %s=0;""" % (
+            FIELD_FILE_ID, FIELD_SONG_ID, FIELD_FILE_DURATION, FIELD_SKETCH,
+            SONGFILES_TABLENAME, FIELD_SKETCH, FIELD_FILE_ERROR)
+
+    UPDATE_SKETCH_VERDICT = """
+        UPDATE %s SET %s=%%s
+        WHERE %s=%%s;""" % (SONGFILES_TABLENAME, FIELD_SKETCH_VERDICT, FIELD_FILE_ID)
+
+    SELECT_NUM_UNIQUE_SKETCHED = """SELECT COUNT(*) FROM %s
+        WHERE %s IS NULL AND %s=0 AND %s=%d;""" % (
+            SONGFILES_TABLENAME, FIELD_SONG_ID, FIELD_FILE_ERROR,
+            FIELD_SKETCH_VERDICT, SKETCH_UNIQUE)
 
     # selects
     SELECT_NEW_FILES = """
@@ -153,9 +412,76 @@ class MudDatabase(SQLDatabase):
                FIELD_SONG_TITLE, FIELD_SONG_ALBUM,
                SONGFILES_TABLENAME, FIELD_SONG_ID)
 
+    # song_ids after the first placeholder, at most as many as the second
+    SELECT_DUPLICATE_FILES = """
+        SELECT f.%s, f.%s, f.%s,
+        f.%s, f.%s FROM %s f JOIN
+        (SELECT %s FROM %s WHERE %s > %%s
+         GROUP BY %s HAVING COUNT(*) > 1
+         ORDER BY %s LIMIT %%s) d
+        ON f.%s = d.%s ORDER BY f.%s, f.%s;
+        """ % (FIELD_SONG_ID, FIELD_FILE_PATH, FIELD_SONG_ARTIST,
+               FIELD_SONG_TITLE, FIELD_SONG_ALBUM, SONGFILES_TABLENAME,
+               FIELD_SONG_ID, SONGFILES_TABLENAME, FIELD_SONG_ID,
+               FIELD_SONG_ID, FIELD_SONG_ID, FIELD_SONG_ID, FIELD_SONG_ID,
+               FIELD_SONG_ID, FIELD_FILE_ID)
+
+    SELECT_NUM_DUPLICATE_GROUPS = """SELECT COUNT(*) FROM
+        (SELECT %s FROM %s WHERE %s IS NOT NULL
+         GROUP BY %s HAVING COUNT(*) > 1) d;
+        """ % (FIELD_SONG_ID, SONGFILES_TABLENAME, FIELD_SONG_ID, FIELD_SONG_ID)
+
+    SELECT_FINGERPRINTED_SONG_IDS = """ SELECT %s FROM %s
+        WHERE %s = 1 AND %s > %%s ORDER BY %s;""" % (
+            FIELD_SONG_ID, SQLDatabase.SONGS_TABLENAME,
+            SQLDatabase.FIELD_FINGERPRINTED, FIELD_SONG_ID, FIELD_SONG_ID)
+
+    SELECT_SONG_HASHES = """ SELECT %s, HEX(%s) FROM %s
+        WHERE %s = 1;""" % (
+            FIELD_SONG_ID, SQLDatabase.FIELD_FILE_SHA1, SQLDatabase.SONGS_TABLENAME,
+            SQLDatabase.FIELD_FINGERPRINTED)
+
+    # needs the right number of placeholders for the IN clause
+    SELECT_FINGERPRINTED_SONG_IDS_OR_IN = """ SELECT %s FROM %s
+        WHERE %s = 1 AND (%s > %%%%s OR %s IN (%%s)) ORDER BY %s;""" % (
+            FIELD_SONG_ID, SQLDatabase.SONGS_TABLENAME,
+            SQLDatabase.FIELD_FINGERPRINTED, FIELD_SONG_ID, FIELD_SONG_ID, FIELD_SONG_ID)
+
+    SELECT_FINGERPRINTS = """ SELECT %s, %s, %s FROM %s
+        WHERE %s <= %%s;""" % (
+            SQLDatabase.FIELD_HASH, FIELD_SONG_ID, SQLDatabase.FIELD_OFFSET,
+            SQLDatabase.FINGERPRINTS_TABLENAME, FIELD_SONG_ID)
+
+    # needs the right number of placeholders for the IN clause
+    SELECT_FINGERPRINTS_OF_SONGS = """ SELECT %s, %s, %s FROM %s
+        WHERE %s IN (%%s);""" % (
+            SQLDatabase.FIELD_HASH, FIELD_SONG_ID, SQLDatabase.FIELD_OFFSET,
+            SQLDatabase.FINGERPRINTS_TABLENAME, FIELD_SONG_ID)
+
     SELECT_ALL_FILES = """ SELECT %s FROM %s;
         """ % (FIELD_FILE_PATH, SONGFILES_TABLENAME)
 
+    SELECT_FILE_STATS = """ SELECT %s, %s, %s, %s, %s FROM %s;
+        """ % (FIELD_FILE_ID, FIELD_FILE_PATH, FIELD_FILE_SIZE,
+               FIELD_FILE_MTIME, FIELD_FILE_INODE, SONGFILES_TABLENAME)
+
+    SELECT_FILE_STATS_BY_PATH = """ SELECT %s, %s, %s, %s, %s, %s FROM %s
+        WHERE %s=%%s;""" % (FIELD_FILE_ID, FIELD_SONG_ID, FIELD_FILE_SIZE,
+                             FIELD_FILE_MTIME, FIELD_FILE_INODE, FIELD_FILE_ERROR,
+                             SONGFILES_TABLENAME, FIELD_FILE_PATH)
+
+    SELECT_SONGDIRS = """ SELECT %s, %s, %s FROM %s;
+        """ % (FIELD_DIR_PATH, FIELD_DIR_MTIME, FIELD_DIR_DEVICE, SONGDIRS_TABLENAME)
+
+    SELECT_FILES_BELOW = """ SELECT %s, %s FROM %s
+        WHERE %s LIKE %%s ESCAPE '|';""" % (FIELD_FILE_ID, FIELD_FILE_PATH,
+                                             SONGFILES_TABLENAME, FIELD_FILE_PATH)
+
+    SELECT_FILE_PAGE = """ SELECT %s, %s FROM %s
+        WHERE %s > %%s ORDER BY %s LIMIT %%s;""" % (
+            FIELD_FILE_ID, FIELD_FILE_PATH, SONGFILES_TABLENAME,
+            FIELD_FILE_PATH, FIELD_FILE_PATH)
+
     SELECT_NUM_FILES = """SELECT COUNT(*), 'num_files' FROM %s;
         """ % (SONGFILES_TABLENAME)
 
@@ -170,11 +496,43 @@ class MudDatabase(SQLDatabase):
         DELETE FROM %s WHERE %s=%%s
         ;""" % (SONGFILES_TABLENAME, FIELD_FILE_PATH)
 
+    DELETE_SONG_FILES_BELOW = """
+        DELETE FROM %s WHERE %s LIKE %%s ESCAPE '|'
+        ;""" % (SONGFILES_TABLENAME, FIELD_FILE_PATH)
+
+    # files sharing their song_id with another file, with their stats
+    SELECT_DUPLICATE_FILE_STATS = """
+        SELECT f.%s, f.%s, f.%s, f.%s FROM %%s%s f JOIN
+        (SELECT %s FROM %%s%s WHERE %s IS NOT NULL
+         GROUP BY %s HAVING COUNT(*) > 1) d
+        ON f.%s = d.%s""" % (
+            FIELD_FILE_PATH, FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_INODE,
+            SONGFILES_TABLENAME, FIELD_SONG_ID, SONGFILES_TABLENAME, FIELD_SONG_ID,
+            FIELD_SONG_ID, FIELD_SONG_ID, FIELD_SONG_ID)
+
+    # copies the duplicates of another database on the same server, the
+    # placeholders are its name
+    COPY_DUPLICATE_FILES = """
+        INSERT IGNORE INTO %s (%s, %s, %s, %s) %s;""" % (
+            SONGFILES_TABLENAME, FIELD_FILE_PATH, FIELD_FILE_SIZE, FIELD_FILE_MTIME,
+            FIELD_FILE_INODE, SELECT_DUPLICATE_FILE_STATS % ('`%s`.', '`%s`.'))
+
+    # needs the right number of placeholders for the IN clause
+    DELETE_SONGDIRS = """
+        DELETE FROM %s WHERE %s IN (%%s)
+        ;""" % (SONGDIRS_TABLENAME, FIELD_DIR_PATH)
+
+    # needs the right number of placeholders for the IN clause
+    DELETE_SONG_FILES_BY_ID = """
+        DELETE FROM %s WHERE %s IN (%%s)
+        ;""" % (SONGFILES_TABLENAME, FIELD_FILE_ID)
+
     def __init__(self, **options):
         """
         Setup Database code
         """
-        self.cursor = cursor_factory(**options)
+        self._options = options
+        self.cursor = instance_cursor_factory(**options)
         #super(MudDatabase, self).__init__(**options)
 
     def setup(self):
@@ -188,6 +546,8 @@ class MudDatabase(SQLDatabase):
         super(MudDatabase, self).setup()
         with self.cursor() as cur:
             cur.execute(self.CREATE_SONGFILES_TABLE)
+            cur.execute(self.ADD_SONGFILES_COLUMNS)
+            cur.execute(self.CREATE_SONGDIRS_TABLE)
 
     def insert_songfile(self, file_path):
         """
@@ -198,6 +558,152 @@ class MudDatabase(SQLDatabase):
         with self.cursor() as cur:
             cur.execute(self.INSERT_SONGFILE, [file_path])
 
+    def executemany_batched(self, statement, rows, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Execute statement for all rows, batch_size rows per executemany
+        call and transaction.
+
+        statement: string, SQL statement
+        rows: iterable of parameter tuples. It is consumed lazily, so it can
+              be a generator.
+        batch_size: int, number of rows per batch
+        return: int, number of affected rows
+        """
+        affected = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return affected
+            with self.cursor() as cur:
+                cur.executemany(statement, batch)
+                affected += cur.rowcount
+
+    def insert_songfiles(self, songfiles, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Insert song files into the database, batch_size files per statement.
+        Files already in the database are skipped.
+
+        songfiles: iterable of (file_path, file_size, file_mtime, file_inode)
+                   tuples, the stat values may be None. It is consumed lazily,
+                   so it can be a generator.
+        batch_size: int, number of files inserted at once
+        return: int, number of files actually inserted
+        """
+        return self.executemany_batched(self.INSERT_IGNORE_SONGFILE, songfiles, batch_size)
+
+    def select_duplicate_file_stats(self):
+        """
+        Get the files sharing their song_id with another file, streamed from the server.
+
+        yields: (file_path, file_size, file_mtime, file_inode) tuples
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_DUPLICATE_FILE_STATS % ('', '') + ';')
+            for row in cur:
+                yield tuple(row)
+
+    def on_same_server(self, other):
+        """
+        Return whether other is a MariaDB database this database's
+        connections can reach, on the same server and with the same user.
+        """
+        if self.type != 'mysql' or other.type != 'mysql':
+            return False
+        return all(self._options.get(key) == other._options.get(key)
+                   for key in ('host', 'port', 'unix_socket', 'user'))
+
+    def copy_duplicate_files(self, source, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Add the files of source that share their song_id with another file.
+
+        On the same server this is a single INSERT ... SELECT, run by the
+        server. Otherwise files are streamed from source, read ahead by a
+        thread while the previous batches are inserted.
+
+        source: MudDatabase
+        batch_size: int, number of files inserted at once
+        return: int, number of files added
+        """
+        if self.on_same_server(source):
+            source_db = source._options['db'].replace('`', '``')
+            try:
+                with self.cursor() as cur:
+                    cur.execute(self.COPY_DUPLICATE_FILES % (source_db, source_db))
+                    return cur.rowcount
+            except OperationalError as err:
+                # most likely no SELECT privilege on the source database
+                logger.warning('Copying on the server failed, streaming instead: ' + str(err))
+        rows = prefetch(source.select_duplicate_file_stats(), batch_size)
+        try:
+            return self.insert_songfiles(rows, batch_size)
+        finally:
+            rows.close()
+
+    def update_file_stats(self, songfiles, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Update size, mtime and inode of song files.
+
+        songfiles: iterable of (file_size, file_mtime, file_inode, file_id) tuples
+        batch_size: int, number of files updated at once
+        """
+        self.executemany_batched(self.UPDATE_FILE_STATS, songfiles, batch_size)
+
+    def update_changed_songfiles(self, songfiles, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Update size, mtime and inode of song files whose content changed, and
+        reset their song_id and error, so they get fingerprinted again.
+
+        songfiles: iterable of (file_size, file_mtime, file_inode, file_id) tuples
+        batch_size: int, number of files updated at once
+        """
+        self.executemany_batched(self.UPDATE_CHANGED_SONGFILE, songfiles, batch_size)
+
+    def update_moved_songfiles(self, songfiles, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Update path, size, mtime and inode of song files that were moved.
+
+        songfiles: iterable of (file_path, file_size, file_mtime, file_inode, file_id) tuples
+        batch_size: int, number of files updated at once
+        """
+        self.executemany_batched(self.UPDATE_MOVED_SONGFILE, songfiles, batch_size)
+
+    def insert_fingerprinted_song(self, song_name, file_hash, hashes, store=None):
+        """
+        Insert a song together with its fingerprints in one transaction.
+
+        Other processes never get to see the song without its fingerprints,
+        so they can't delete it as unfingerprinted in their setup().
+
+        song_name: string, name of the song
+        file_hash: string, sha1 of the song file, as hex
+        hashes: iterable of (hash, offset) tuples
+        store: mud_segments.SegmentStore, if given the fingerprints are
+               written there instead of to the fingerprints table. They
+               are published after the song is committed, a rolled back
+               song id may be used again.
+        return: int, song_id of the new song
+        """
+        pending_path = None
+        try:
+            with self.cursor() as cur:
+                cur.execute(self.INSERT_SONG, (song_name, file_hash))
+                sid = cur.lastrowid
+                if store is not None:
+                    pending_path = store.prepare(sid, hashes, file_hash.upper())
+                else:
+                    values = [(hsh, sid, offset) for hsh, offset in hashes]
+                    for i in range(0, len(values), 1000):
+                        cur.executemany(self.INSERT_FINGERPRINT, values[i:i + 1000])
+                cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid,))
+        except:
+            if pending_path is not None:
+                store.discard(pending_path)
+            raise
+        if pending_path is not None:
+            store.publish(pending_path)
+        return sid
+
     def update_songfile(self, file_path, song_id, artist, title, album):
         """
         Update a songfile with its song id.
@@ -228,6 +734,143 @@ class MudDatabase(SQLDatabase):
             cur.execute(self.UPDATE_ERROR_SONGFILE, [
                 error_code, artist, title, album, file_path])
 
+    def update_songfiles(self, songfiles, error_songfiles):
+        """
+        Update song ids, error codes and tags of song files in one transaction.
+
+        songfiles: list of (song_id, artist, title, album, file_path) tuples
+        error_songfiles: list of (error_code, artist, title, album, file_path) tuples
+        """
+        with self.cursor() as cur:
+            if songfiles:
+                cur.executemany(self.UPDATE_SONGFILE, songfiles)
+            if error_songfiles:
+                cur.executemany(self.UPDATE_ERROR_SONGFILE, error_songfiles)
+
+    def claim_song_files(self, worker_id, limit=1,
+                         lease_time=DEFAULT_CLAIM_LEASE_TIME,
+                         max_attempts=DEFAULT_MAX_CLAIM_ATTEMPTS):
+        """
+        Claim up to limit files that are not fingerprinted yet and not
+        claimed by anybody else, for lease_time seconds.
+
+        Several processes, even on different hosts, can claim files from the
+        same database at the same time, every file is only handed to one.
+        The claim ends when the song id or an error is written for the file.
+
+        worker_id: string, identifies the claiming process
+        limit: int, maximum number of files claimed
+        lease_time: int, seconds after which other processes may claim the files again
+        max_attempts: int, files claimed this often before are left alone
+        return: list of file paths
+        """
+        with self.cursor(cursor_type=DictCursor) as cur:
+            cur.execute(self.SELECT_CLAIMABLE_FILES, (max_attempts, limit))
+            rows = cur.fetchall()
+            if rows:
+                cur.executemany(self.UPDATE_CLAIM,
+                    [(worker_id, lease_time, row[self.FIELD_FILE_ID]) for row in rows])
+        return [row[self.FIELD_FILE_PATH] for row in rows]
+
+    def claim_song_file_by_path(self, worker_id, file_path,
+                                lease_time=DEFAULT_CLAIM_LEASE_TIME):
+        """
+        Claim the file at file_path, unless it is fingerprinted already or
+        claimed by another process, see claim_song_files.
+
+        worker_id: string, identifies the claiming process
+        file_path: string, utf-8 encoded path of the file
+        lease_time: int, seconds after which other processes may claim the file again
+        return: bool, whether the file is claimed by worker_id now
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CLAIM_SONGFILE, (worker_id, lease_time, file_path, worker_id))
+            return cur.rowcount == 1
+
+    def release_song_files(self, worker_id):
+        """
+        Give back the files claimed by worker_id that are not finished.
+
+        worker_id: string, as given to claim_song_files
+        """
+        with self.cursor() as cur:
+            cur.execute(self.RELEASE_CLAIMS, (worker_id,))
+
+    def expire_claims(self, worker_id):
+        """
+        Let other processes claim the unfinished files of worker_id right
+        away, without giving back the attempt.
+
+        worker_id: string, as given to claim_song_files
+        """
+        with self.cursor() as cur:
+            cur.execute(self.EXPIRE_CLAIMS, (worker_id,))
+
+    def park_poison_files(self, max_attempts=DEFAULT_MAX_CLAIM_ATTEMPTS):
+        """
+        Mark files that have been claimed max_attempts times without ever
+        being finished with ERROR_CODES['PoisonFile'].
+
+        max_attempts: int, as given to claim_song_files
+        return: int, number of files marked
+        """
+        with self.cursor() as cur:
+            cur.execute(self.PARK_POISON_FILES, (ERROR_CODES['PoisonFile'], max_attempts))
+            return cur.rowcount
+
+    def select_claim_workers(self):
+        """Return the ids of all workers that have unfinished claims"""
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_CLAIM_WORKERS)
+            return [row[0] for row in cur]
+
+    def select_files_to_sketch(self):
+        """
+        Get the files that have not been sketched yet.
+
+        return: list of (file_id, file_path) tuples
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_FILES_TO_SKETCH)
+            return [tuple(row) for row in cur]
+
+    def update_sketches(self, sketches, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Store the sketches of files.
+
+        sketches: iterable of (file_duration, sketch, file_id) tuples, see
+                  mud_sketch. It is consumed lazily, so it can be a generator.
+        batch_size: int, number of files updated at once
+        return: int, number of files updated
+        """
+        return self.executemany_batched(self.UPDATE_SKETCH, sketches, batch_size)
+
+    def select_sketches(self):
+        """
+        Get the sketches of all files, streamed from the server.
+
+        yields: (file_id, song_id, file_duration, sketch) tuples
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_SKETCHES)
+            for row in cur:
+                yield row
+
+    def update_sketch_verdicts(self, verdicts, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Store the verdicts of the sketch stage.
+
+        verdicts: iterable of (sketch_verdict, file_id) tuples
+        batch_size: int, number of files updated at once
+        """
+        return self.executemany_batched(self.UPDATE_SKETCH_VERDICT, verdicts, batch_size)
+
+    def select_num_unique_sketched(self):
+        """Get the number of files not fingerprinted, as their sketch is unique"""
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_NUM_UNIQUE_SKETCHED)
+            return cur.fetchone()[0]
+
     def select_new_files(self):
         """
         Select all files without a song ID
@@ -257,6 +900,79 @@ class MudDatabase(SQLDatabase):
             for row in cur:
                 yield row
 
+    def select_duplicate_files(self, after_song_id=0, limit=NO_LIMIT):
+        """
+        Get songfiles sharing their song_id with at least one other
+        songfile, grouped by song_id, in the order of song_id.
+
+        This is a single query, streamed from the server with an unbuffered
+        cursor, so rows are yielded while they arrive.
+
+        after_song_id: int, only song_ids greater than this are returned
+        limit: int, maximum number of song_ids returned
+        yields: lists of rows, one list per song_id
+        """
+        with self.cursor(cursor_type=SSDictCursor) as cur:
+            cur.execute(self.SELECT_DUPLICATE_FILES, (after_song_id, limit))
+            for song_id, rows in itertools.groupby(cur, lambda row: row[self.FIELD_SONG_ID]):
+                yield list(rows)
+
+    def select_num_duplicate_groups(self):
+        """Get the number of song_ids with more than one songfile"""
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_NUM_DUPLICATE_GROUPS)
+            return cur.fetchone()[0]
+
+    def select_fingerprinted_song_ids(self, after_song_id=0, song_ids=None):
+        """
+        Get the ids of all completely fingerprinted songs.
+
+        after_song_id: int, only song ids greater than this are returned
+        song_ids: list of ints, song ids returned as well, if fingerprinted
+        return: list of ints, in ascending order
+        """
+        with self.cursor() as cur:
+            if song_ids:
+                cur.execute(self.SELECT_FINGERPRINTED_SONG_IDS_OR_IN % ', '.join(['%s'] * len(song_ids)),
+                            [after_song_id] + list(song_ids))
+            else:
+                cur.execute(self.SELECT_FINGERPRINTED_SONG_IDS, (after_song_id,))
+            return [row[0] for row in cur]
+
+    def select_song_hashes(self):
+        """
+        Get the file hashes of all completely fingerprinted songs.
+
+        return: dict of song_id -> sha1 of the song file, as upper case hex
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SONG_HASHES)
+            return dict((row[0], row[1]) for row in cur)
+
+    def select_fingerprints(self, max_song_id=None, song_ids=None,
+                            batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Get fingerprints, streamed from the server.
+
+        max_song_id: int, only fingerprints of songs up to this id, all by default
+        song_ids: list of ints, only fingerprints of these songs, batch_size
+                  songs per query
+        yields: (hash, song_id, offset) tuples, hash as the binary string stored
+        """
+        if song_ids is None:
+            with self.cursor(cursor_type=SSCursor) as cur:
+                cur.execute(self.SELECT_FINGERPRINTS,
+                            (NO_LIMIT if max_song_id is None else max_song_id,))
+                for row in cur:
+                    yield row
+            return
+        for i in range(0, len(song_ids), batch_size):
+            batch = song_ids[i:i + batch_size]
+            with self.cursor(cursor_type=SSCursor) as cur:
+                cur.execute(self.SELECT_FINGERPRINTS_OF_SONGS % ', '.join(['%s'] * len(batch)), batch)
+                for row in cur:
+                    yield row
+
     def select_all_song_files(self):
         """Get all song files stored in db."""
         with self.cursor(cursor_type=DictCursor) as cur:
@@ -264,6 +980,65 @@ class MudDatabase(SQLDatabase):
             for row in cur:
                 yield row
 
+    def select_file_stats(self):
+        """Get file_id, path, size, mtime and inode of all song files."""
+        with self.cursor(cursor_type=SSDictCursor) as cur:
+            cur.execute(self.SELECT_FILE_STATS)
+            for row in cur:
+                yield row
+
+    def select_song_file_pages(self, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Get file_id and path of all song files, ordered by path, reading
+        page_size rows per query.
+
+        yields: lists of rows, one list per page
+        """
+        last_path = ''
+        while True:
+            with self.cursor(cursor_type=DictCursor) as cur:
+                cur.execute(self.SELECT_FILE_PAGE, [last_path, page_size])
+                page = list(cur)
+            if not page:
+                return
+            yield page
+            last_path = page[-1][self.FIELD_FILE_PATH]
+
+    def select_file_stats_by_path(self, path):
+        """
+        Get file_id, song_id, size, mtime, inode and error of a song file,
+        or None if path is not in the database.
+
+        path: string, full path of file
+        """
+        with self.cursor(cursor_type=DictCursor) as cur:
+            cur.execute(self.SELECT_FILE_STATS_BY_PATH, [path])
+            for row in cur:
+                return row
+
+    def select_files_below(self, directory):
+        """
+        Get file_id and path of all song files below directory.
+
+        directory: string, full path of a directory
+        """
+        with self.cursor(cursor_type=DictCursor) as cur:
+            cur.execute(self.SELECT_FILES_BELOW, [like_prefix(directory)])
+            for row in cur:
+                yield row
+
+    def move_song_files(self, moves):
+        """
+        Change the path of song files, replacing song files that are already
+        stored under the new path.
+
+        moves: list of (old path, new path) tuples
+        """
+        with self.cursor() as cur:
+            for old_path, new_path in moves:
+                cur.execute(self.DELETE_SONG_FILE, [new_path])
+                cur.execute(self.UPDATE_SONGFILE_PATH, [new_path, old_path])
+
     def select_num_files(self):
         """Get the number of files indexed"""
         with self.cursor(cursor_type=DictCursor) as cur:
@@ -297,6 +1072,234 @@ class MudDatabase(SQLDatabase):
         with self.cursor() as cur:
             cur.execute(self.DELETE_SONG_FILE, [path])
 
+    def delete_song_files(self, file_ids, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Delete song files from database, batch_size per statement, all in
+        one transaction.
+
+        file_ids: list of ints, file_id of the song files
+        batch_size: int, number of song files deleted per statement
+        """
+        with self.cursor() as cur:
+            for i in range(0, len(file_ids), batch_size):
+                batch = file_ids[i:i + batch_size]
+                cur.execute(self.DELETE_SONG_FILES_BY_ID % ', '.join(['%s'] * len(batch)), batch)
+
+    def select_song_dirs(self):
+        """Get path, mtime and device of all directories, as last listed."""
+        with self.cursor(cursor_type=DictCursor) as cur:
+            cur.execute(self.SELECT_SONGDIRS)
+            for row in cur:
+                yield row
+
+    def update_song_dirs(self, song_dirs, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Insert or replace directories.
+
+        song_dirs: iterable of (dir_path, dir_mtime, dir_device) tuples
+        batch_size: int, number of directories written at once
+        """
+        self.executemany_batched(self.REPLACE_SONGDIR, song_dirs, batch_size)
+
+    def delete_song_dirs(self, dir_paths, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Delete directories, batch_size per statement, all in one transaction.
+
+        dir_paths: list of strings, full paths of the directories
+        batch_size: int, number of directories deleted per statement
+        """
+        with self.cursor() as cur:
+            for i in range(0, len(dir_paths), batch_size):
+                batch = dir_paths[i:i + batch_size]
+                cur.execute(self.DELETE_SONGDIRS % ', '.join(['%s'] * len(batch)), batch)
+
+    def delete_song_files_below(self, directory):
+        """
+        Delete all song files below directory from database.
+
+        directory: string, full path of a directory
+        """
+        with self.cursor() as cur:
+            cur.execute(self.DELETE_SONG_FILES_BELOW, [like_prefix(directory)])
+
+
+class MudSQLiteDatabase(MudDatabase, mud_sqlite.SQLiteDatabase):
+    """
+    MudDatabase with all tables in an SQLite file, see mud_sqlite.
+
+    Only the statements MySQL and SQLite disagree on are replaced.
+    """
+    # creates
+    CREATE_SONGFILES_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+             `%s` integer primary key autoincrement,
+             `%s` varchar(500) not null unique,
+             `%s` integer references %s(%s) on delete cascade,
+             `%s` smallint default '0',
+             `%s` varchar(250),
+             `%s` varchar(250),
+             `%s` varchar(250),
+             `%s` bigint,
+             `%s` double,
+             `%s` bigint,
+             `%s` varchar(100),
+             `%s` datetime,
+             `%s` smallint not null default '0',
+             `%s` double,
+             `%s` blob,
+             `%s` tinyint
+    );""" % (
+        MudDatabase.SONGFILES_TABLENAME,
+        MudDatabase.FIELD_FILE_ID,
+        MudDatabase.FIELD_FILE_PATH,
+        MudDatabase.FIELD_SONG_ID, SQLDatabase.SONGS_TABLENAME, MudDatabase.FIELD_SONG_ID,
+        MudDatabase.FIELD_FILE_ERROR,
+        MudDatabase.FIELD_SONG_ARTIST,
+        MudDatabase.FIELD_SONG_TITLE,
+        MudDatabase.FIELD_SONG_ALBUM,
+        MudDatabase.FIELD_FILE_SIZE,
+        MudDatabase.FIELD_FILE_MTIME,
+        MudDatabase.FIELD_FILE_INODE,
+        MudDatabase.FIELD_CLAIM_WORKER,
+        MudDatabase.FIELD_CLAIM_EXPIRES,
+        MudDatabase.FIELD_CLAIM_ATTEMPTS,
+        MudDatabase.FIELD_FILE_DURATION,
+        MudDatabase.FIELD_SKETCH,
+        MudDatabase.FIELD_SKETCH_VERDICT,
+    )
+
+    CREATE_SONGDIRS_TABLE = MudDatabase.CREATE_SONGDIRS_TABLE.replace(' ENGINE=INNODB;', ';')
+
+    # columns that came later, added to existing tables one by one, as
+    # SQLite knows no ADD COLUMN IF NOT EXISTS
+    ADD_SONGFILES_COLUMNS = [
+        (MudDatabase.FIELD_FILE_DURATION, 'double'),
+        (MudDatabase.FIELD_SKETCH, 'blob'),
+        (MudDatabase.FIELD_SKETCH_VERDICT, 'tinyint'),
+    ]
+
+    # finding new files and duplicates, and claiming files
+    CREATE_SONGFILES_INDEX = """
+        CREATE INDEX IF NOT EXISTS `claim_index` ON `%s` (%s, %s, %s);""" % (
+        MudDatabase.SONGFILES_TABLENAME, MudDatabase.FIELD_SONG_ID,
+        MudDatabase.FIELD_FILE_ERROR, MudDatabase.FIELD_CLAIM_EXPIRES)
+
+    # inserts
+    INSERT_IGNORE_SONGFILE = """
+        INSERT OR IGNORE INTO %s (%s, %s, %s, %s) values
+        (%%s, %%s, %%s, %%s); """ % (MudDatabase.SONGFILES_TABLENAME, MudDatabase.FIELD_FILE_PATH,
+                                MudDatabase.FIELD_FILE_SIZE, MudDatabase.FIELD_FILE_MTIME,
+                                MudDatabase.FIELD_FILE_INODE)
+
+    # claims, there is no need for FOR UPDATE, claim_song_files holds the
+    # write lock for the whole transaction
+    SELECT_CLAIMABLE_FILES = MudDatabase.SELECT_CLAIMABLE_FILES.replace(' FOR UPDATE;', ';')
+
+    UPDATE_CLAIM = """
+        UPDATE %s SET %s=%%s, %s=datetime(NOW(), '+' || %%s || ' seconds'), %s=%s+1
+        WHERE %s=%%s;""" % (MudDatabase.SONGFILES_TABLENAME, MudDatabase.FIELD_CLAIM_WORKER,
+                             MudDatabase.FIELD_CLAIM_EXPIRES, MudDatabase.FIELD_CLAIM_ATTEMPTS,
+                             MudDatabase.FIELD_CLAIM_ATTEMPTS, MudDatabase.FIELD_FILE_ID)
+
+    CLAIM_SONGFILE = MudDatabase.CLAIM_SONGFILE.replace(
+        'NOW() + INTERVAL %s SECOND', "datetime(NOW(), '+' || %s || ' seconds')")
+
+    EXPIRE_CLAIMS = """
+        UPDATE %s SET %s=datetime(NOW(), '-1 seconds')
+        WHERE %s=%%s AND %s IS NULL AND %s=0;""" % (
+            MudDatabase.SONGFILES_TABLENAME, MudDatabase.FIELD_CLAIM_EXPIRES,
+            MudDatabase.FIELD_CLAIM_WORKER, MudDatabase.FIELD_SONG_ID,
+            MudDatabase.FIELD_FILE_ERROR)
+
+    def __init__(self, **options):
+        """
+        Setup Database code
+        """
+        mud_sqlite.SQLiteDatabase.__init__(self, **options)
+
+    def setup(self):
+        """
+        Creates any non-existing tables required for mud to function.
+
+        This also removes all songs that have been added but have no
+        fingerprints associated with them.
+        """
+        mud_sqlite.SQLiteDatabase.setup(self)
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_SONGFILES_TABLE)
+            cur.execute(self.CREATE_SONGFILES_INDEX)
+            cur.execute(self.CREATE_SONGDIRS_TABLE)
+            cur.execute('PRAGMA table_info(`%s`);' % self.SONGFILES_TABLENAME)
+            columns = [row[1] for row in cur.fetchall()]
+            for column, column_type in self.ADD_SONGFILES_COLUMNS:
+                if column not in columns:
+                    cur.execute('ALTER TABLE `%s` ADD COLUMN `%s` %s;' % (
+                        self.SONGFILES_TABLENAME, column, column_type))
+
+    def update_sketches(self, sketches, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        See MudDatabase.update_sketches. Strings would be stored as text,
+        sketches are passed as buffers to store them as blobs.
+        """
+        return MudDatabase.update_sketches(self,
+            ((file_duration, buffer(sketch), file_id) for file_duration, sketch, file_id in sketches),
+            batch_size)
+
+    def claim_song_files(self, worker_id, limit=1,
+                         lease_time=DEFAULT_CLAIM_LEASE_TIME,
+                         max_attempts=DEFAULT_MAX_CLAIM_ATTEMPTS):
+        """
+        See MudDatabase.claim_song_files. Instead of locking the selected
+        rows, the write lock is taken before selecting them.
+        """
+        with self.cursor(cursor_type=DictCursor, immediate=True) as cur:
+            cur.execute(self.SELECT_CLAIMABLE_FILES, (max_attempts, limit))
+            rows = cur.fetchall()
+            if rows:
+                cur.executemany(self.UPDATE_CLAIM,
+                    [(worker_id, lease_time, row[self.FIELD_FILE_ID]) for row in rows])
+        return [row[self.FIELD_FILE_PATH] for row in rows]
+
+def instance_cursor_factory(**factory_options):
+    """
+    Return a function creating Cursors, like dejavu.database_sql.cursor_factory,
+    but with a connection cache of its own. dejavu's cache is shared by all
+    databases of a process, and would hand a connection to one instance's
+    database to another instance.
+    """
+    class InstanceCursor(Cursor):
+        _cache = Queue.Queue(maxsize=5)
+
+    def cursor(**options):
+        options.update(factory_options)
+        return InstanceCursor(**options)
+    return cursor
+
+def get_mud_database(database_type=None):
+    """
+    Return the MudDatabase class for database_type, like
+    dejavu.database.get_database does for the dejavu database.
+
+    database_type: string, 'mysql' (the default) or 'sqlite'
+    """
+    database_type = (database_type or 'mysql').lower()
+    for db_cls in (MudDatabase, MudSQLiteDatabase):
+        if db_cls.type == database_type:
+            return db_cls
+    raise TypeError('Unsupported database type supplied.')
+
+
+def like_prefix(directory):
+    """
+    Return a LIKE pattern (with '|' as escape character) matching all paths
+    below directory.
+
+    directory: string, full path of a directory
+    """
+    for char in '|%_':
+        directory = directory.replace(char, '|' + char)
+    return directory.rstrip('/') + '/%'
+
 
 class mud(object):
     """A mud instance with its database"""
@@ -309,12 +1312,41 @@ class mud(object):
         """
         warnings.filterwarnings('ignore')
         dejavu_config = settings.dejavu_configs[inst_num]
-        self.db = MudDatabase(**dejavu_config.get('database', {}))
+        db_cls = get_mud_database(dejavu_config.get('database_type'))
+        self.db = db_cls(**dejavu_config.get('database', {}))
         self.db.setup()
         self.djv = Dejavu(dejavu_config)
+        # dejavu's connection must not be handed to the next instance created
+        # in this process, see instance_cursor_factory
+        self.djv.db.cursor = self.db.cursor
+        Cursor.clear_cache()
         self.inst_num = inst_num
-
-    def build_collection(self):
+        self.worker_id = claim_worker_id()
+        self.fingerprint = FINGERPRINT_ENGINES[getattr(settings, 'fingerprint_engine', DEFAULT_FINGERPRINT_ENGINE)]
+        # seconds skipped at the start of every file, before fingerprint_limit
+        # seconds are fingerprinted. Not used with a list of windows.
+        self.fingerprint_start = dejavu_config.get('fingerprint_start', 0)
+        # optional in-memory fingerprint index, used instead of the
+        # fingerprints table for recognition
+        self.index = None
+        index_options = dejavu_config.get('fingerprint_index')
+        if index_options:
+            if index_options is True:
+                index_options = {}
+            self.index = mud_index.FingerprintIndex(self.db, **index_options)
+        # optional segment store, keeping the fingerprints in files instead
+        # of the fingerprints table
+        self.store = None
+        store_options = dejavu_config.get('fingerprint_store')
+        if store_options:
+            self.store = mud_segments.SegmentStore(songs=self.db.select_song_hashes, **store_options)
+
+    def close(self):
+        """Wait for background work of the instance to finish"""
+        if self.store is not None:
+            self.store.close()
+
+    def build_collection(self, jobs=1):
         """
         Go through the collection song by song and add them to the
         dejavu database, if it is not already recognized.
@@ -322,13 +1354,281 @@ class mud(object):
         In any case, create an entry in the song_files database, pointing
         to the song_id in dejavu.songs
 
+        Files are claimed one by one before they are fingerprinted, so
+        several mud processes, also on different hosts, can build the same
+        collection at the same time, and a killed process just leaves its
+        current files to be claimed again. Files that keep killing mud, or
+        make it raise an exception, are marked with ERROR_CODES['PoisonFile']
+        after settings.max_claim_attempts attempts, see finish_claims.
+
+        jobs: int, number of fingerprint worker processes. With 1, everything
+              happens in this process.
         """
         logger.info('Building collection')
-        for song_f in self.list_new_files():
-            logger.debug('Getting song id for ' + song_f)
-            song_id = self.get_song_id(song_f)
-            logger.debug('Adding "' + song_f + '" to collection with song_id ' + str(song_id))
-            self.add_to_collection(song_f, song_id)
+        self.recover_claims()
+        if jobs > 1:
+            self.build_collection_parallel(jobs)
+            return
+        writer = CollectionWriter(self.db)
+        failed = False
+        try:
+            while True:
+                song_f = self.claim_song_file()
+                if song_f is None:
+                    break
+                # the tags are read by the writer's threads while fingerprinting
+                writer.read_tags(song_f)
+                logger.debug('Getting song id for ' + song_f)
+                song_id = self.get_song_id(song_f)
+                logger.debug('Adding "' + song_f + '" to collection with song_id ' + str(song_id))
+                writer.add(song_f, song_id)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            writer.close()
+            self.finish_claims(failed)
+
+    def sketch_files(self, threads=None):
+        """
+        Sketch the files not sketched yet and decide which of them need
+        fingerprinting, see mud_sketch.
+
+        Files that have no song id yet and whose duration and sketch are not
+        near those of any other file, fingerprinted or not, are marked
+        unique and skipped by build_collection. All other files are
+        candidates. Verdicts are decided again on every run, so a unique
+        file becomes a candidate once a similar file shows up.
+
+        threads: int, number of files sketched at once, settings.sketch_threads by default
+        """
+        if threads is None:
+            threads = getattr(settings, 'sketch_threads', DEFAULT_SKETCH_THREADS)
+        batch_size = getattr(settings, 'insert_batch_size', DEFAULT_INSERT_BATCH_SIZE)
+        logger.info('Sketching new files')
+        files = self.db.select_files_to_sketch()
+        pool = ThreadPool(threads)
+        try:
+            num_sketched = self.db.update_sketches(pool.imap_unordered(sketch_file, files), batch_size)
+        finally:
+            pool.close()
+            pool.join()
+        logger.info('Sketched ' + str(num_sketched) + ' files')
+        pending = set()
+        items = []
+        for file_id, song_id, file_duration, words in self.db.select_sketches():
+            if song_id is None:
+                pending.add(file_id)
+            items.append((file_id, file_duration, mud_sketch.unpack(words)))
+        index = mud_sketch.SketchIndex(items)
+        unique = set(index.neighbourless(pending))
+        self.db.update_sketch_verdicts(
+            ((SKETCH_UNIQUE if file_id in unique else SKETCH_CANDIDATE, file_id) for file_id in pending),
+            batch_size)
+        logger.info(str(len(unique)) + ' of ' + str(len(pending)) + ' files without fingerprint are unique')
+
+    def tier_song_id(self, song_file, decoding_tier, decoded):
+        """
+        Add song_file to the instance, as a duplicate passed on by run_tiers,
+        and return its song id.
+
+        The file is claimed before it is fingerprinted, like build_collection
+        does. If a build of this instance (-b) claimed it already, this waits
+        for its song id.
+
+        song_file: string, utf-8 encoded absolute path to sound file
+        decoding_tier: mud, the instance decoding the audio, if this one reuses it
+        decoded: dict, song_file -> audio decoded by decoding_tier
+        return: int, song id, or a negative error code
+        """
+        lease_time = getattr(settings, 'claim_lease_time', DEFAULT_CLAIM_LEASE_TIME)
+        while True:
+            row = self.db.select_file_stats_by_path(song_file)
+            if row is not None and row[self.db.FIELD_SONG_ID] is not None:
+                return row[self.db.FIELD_SONG_ID]
+            if row is not None and row[self.db.FIELD_FILE_ERROR]:
+                return row[self.db.FIELD_FILE_ERROR]
+            if row is None:
+                self.add_song_file(song_file.decode('utf-8'))
+            if self.db.claim_song_file_by_path(self.worker_id, song_file, lease_time):
+                break
+            logger.debug('Waiting for another process fingerprinting ' + song_file)
+            time.sleep(TIER_CLAIM_WAIT)
+        audio = None
+        if self.reuses(decoding_tier):
+            if song_file not in decoded:
+                try:
+                    decoded[song_file] = decoding_tier.decode(song_file)
+                except pydub.exceptions.CouldntDecodeError:
+                    decoded[song_file] = None
+            if decoded[song_file] is not None:
+                audio = self.trim_decoded(decoded[song_file])
+        song_id = self.get_song_id(song_file, audio)
+        self.add_to_collection(song_file, song_id)
+        return song_id
+
+    def claim_song_file(self):
+        """
+        Claim the next file to fingerprint for this process.
+
+        return: string, path of the file, or None if there is nothing left to do
+        """
+        claimed = self.db.claim_song_files(self.worker_id, 1,
+            getattr(settings, 'claim_lease_time', DEFAULT_CLAIM_LEASE_TIME),
+            getattr(settings, 'max_claim_attempts', DEFAULT_MAX_CLAIM_ATTEMPTS))
+        if claimed:
+            return claimed[0]
+        return None
+
+    def finish_claims(self, failed):
+        """
+        Let go of the files this process claimed and did not finish.
+
+        After a complete run or a KeyboardInterrupt, the attempts don't
+        count. After any other exception they do: the file being
+        fingerprinted might be what failed, and it is marked as PoisonFile
+        once it did so settings.max_claim_attempts times, instead of
+        stopping every run that claims it.
+
+        failed: bool, whether building the collection raised an exception
+        """
+        if failed:
+            self.db.expire_claims(self.worker_id)
+        else:
+            self.db.release_song_files(self.worker_id)
+
+    def recover_claims(self):
+        """
+        Make files claimed by dead mud processes on this host available
+        again, without waiting for their lease to expire, and mark files that
+        were claimed too often as poison.
+        """
+        hostname = socket.gethostname()
+        for worker_id in self.db.select_claim_workers():
+            host, sep, pid = worker_id.rpartition(':')
+            if host != hostname or not pid.isdigit() or process_alive(int(pid)):
+                continue
+            logger.warning('Files claimed by ' + worker_id + ' are free again, the process is gone')
+            self.db.expire_claims(worker_id)
+        poisoned = self.db.park_poison_files(
+            getattr(settings, 'max_claim_attempts', DEFAULT_MAX_CLAIM_ATTEMPTS))
+        if poisoned:
+            logger.error('PoisonFile raised for ' + str(poisoned) + ' files')
+
+    def fingerprint_song_file(self, song_file):
+        """
+        Fingerprint a single song file and add it to the collection.
+
+        song_file: string, absolute path to sound file, already in the database
+        """
+        logger.debug('Getting song id for ' + song_file)
+        song_id = self.get_song_id(song_file)
+        logger.debug('Adding "' + song_file + '" to collection with song_id ' + str(song_id))
+        self.add_to_collection(song_file, song_id)
+
+    def build_collection_parallel(self, jobs):
+        """
+        Build the collection with a pool of fingerprint worker processes.
+
+        This process acts as coordinator: it hands out one file path at a
+        time to each worker and writes the returned song_ids to the
+        database, so every file is owned by exactly one worker at a time.
+        Tags are read by a thread pool in this process while the file is
+        being fingerprinted, the workers only decode and hash.
+        If a worker dies, it is restarted right away and the file it was
+        working on is handed out again, until it has taken down
+        MAX_WORKER_CRASHES workers. Then it is marked with
+        ERROR_CODES['WorkerCrashed'].
+
+        Starting up includes the dejavu database setup, which deletes songs
+        that are not completely fingerprinted yet. This doesn't get in the
+        way of the other workers, which insert each song together with its
+        fingerprints in one transaction, see insert_fingerprinted_song.
+
+        Files are claimed in the name of this process whenever a worker
+        becomes idle.
+
+        jobs: int, number of worker processes
+        """
+        # files to hand out again after a worker crash
+        pending = collections.deque()
+        claimed_all = False
+        logger.info('Fingerprinting with ' + str(jobs) + ' workers')
+        result_queue = MPQueue()
+        workers = [FingerprintWorker(num, self.inst_num, result_queue) for num in range(jobs)]
+        crashes = collections.defaultdict(int)
+        writer = CollectionWriter(self.db)
+        failed = False
+
+        def handle_result(num, song_file, song_id):
+            worker = workers[num]
+            if song_file is None:
+                logger.debug('Fingerprint worker ' + str(num) + ' is ready')
+                worker.state = FingerprintWorker.IDLE
+                return
+            if worker.song_file == song_file:
+                worker.song_file = None
+                worker.state = FingerprintWorker.IDLE
+            logger.debug('Adding "' + song_file + '" to collection with song_id ' + str(song_id))
+            writer.add(song_file, song_id)
+
+        try:
+            while pending or not claimed_all or any(w.state == FingerprintWorker.BUSY for w in workers):
+                for worker in workers:
+                    if worker.state == FingerprintWorker.DEAD:
+                        worker.start()
+                for worker in workers:
+                    if worker.state != FingerprintWorker.IDLE:
+                        continue
+                    if pending:
+                        song_file = pending.popleft()
+                    elif claimed_all:
+                        break
+                    else:
+                        song_file = self.claim_song_file()
+                        if song_file is None:
+                            claimed_all = True
+                            break
+                    writer.read_tags(song_file)
+                    worker.assign(song_file)
+                try:
+                    handle_result(*result_queue.get(timeout=1))
+                except Queue.Empty:
+                    pass
+                for worker in workers:
+                    if worker.state == FingerprintWorker.DEAD or worker.process.is_alive():
+                        continue
+                    # whatever the dead worker managed to send is in the pipe by now
+                    while True:
+                        try:
+                            handle_result(*result_queue.get_nowait())
+                        except Queue.Empty:
+                            break
+                    if worker.state == FingerprintWorker.STARTING:
+                        for w in workers:
+                            w.process.terminate()
+                        raise Exception('Fingerprint worker ' + str(worker.num) + ' failed to start')
+                    song_file = worker.song_file
+                    worker.state = FingerprintWorker.DEAD
+                    worker.song_file = None
+                    if song_file is None:
+                        logger.error('Fingerprint worker ' + str(worker.num) + ' died')
+                        continue
+                    logger.error('Fingerprint worker ' + str(worker.num) + ' died on ' + song_file)
+                    crashes[song_file] += 1
+                    if crashes[song_file] < MAX_WORKER_CRASHES:
+                        pending.appendleft(song_file)
+                    else:
+                        logger.error('WorkerCrashed raised for ' + song_file)
+                        writer.add(song_file, ERROR_CODES['WorkerCrashed'])
+        except Exception:
+            failed = True
+            raise
+        finally:
+            writer.close()
+            self.finish_claims(failed)
+        for worker in workers:
+            worker.stop()
 
     def add_to_collection(self, song_file, song_id):
         """
@@ -338,34 +1638,10 @@ class mud(object):
         song_id: int, foreign key to songs database
 
         """
-        audio_file_tag = None
-        try:
-            audio_file = eyed3.load(song_file)
-            audio_file_tag = audio_file.tag
-        except IOError:
+        tags = get_tags(song_file)
+        if tags is None:
             return
-        except eyed3.id3.tag.TagException:
-            pass
-        except Exception:
-            pass
-        tags = {}
-        if audio_file_tag:
-            tags['artist'] = audio_file.tag.artist
-            tags['title'] = audio_file.tag.title
-            tags['album'] = audio_file.tag.album
-            for tag_name,tag_value in tags.iteritems():
-                if tag_value:
-                    tags[tag_name] = tag_value.strip().encode('utf-8')
-                else:
-                    tags[tag_name] = ''.encode('utf-8')
-        else:
-            logger.warning('File without valid mp3 tag, using filename as "title": ' + song_file)
-            tags['artist'] = ''.encode('utf-8')
-            tags['title'] = os.path.split(song_file)[1].replace('.mp3','').replace('.MP3','').decode('utf-8').encode('utf-8')
-            tags['album'] = ''.encode('utf-8')
-        artist = tags['artist']
-        title = tags['title']
-        album = tags['album']
+        artist, title, album = tags
         if song_id > 0:
             self.db.update_songfile(song_file, song_id, artist, title, album)
         else:
@@ -379,18 +1655,17 @@ class mud(object):
         for filepath in self.db.select_new_files():
             yield filepath['file_path']
 
-    def get_song_id(self, song_file):
+    def get_song_id(self, song_file, decoded=None):
         """
         Return song_id of song_file, fingerprint first if nessessary.
 
         song_file: string, absolute path to sound file
+        decoded: audio of song_file as returned by decode, None to decode it
         """
         song = None
         try:
             logger.debug('Fingerprinting ' + song_file)
-            self.djv.fingerprint_file(song_file)
-            logger.debug('Recognizing ' + song_file)
-            song = self.djv.recognize(FileRecognizer, song_file)
+            song = self.fingerprint_and_recognize(song_file, decoded)
         except pydub.exceptions.CouldntDecodeError:
             logger.error('CouldntDecodeError raised for ' + song_file)
             return ERROR_CODES['CouldntDecodeError']
@@ -401,41 +1676,363 @@ class mud(object):
             logger.error('SongObjectIsNone raised for ' + song_file)
             return ERROR_CODES['SongObjectIsNone']
 
-    def scan_files(self):
-        """Scan for music files and add them to the database."""
+    def decode(self, song_file):
+        """
+        Decode the part of song_file selected by fingerprint_limit.
+
+        fingerprint_limit is either a number of seconds, or a list of
+        (seconds, position) windows, e.g. [(5, 0.2), (5, 0.5), (5, 0.8)] for
+        5 seconds at 20%, 50% and 80% of the song.
+
+        song_file: string, absolute path to sound file
+        return: (windows, samplerate, file_hash), windows being a list of
+                (start, channels) tuples, as returned by mud_decoder.read_windows
+        raises: CouldntDecodeError
+        """
+        if not isinstance(self.djv.limit, (list, tuple)):
+            channels, fs, file_hash = mud_decoder.read(song_file, self.djv.limit, self.fingerprint_start)
+            return [(0, channels)], fs, file_hash
+        return mud_decoder.read_windows(song_file, self.djv.limit, FINGERPRINT_STEP)
+
+    def reuses(self, other):
+        """
+        Return whether the audio decoded by the instance other holds all
+        this instance fingerprints, see trim_decoded. That is the case if both
+        start at fingerprint_start, and other decodes at least as many seconds.
+        """
+        if isinstance(self.djv.limit, (list, tuple)) or isinstance(other.djv.limit, (list, tuple)):
+            return False
+        if self.fingerprint_start != other.fingerprint_start:
+            return False
+        if other.djv.limit is None:
+            return True
+        return self.djv.limit is not None and self.djv.limit <= other.djv.limit
+
+    def trim_decoded(self, decoded):
+        """
+        Cut audio decoded by an instance this one reuses down to what decode
+        would return.
+
+        decoded: (windows, samplerate, file_hash), as returned by decode
+        """
+        windows, fs, file_hash = decoded
+        if self.djv.limit is None:
+            return decoded
+        count = int(self.djv.limit * fs)
+        return [(start, [channel[:count] for channel in channels]) for start, channels in windows], fs, file_hash
+
+    def decode_and_fingerprint(self, song_file, decoded=None):
+        """
+        Decode the part of song_file selected by fingerprint_limit and hash it.
+
+        The offsets of the hashes of a window count from the start of the
+        song, so matching windows of two songs line up like a single window does.
+
+        song_file: string, absolute path to sound file
+        decoded: audio of song_file as returned by decode, None to decode it
+        return: (channel_hashes, file_hash), channel_hashes being a list of
+                (hash, offset) lists, one per channel and window
+        """
+        windows, fs, file_hash = decoded or self.decode(song_file)
+        channel_hashes = []
+        for start, channels in windows:
+            # offsets are counted in steps of the spectrogram
+            start_offset = start // FINGERPRINT_STEP
+            for channel in channels:
+                hashes = self.fingerprint(channel, Fs=fs)
+                if start_offset:
+                    hashes = [(h, offset + start_offset) for h, offset in hashes]
+                channel_hashes.append(list(hashes))
+        return channel_hashes, file_hash
+
+    def fingerprint_and_recognize(self, song_file, decoded=None):
+        """
+        Fingerprint song_file and recognize it, decoding and hashing it only once.
+
+        The hashes are stored, unless a file with the same content has been
+        fingerprinted before, and then the very same hashes are looked up to
+        find the matching song. This is what Dejavu.fingerprint_file followed
+        by Dejavu.recognize would do, only they each decode the file. And only
+        the part selected by fingerprint_limit is decoded, see
+        decode_and_fingerprint.
+
+        If the instance has a fingerprint store, fingerprints are written to
+        and looked up in the store. Otherwise, if the fingerprint index is
+        enabled, matches are looked up there instead of in the database.
+
+        song_file: string, absolute path to sound file
+        decoded: audio of song_file as returned by decode, None to decode it
+        return: dict, the matching song as returned by Dejavu.align_matches, or None
+        """
+        channel_hashes, file_hash = self.decode_and_fingerprint(song_file, decoded)
+        if file_hash not in self.djv.songhashes_set:
+            hashes = set()
+            for ch_hashes in channel_hashes:
+                hashes |= set(ch_hashes)
+            song_id = self.db.insert_fingerprinted_song(decoder.path_to_songname(song_file), file_hash, hashes,
+                                                        self.store)
+            self.djv.songhashes_set.add(file_hash)
+            if self.index is not None and self.store is None:
+                self.index.add(song_id, hashes)
+        logger.debug('Recognizing ' + song_file)
+        if self.store is not None:
+            matcher = self.store
+        elif self.index is not None:
+            matcher = self.index
+        else:
+            matcher = self.db
+        matches = []
+        for ch_hashes in channel_hashes:
+            matches.extend(matcher.return_matches(ch_hashes))
+        return self.djv.align_matches(matches)
+
+    def scan_files(self, incremental=False):
+        """
+        Scan for music files and add them to the database.
+
+        incremental: bool, also look for changed and moved files, see scan_files_incremental
+        """
         if self.inst_num != 0: 
             logger.error('File scanning not permitted for non-primary instance')
             return
+        if incremental:
+            self.scan_files_incremental()
+            return
         logger.info('Scanning music base dir for mp3 files')
-        for root, sub_folders, files in os.walk(settings.music_base_dir):
-            for filepath in files:
-                if filepath.endswith(('.mp3', '.MP3')):
-                    path = os.path.join(root, filepath)
-                    self.add_song_file(path.decode('utf-8'))
+        num_added = self.add_song_files(self.walk_song_files())
+        logger.info('Added ' + str(num_added) + ' new files')
+
+    def scan_files_incremental(self):
+        """
+        Scan for new, changed and moved music files, comparing them to the
+        size, mtime and inode stored in the database.
+
+        Only directories whose mtime changed since the last incremental scan
+        are listed, see mud_scanner.ParallelScanner: the files of all other
+        directories are taken to be unchanged.
+        New files are added. Files with a different size or mtime get their
+        song_id reset, so the next build_collection fingerprints them again.
+        A new path with the device, inode, size and mtime of a path that is
+        gone is taken to be a moved file: the row is updated in place and
+        keeps its song_id. The device of a file that is gone is the one of
+        its directory.
+        Unchanged files are not touched at all, and the database is read with
+        a single query instead of once per file.
+        """
+        logger.info('Scanning music base dir for new, changed and moved mp3 files')
+        batch_size = getattr(settings, 'insert_batch_size', DEFAULT_INSERT_BATCH_SIZE)
+        scan_start = time.time()
+        song_dirs = {}
+        for row in self.db.select_song_dirs():
+            song_dirs[row['dir_path']] = row
+        known_dirs = {}
+        for path, row in song_dirs.iteritems():
+            if row['dir_mtime'] is not None:
+                known_dirs[path] = (row['dir_mtime'], [])
+        for path in song_dirs:
+            parent = os.path.dirname(path)
+            if parent in known_dirs and parent != path:
+                known_dirs[parent][1].append(path)
+        known = {}
+        for row in self.db.select_file_stats():
+            known[row['file_path']] = row
+        new_files = []
+        changed = []
+        restat = []
+        scanner = self.song_file_scanner(known_dirs)
+        for path, stat in self.walk_song_files(scanner):
+            path = path.encode('utf-8')
+            size, mtime, inode = file_stats(stat)
+            row = known.pop(path, None)
+            if row is None:
+                new_files.append((stat.st_dev, (path, size, mtime, inode)))
+            elif row['file_size'] is None:
+                # stored before stats were recorded, nothing to compare with
+                restat.append((size, mtime, inode, row['file_id']))
+            elif (row['file_size'], row['file_mtime']) != (size, mtime):
+                changed.append((size, mtime, inode, row['file_id']))
+            elif row['file_inode'] != inode:
+                restat.append((size, mtime, inode, row['file_id']))
+        # whatever is left in known is unchanged, if its directory was not
+        # listed, or gone from its path, but might show up under a new one
+        gone = {}
+        for path in known.keys():
+            directory = os.path.dirname(path)
+            if directory in scanner.unchanged_dirs:
+                del known[path]
+                continue
+            row = known[path]
+            if directory in scanner.dirs:
+                device = scanner.dirs[directory].st_dev
+            elif directory in song_dirs:
+                device = song_dirs[directory]['dir_device']
+            else:
+                device = None
+            if row['file_inode'] is not None and device is not None:
+                gone[(device, row['file_inode'], row['file_size'], row['file_mtime'])] = row
+        added = []
+        moved = []
+        for device, (path, size, mtime, inode) in new_files:
+            row = gone.pop((device, inode, size, mtime), None)
+            if row is None:
+                added.append((path, size, mtime, inode))
+            else:
+                logger.debug('Moved ' + row['file_path'] + ' to ' + path)
+                moved.append((path, size, mtime, inode, row['file_id']))
+        self.db.update_file_stats(restat, batch_size)
+        self.db.update_changed_songfiles(changed, batch_size)
+        self.db.update_moved_songfiles(moved, batch_size)
+        num_added = self.db.insert_songfiles(added, batch_size)
+        logger.info('Added ' + str(num_added) + ' new, ' + str(len(changed)) + ' changed and '
+                    + str(len(moved)) + ' moved files')
+        num_missing = len(known) - len(moved)
+        if num_missing:
+            logger.info(str(num_missing) + ' files in the database no longer exist, use -c to remove them')
+        # written last, if mud gets killed before, the next scan lists the
+        # directories again
+        updated_dirs = []
+        for path, stat in scanner.dirs.iteritems():
+            mtime = stat.st_mtime if stat.st_mtime < scan_start - DIR_MTIME_MARGIN else None
+            row = song_dirs.pop(path, None)
+            if row is None or (row['dir_mtime'], row['dir_device']) != (mtime, stat.st_dev):
+                updated_dirs.append((path, mtime, stat.st_dev))
+        self.db.update_song_dirs(updated_dirs, batch_size)
+        self.db.delete_song_dirs(list(song_dirs), batch_size)
+        logger.info('Listed ' + str(len(scanner.dirs) - len(scanner.unchanged_dirs)) + ' of '
+                    + str(len(scanner.dirs)) + ' directories')
+
+    def song_file_scanner(self, known_dirs=None):
+        """
+        Return a mud_scanner.ParallelScanner for all mp3 files below the
+        music base dir, listing settings.scan_threads directories at once.
+
+        known_dirs: dict, see mud_scanner.ParallelScanner
+        """
+        # no trailing slash, so the base dir is the dirname of its subdirectories
+        base_dir = settings.music_base_dir.rstrip('/') or '/'
+        return mud_scanner.ParallelScanner(
+            base_dir, ('.mp3', '.MP3'),
+            getattr(settings, 'scan_threads', mud_scanner.DEFAULT_SCAN_THREADS), known_dirs)
+
+    def walk_song_files(self, scanner=None):
+        """
+        Yield (path, stat) for all mp3 files below the music base dir, where
+        path is unicode and stat is the result of os.stat().
+
+        scanner: mud_scanner.ParallelScanner, song_file_scanner() by default
+        """
+        if scanner is None:
+            scanner = self.song_file_scanner()
+        for path, stat in scanner:
+            yield path.decode('utf-8'), stat
 
     def add_song_file(self, song_file):
         """Add a song file to the database, if it not already exists."""
         try:
             self.db.insert_songfile(song_file.encode('utf-8'))
-        except IntegrityError:
+        except (IntegrityError, sqlite3.IntegrityError):
             pass
 
-    def yield_duplicates(self):
+    def add_song_files(self, song_files):
+        """
+        Add song files to the database in batches, skipping files that
+        already exist.
+
+        song_files: iterable of (path, stat) tuples, path being unicode and
+                    stat the result of os.stat() or None. Consumed lazily.
+        return: int, number of files added
+        """
+        batch_size = getattr(settings, 'insert_batch_size', DEFAULT_INSERT_BATCH_SIZE)
+        return self.db.insert_songfiles(
+            ((path.encode('utf-8'),) + file_stats(stat) for path, stat in song_files), batch_size)
+
+    def refresh_song_file(self, song_file):
+        """
+        Bring a single song file up to date: add it to the database if it is
+        new, reset it if its size or mtime changed, and fingerprint it if it
+        has no song_id yet.
+
+        song_file: unicode, absolute path to sound file
+        """
+        try:
+            stat = os.stat(song_file)
+        except OSError:
+            return
+        path = song_file.encode('utf-8')
+        size, mtime, inode = file_stats(stat)
+        row = self.db.select_file_stats_by_path(path)
+        if row is None:
+            self.add_song_files([(song_file, stat)])
+        elif (row['file_size'], row['file_mtime']) != (size, mtime):
+            self.db.update_changed_songfiles([(size, mtime, inode, row['file_id'])])
+        elif row['song_id'] is not None:
+            return
+        self.fingerprint_song_file(path)
+
+    def remove_song_files(self, path, is_dir=False):
+        """
+        Remove a song file, or all song files below a directory, from the database.
+
+        path: unicode, absolute path to a sound file or directory
+        is_dir: bool, whether path is a directory
+        """
+        logger.info('Deleting ' + path + ' from database.')
+        if is_dir:
+            self.db.delete_song_files_below(path.encode('utf-8'))
+        else:
+            self.db.delete_song_file(path.encode('utf-8'))
+
+    def move_song_files(self, old_path, new_path, is_dir=False):
+        """
+        Update the path of a moved song file, or of all song files below a
+        moved directory. The files keep their song_id.
+
+        old_path: unicode, absolute path the file or directory was moved from
+        new_path: unicode, absolute path the file or directory was moved to
+        is_dir: bool, whether a directory was moved
+        """
+        logger.info('Moving ' + old_path + ' to ' + new_path + ' in database.')
+        old_path = old_path.encode('utf-8')
+        new_path = new_path.encode('utf-8')
+        if not is_dir:
+            self.db.move_song_files([(old_path, new_path)])
+            return
+        old_prefix = old_path.rstrip('/') + '/'
+        new_prefix = new_path.rstrip('/') + '/'
+        self.db.move_song_files([
+            (row['file_path'], new_prefix + row['file_path'][len(old_prefix):])
+            for row in self.db.select_files_below(old_path)])
+
+    def yield_duplicates(self, resume_token=None, page_size=None):
         """
         Query the database for duplicates and yield lists of duplicate song files
 
-        This is achived by going through all song_ids and then list
-        all song_files that point to a certain song_id. Only
-        return song_ids (together with the song_files) that have more
-        then one song_file pointing to them.
-        """
-        for sid in self.db.select_song_ids():
-            files = []
-            for path in self.db.select_file_by_id(sid['song_id']):
-                files.append(path)
-            if len(files) > 1:
-                logger.debug('Yielding duplicate song id ' + str(sid['song_id']))
+        Only song_ids (together with the song_files) that have more
+        then one song_file pointing to them are returned. The database
+        does the grouping, and rows are streamed from the server, so only
+        one group at a time is held in memory.
+
+        Groups come in the order of song_id. To continue after a group
+        later on, pass duplicates_resume_token(group) as resume_token.
+
+        resume_token: string, only groups after the one it was taken from are yielded
+        page_size: int, number of groups per query. By default a single query
+                   is used, which keeps its connection busy until all groups
+                   are consumed.
+        """
+        after_song_id = int(resume_token) if resume_token else 0
+        while True:
+            files = None
+            for files in self.db.select_duplicate_files(after_song_id, page_size or NO_LIMIT):
+                logger.debug('Yielding duplicate song id ' + str(files[0]['song_id']))
                 yield files
+            if files is None or not page_size:
+                return
+            after_song_id = files[0]['song_id']
+
+    def count_duplicates(self):
+        """Return the number of groups yield_duplicates would yield"""
+        return self.db.select_num_duplicate_groups()
 
     def get_duplicates(self):
         """
@@ -449,16 +2046,16 @@ class mud(object):
 
     def print_duplicates(self):
         """ Print duplicates to std out """
-        dups = self.get_duplicates()
-        if not dups:
-            print('No duplicates found')
-            return
-        for sfiles in dups:
+        found = False
+        for sfiles in self.yield_duplicates():
+            found = True
             print('')
             for sound_file in sfiles:
                 song_title = sound_file['song_title']
                 if not song_title: song_title = 'NO TITLE'
                 print(song_title + ' - ' + sound_file['file_path'])
+        if not found:
+            print('No duplicates found')
 
     def get_dup_albums(self):
         """
@@ -511,55 +2108,441 @@ class mud(object):
             num_errors = self.db.select_num_errors(error_key)
             print('ERRORS: ' + str(num_errors) + ' ' + error_key)
         # Duplicates
-        dups = self.get_duplicates()
-        print('DUPLICATES: ' + str(len(dups)) + ' duplicates found')
+        num_dups = self.count_duplicates()
+        print('DUPLICATES: ' + str(num_dups) + ' duplicates found')
+        # Sketches
+        num_unique = self.db.select_num_unique_sketched()
+        print('SKETCHES: ' + str(num_unique) + ' files unique, not fingerprinted')
+        # Fingerprint store
+        if self.store is not None:
+            print('STORE: ' + str(len(self.store)) + ' fingerprints in ' + str(len(self.store.segments)) +
+                  ' segments, ' + str(self.store.nbytes / 2 ** 20) + ' MiB')
+
+    def import_fingerprints(self):
+        """
+        Copy the fingerprints table of the instance into its fingerprint store.
+
+        return: int, number of fingerprints copied, or -1 if the store is
+                missing or not empty
+        """
+        if self.store is None:
+            logger.error('Instance ' + str(self.inst_num) + ' has no fingerprint_store in settings.py')
+            return -1
+        if len(self.store) > 0:
+            logger.error('Fingerprint store ' + self.store.path + ' is not empty')
+            return -1
+        logger.info('Copying fingerprints to ' + self.store.path)
+        count = self.store.import_rows(self.db.select_fingerprints())
+        self.store.close()
+        logger.info('Copied ' + str(count) + ' fingerprints to ' + self.store.path)
+        return count
 
     def check_files(self):
         """
         Go through songfiles table and check if each file still exists on disk.
+
+        The table is read page by page, ordered by path, and every directory
+        is listed once instead of checking each file on its own. Missing files
+        are deleted in batches, in a single transaction at the end.
         """
         logger.info('Checking all songs in database still exists on disk.')
-        for song_file in self.db.select_all_song_files():
-            if not os.path.isfile(song_file['file_path']):
-                logger.info('Deleting ' + song_file['file_path'] + ' from database.')
-                self.db.delete_song_file(song_file['file_path'])
+        listings = {}
+        missing = []
+        for page in self.db.select_song_file_pages():
+            for song_file in page:
+                directory, name = os.path.split(song_file['file_path'])
+                if directory not in listings:
+                    if len(listings) > 1000:
+                        listings.clear()
+                    listings[directory] = list_dir(directory)
+                listing = listings[directory]
+                if listing is not None and name not in listing:
+                    logger.info('Deleting ' + song_file['file_path'] + ' from database.')
+                    missing.append(song_file['file_id'])
+        if missing:
+            self.db.delete_song_files(missing)
+        logger.info('Deleted ' + str(len(missing)) + ' files from database.')
+
+def list_dir(directory):
+    """
+    Return the set of names in directory. If it does not exist, the set is
+    empty. If it can't be read for another reason, return None.
 
-def fill_dupes(inst_num, queue):
+    directory: string, full path of directory
     """
-    Create a mud instance and fill queue with duplicates.
-    
-    inst_num: int, the number 
+    try:
+        return set(os.listdir(directory))
+    except OSError as err:
+        if err.errno in (errno.ENOENT, errno.ENOTDIR):
+            return set()
+        logger.warning('Could not list ' + directory + ': ' + str(err))
+        return None
+
+def file_stats(stat):
+    """
+    Return (size, mtime, inode) as stored in the database for the result of
+    os.stat(), or (None, None, None) if stat is None.
+    """
+    if stat is None:
+        return (None, None, None)
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+def claim_worker_id():
+    """Return the id this process claims files with, unique across hosts"""
+    return socket.gethostname() + ':' + str(os.getpid())
+
+def process_alive(pid):
+    """Return True if a process with pid exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def get_tags(song_file):
+    """
+    Return (artist, title, album) of song_file as utf-8 encoded strings.
+
+    Tags are read with mud_tags, eyed3 is only used for tags mud_tags can't
+    parse. Missing tags are empty strings, for files without any tag the
+    file name is used as title.
+
+    song_file: string, absolute path to sound file
+    return: tuple, or None if the file can't be read
+    """
+    try:
+        tags = mud_tags.read_tags(song_file)
+    except IOError:
+        return None
+    except Exception:
+        tags = None
+        try:
+            audio_file = eyed3.load(song_file)
+            if audio_file and audio_file.tag:
+                tags = {
+                    'artist': audio_file.tag.artist,
+                    'title': audio_file.tag.title,
+                    'album': audio_file.tag.album,
+                    }
+        except IOError:
+            return None
+        except eyed3.id3.tag.TagException:
+            pass
+        except Exception:
+            pass
+    if tags:
+        for tag_name,tag_value in tags.iteritems():
+            if tag_value:
+                tags[tag_name] = tag_value.strip().encode('utf-8')
+            else:
+                tags[tag_name] = ''.encode('utf-8')
+    else:
+        logger.warning('File without valid mp3 tag, using filename as "title": ' + song_file)
+        tags = {}
+        tags['artist'] = ''.encode('utf-8')
+        tags['title'] = os.path.split(song_file)[1].replace('.mp3','').replace('.MP3','').decode('utf-8').encode('utf-8')
+        tags['album'] = ''.encode('utf-8')
+    return (tags['artist'], tags['title'], tags['album'])
+
+def sketch_file(song_file):
+    """
+    Sketch one file for mud.sketch_files.
+
+    song_file: (file_id, file_path) tuple
+    return: (file_duration, sketch, file_id), the sketch packed by
+            mud_sketch.pack. Files that can't be decoded get an empty
+            sketch, and are never found unique.
+    """
+    file_id, file_path = song_file
+    try:
+        samples, fs = mud_sketch.decode(file_path)
+        words = mud_sketch.sketch(samples, fs)
+        file_duration = mud_sketch.duration(file_path)
+    except (pydub.exceptions.CouldntDecodeError, IOError, OSError) as err:
+        logger.warning('Could not sketch ' + file_path + ': ' + str(err))
+        return None, '', file_id
+    return file_duration, mud_sketch.pack(words), file_id
+
+class CollectionWriter(object):
+    """
+    Read tags of song files with a pool of threads and write them to the
+    database together with the song ids, batch_size files per transaction.
+
+    Call read_tags as soon as a file is known, so the tags are ready by the
+    time its song id is, then add, and close when done. Files are written at
+    least every write_interval seconds, so not much work is lost when mud
+    gets killed.
     """
-    logger.debug('Filling queue with duplicates from instance ' + str(inst_num))
+
+    def __init__(self, db, threads=None, batch_size=None, write_interval=DEFAULT_WRITE_INTERVAL):
+        """
+        db: MudDatabase
+        threads: int, number of threads reading tags, settings.tag_threads by default
+        batch_size: int, number of files written at once, settings.insert_batch_size by default
+        write_interval: int, seconds files are kept at most before they are written
+        """
+        if threads is None:
+            threads = getattr(settings, 'tag_threads', DEFAULT_TAG_THREADS)
+        if batch_size is None:
+            batch_size = getattr(settings, 'insert_batch_size', DEFAULT_INSERT_BATCH_SIZE)
+        self.db = db
+        self.batch_size = batch_size
+        self.write_interval = write_interval
+        self.next_write = time.time() + write_interval
+        self.pool = ThreadPool(threads)
+        # song_file -> AsyncResult of get_tags
+        self.tags = {}
+        self.songfiles = []
+        self.error_songfiles = []
+
+    def read_tags(self, song_file):
+        """Start reading the tags of song_file in the background"""
+        if song_file not in self.tags:
+            self.tags[song_file] = self.pool.apply_async(get_tags, (song_file,))
+
+    def add(self, song_file, song_id):
+        """
+        Add song_file to the collection, with foreign key song_id.
+
+        song_file: string, absolute path to sound file
+        song_id: int, foreign key to songs database, or an error code
+        """
+        self.read_tags(song_file)
+        tags = self.tags.pop(song_file).get()
+        if tags is None:
+            return
+        if song_id > 0:
+            self.songfiles.append((song_id,) + tags + (song_file,))
+        else:
+            self.error_songfiles.append((song_id,) + tags + (song_file,))
+        if (len(self.songfiles) + len(self.error_songfiles) >= self.batch_size or
+                time.time() >= self.next_write):
+            self.flush()
+
+    def flush(self):
+        """Write the files added so far to the database"""
+        if self.songfiles or self.error_songfiles:
+            self.db.update_songfiles(self.songfiles, self.error_songfiles)
+        self.songfiles = []
+        self.error_songfiles = []
+        self.next_write = time.time() + self.write_interval
+
+    def close(self):
+        """Write remaining files and stop the threads"""
+        self.flush()
+        self.pool.close()
+        self.pool.join()
+
+class FingerprintWorker(object):
+    """Coordinator side handle of a fingerprint worker process"""
+
+    STARTING = 'starting'
+    IDLE = 'idle'
+    BUSY = 'busy'
+    DEAD = 'dead'
+
+    def __init__(self, num, inst_num, result_queue):
+        """
+        Start a fingerprint worker process.
+
+        num: int, number of the worker, used to route results back
+        inst_num: int, the mud instance number
+        result_queue: multiprocessing.Queue shared by all workers
+        """
+        self.num = num
+        self.inst_num = inst_num
+        self.result_queue = result_queue
+        self.start()
+
+    def start(self):
+        """(Re)start the worker process"""
+        logger.debug('Starting fingerprint worker ' + str(self.num))
+        self.task_queue = MPQueue()
+        self.song_file = None
+        self.state = self.STARTING
+        self.process = Process(target=fingerprint_files,
+                               args=(self.num, self.inst_num, self.task_queue, self.result_queue))
+        self.process.daemon = True
+        self.process.start()
+
+    def assign(self, song_file):
+        """Hand song_file to the worker"""
+        logger.debug('Handing ' + song_file + ' to fingerprint worker ' + str(self.num))
+        self.song_file = song_file
+        self.state = self.BUSY
+        self.task_queue.put(song_file)
+
+    def stop(self):
+        """Tell the worker there is no more work and wait for it"""
+        if self.process.is_alive():
+            self.task_queue.put(None)
+        self.process.join()
+
+def fingerprint_files(num, inst_num, task_queue, result_queue):
+    """
+    Fingerprint worker process. Fingerprint files from task_queue until None
+    is received, and put (num, song_file, song_id) on result_queue.
+    (num, None, None) is sent once the worker is ready to take files.
+
+    num: int, number of the worker
+    inst_num: int, the mud instance number
+    task_queue: multiprocessing.Queue, files for this worker only
+    result_queue: multiprocessing.Queue, shared by all workers
+    """
+    # do not reuse database connections inherited from the coordinator
+    Cursor.clear_cache()
     mud_inst = mud(inst_num)
-    for files in mud_inst.yield_duplicates():
-        queue.put(files)
-    queue.put(None)
+    result_queue.put((num, None, None))
+    while True:
+        song_file = task_queue.get()
+        if song_file is None:
+            break
+        logger.debug('Getting song id for ' + song_file)
+        result_queue.put((num, song_file, mud_inst.get_song_id(song_file)))
+    mud_inst.close()
+
+def duplicates_resume_token(files):
+    """
+    Return the token to continue mud.yield_duplicates after a group.
+
+    files: list of rows, as yielded by mud.yield_duplicates
+    """
+    return str(files[0]['song_id'])
+
+def prefetch(rows, batch_size, max_batches=DEFAULT_PREFETCH_BATCHES):
+    """
+    Yield rows, read by a thread batch_size rows at a time and at most
+    max_batches batches ahead, so reading overlaps with what is done with them.
+
+    Close the returned generator if it is not consumed to the end: the
+    thread stops reading, and closes rows if it is a generator.
+
+    rows: iterable
+    """
+    batches = Queue.Queue(maxsize=max_batches)
+    stop = threading.Event()
+
+    def read():
+        rows_iter = iter(rows)
+        try:
+            while not stop.is_set():
+                batch = list(itertools.islice(rows_iter, batch_size))
+                batches.put((batch, None))
+                if not batch:
+                    return
+        except Exception as err:
+            batches.put((None, err))
+        finally:
+            if hasattr(rows_iter, 'close'):
+                rows_iter.close()
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            batch, err = batches.get()
+            if err is not None:
+                raise err
+            if not batch:
+                break
+            for row in batch:
+                yield row
+    finally:
+        stop.set()
+        # a reader waiting for room in the queue would never see stop
+        while reader.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        reader.join()
 
 def pass_duplicates(args):
     """
     Pass possible duplicates from one instance to the next instance.
 
+    The files are copied between the databases in bulk, see
+    MudDatabase.copy_duplicate_files.
+
     args: cli args. args.fill_instance is the instance duplicates should be passed to
     """
     if args.fill_instance < 1: raise Exception('Instance number must be > 0')
     logger.info('Filling instance no ' + str(args.fill_instance) + ' with duplicate candidates')
-    queue = MPQueue()
-    p = Process(target=fill_dupes, args=(args.fill_instance -1, queue))
-    p.start()
-    mud_inst = mud(args.fill_instance) # don't put this above Process(), it won't work.
-    counter = 0
-    while True:
-        files = queue.get()
-        if not files:
-            break
-        for song_file in files:
-            logger.debug('Adding ' + song_file['file_path'] + ' to instance number ' + str(args.fill_instance))
-            mud_inst.add_song_file(song_file['file_path'].decode('utf-8'))
-            counter += 1
-    p.join()
+    source = mud(args.fill_instance - 1)
+    try:
+        mud_inst = mud(args.fill_instance)
+        try:
+            counter = mud_inst.db.copy_duplicate_files(source.db,
+                getattr(settings, 'insert_batch_size', DEFAULT_INSERT_BATCH_SIZE))
+        finally:
+            mud_inst.close()
+    finally:
+        source.close()
     logger.info('Filled instace no ' + str(args.fill_instance) + ' with ' + str(counter) + ' possible duplicates')
 
+def run_tiers(mud_inst):
+    """
+    Pass the duplicates of mud_inst through all later instances in one go,
+    instead of filling (-f) and building (-b) every instance in turn.
+
+    Every group of duplicates is fingerprinted by the next instance. The
+    files of the group it recognizes as the same song are the groups passed
+    on to the instance after that, files left on their own are no duplicates
+    and go no further. So only files every instance confirmed reach the last
+    one, with the highest fingerprint_limit. Files fingerprinted by an
+    instance before keep their song id (or error) there, so an interrupted
+    run can be started again. Files are claimed like build_collection does,
+    so builds (-b) of the later instances may run at the same time.
+
+    mud_inst: mud, the instance whose duplicates are passed on
+    return: list with the number of groups confirmed by every later instance
+    """
+    tiers = [mud(inst_num) for inst_num in range(mud_inst.inst_num + 1, len(settings.dejavu_configs))]
+    if not tiers:
+        logger.error('Instance ' + str(mud_inst.inst_num) + ' is the last one, there is nothing to pass duplicates to')
+        return []
+    # audio is decoded once, by the instance most others can reuse it from
+    decoding_tier = max(tiers, key=lambda decoder_tier: sum(tier.reuses(decoder_tier) for tier in tiers))
+    confirmed = [0] * len(tiers)
+    rejected = [0] * len(tiers)
+    num_groups = 0
+    failed = False
+    try:
+        for files in mud_inst.yield_duplicates(page_size=DEFAULT_PAGE_SIZE):
+            num_groups += 1
+            groups = [[row['file_path'] for row in files]]
+            decoded = {}
+            for num, tier in enumerate(tiers):
+                next_groups = []
+                for group in groups:
+                    song_files = collections.defaultdict(list)
+                    for song_file in group:
+                        song_id = tier.tier_song_id(song_file, decoding_tier, decoded)
+                        if song_id > 0:
+                            song_files[song_id].append(song_file)
+                    for same_song in song_files.itervalues():
+                        if len(same_song) > 1:
+                            next_groups.append(same_song)
+                        else:
+                            rejected[num] += 1
+                confirmed[num] += len(next_groups)
+                groups = next_groups
+                if not groups:
+                    break
+    except Exception:
+        failed = True
+        raise
+    finally:
+        for tier in tiers:
+            tier.finish_claims(failed)
+            tier.close()
+    logger.info('Passed ' + str(num_groups) + ' groups of duplicates from instance ' + str(mud_inst.inst_num))
+    for num, tier in enumerate(tiers):
+        logger.info('Instance ' + str(tier.inst_num) + ' confirmed ' + str(confirmed[num]) + ' groups, ' +
+                    str(rejected[num]) + ' files are no duplicates')
+    return confirmed
+
 #
 # CLI
 #
@@ -610,10 +2593,23 @@ def parse_cli_args():
     parser.add_argument('-s', '--scan',
                         action='store_true',
                         help='Scan music directory for new files. Only permited for primary instance (see -i)')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='With -s, only look at files that are new, changed or moved \
+                            since the last scan. Changed files are fingerprinted again by -b.')
+    parser.add_argument('-k', '--sketch',
+                        action='store_true',
+                        help='Sketch new files and skip fingerprinting those that have no \
+                            possible duplicate (see README). Runs after -s and before -b.')
     parser.add_argument('-b', '--build-collection',
                         action='store_true',
                         help='Go through collection and build database of \
                             audio fingerprints.')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes used for fingerprinting when building \
+                            the collection (see -b). Default is 1.')
     parser.add_argument('-p', '--print-dups',
                         action='store_true',
                         help='Print all duplicates found.')
@@ -626,6 +2622,15 @@ def parse_cli_args():
     parser.add_argument('-c', '--check',
                         action='store_true',
                         help='Check if files in database still exist on disk.')
+    parser.add_argument('--import-fingerprints',
+                        action='store_true',
+                        help='Copy the fingerprints table of the instance into its \
+                            fingerprint_store (see README).')
+    parser.add_argument('-w', '--watch',
+                        action='store_true',
+                        help='Keep running and watch the music directory: new files are \
+                            fingerprinted right away, deleted and moved files are updated \
+                            in the database. Only permited for primary instance (see -i)')
     parser.add_argument('-i', '--instance-number',
                         type=int,
                         default=0,
@@ -634,6 +2639,11 @@ def parse_cli_args():
                         type=int,
                         default=0,
                         help='Specify the instance to fill with possible duplicates. Argument must >= 1, if < 1 nothing will happen.')
+    parser.add_argument('--tiered',
+                        action='store_true',
+                        help='Pass the duplicates of the instance (see -i) through all later \
+                            instances, each confirming or rejecting them, instead of -f and -b \
+                            for every instance.')
     parser.add_argument('-V', '--Version',
                         action='store_true',
                         help='Display version.')
@@ -662,10 +2672,17 @@ if __name__ == '__main__':
     if args.fill_instance > 0:
         pass_duplicates(args)
     mud_inst = mud(args.instance_number)
+    if args.import_fingerprints:
+        if mud_inst.import_fingerprints() < 0:
+            sys.exit(1)
     if args.scan:
-        mud_inst.scan_files()
+        mud_inst.scan_files(incremental=args.incremental)
+    if args.sketch:
+        mud_inst.sketch_files()
     if args.build_collection:
-        mud_inst.build_collection()
+        mud_inst.build_collection(jobs=args.jobs)
+    if args.tiered:
+        run_tiers(mud_inst)
     if args.check:
         mud_inst.check_files()
     if args.print_dups:
@@ -674,3 +2691,11 @@ if __name__ == '__main__':
         mud_inst.print_dup_albums()
     if args.print_stats:
         mud_inst.print_stats()
+    mud_inst.close()
+    if args.watch:
+        if args.instance_number != 0:
+            print('ERROR: Watching is only permitted for the primary instance')
+            sys.exit(1)
+        mud_watch.watch(mud_inst, settings.music_base_dir,
+                        getattr(settings, 'watch_settle_time', mud_watch.DEFAULT_SETTLE_TIME),
+                        getattr(settings, 'watch_poll_interval', mud_watch.DEFAULT_POLL_INTERVAL))
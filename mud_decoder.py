@@ -0,0 +1,224 @@
+"""
+mud_decoder.py - decode only the part of a file that gets fingerprinted
+
+dejavu.decoder.read has pydub decode the whole file into memory and cuts
+off fingerprint_limit seconds afterwards. For an hour long mix that is
+hundreds of MB of samples, of which maybe 30 seconds are used. read asks
+ffmpeg for the wanted window only and streams its PCM output into a buffer
+of the window's size. read_windows does the same for several short windows
+spread over the file.
+"""
+
+import errno
+import logging
+import os
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+from dejavu import decoder
+from pydub.exceptions import CouldntDecodeError
+
+logger = logging.getLogger('mud.decoder')
+
+FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
+
+# bytes read from ffmpeg at once, without a limit
+CHUNK_SIZE = 2 ** 20
+
+# ffmpeg could not be run, dejavu's decoder is used instead
+_ffmpeg_missing = False
+
+
+def read(filename, limit=None, start=0):
+    """
+    Decode a window of filename, like dejavu.decoder.read.
+
+    filename: string, path of an audio file ffmpeg can decode
+    limit: int, seconds to decode, None for all
+    start: int, seconds to skip at the beginning of the file
+    return: (channels, samplerate, file_hash), channels being numpy arrays
+            of 16 bit samples
+    raises: CouldntDecodeError if ffmpeg fails
+    """
+    global _ffmpeg_missing
+    if not _ffmpeg_missing:
+        try:
+            channels, fs = read_pcm(filename, limit, start)
+            return channels, fs, decoder.unique_hash(filename)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            logger.warning(FFMPEG + ' not found, decoding whole files with pydub')
+            _ffmpeg_missing = True
+    channels, fs, file_hash = decoder.read(filename, None if start else limit)
+    if start:
+        channels = [channel[start * fs:] for channel in channels]
+        if limit:
+            channels = [channel[:limit * fs] for channel in channels]
+    return channels, fs, file_hash
+
+def read_windows(filename, windows, step=1):
+    """
+    Decode several windows of filename, placed relative to its duration.
+
+    filename: string, path of an audio file ffmpeg can decode
+    windows: list of (seconds, position) tuples, position being the
+             fraction of the duration at which the window starts, e.g.
+             [(5, 0.2), (5, 0.5), (5, 0.8)]. Windows are moved forward
+             to fit into the file.
+    step: int, windows start at multiples of step samples
+    return: ([(start, channels), ...], samplerate, file_hash), start being
+            the first sample of the window, channels as returned by read
+    raises: CouldntDecodeError if ffmpeg fails
+    """
+    probed = None if _ffmpeg_missing else probe(filename)
+    if probed is None:
+        # no way to place the windows before decoding, cut them out of the whole file
+        channels, fs, file_hash = read(filename)
+        duration = float(len(channels[0]) if channels else 0) / fs
+        starts = window_starts(windows, duration, fs, step)
+        return [(start, [channel[start:start + int(seconds * fs)] for channel in channels])
+                for start, (seconds, position) in zip(starts, windows)], fs, file_hash
+    duration, fs = probed
+    segments = []
+    for start, (seconds, position) in zip(window_starts(windows, duration, fs, step), windows):
+        channels, fs = read_pcm(filename, seconds, float(start) / fs)
+        segments.append((start, channels))
+    return segments, fs, decoder.unique_hash(filename)
+
+def window_starts(windows, duration, fs, step=1):
+    """
+    Return the first sample of every window.
+
+    windows: list of (seconds, position) tuples, as passed to read_windows
+    duration: float, seconds of audio in the file
+    fs: int, samplerate
+    step: int, starts are rounded to multiples of step samples
+    """
+    starts = []
+    for seconds, position in windows:
+        last = int((duration - seconds) * fs) // step * step
+        start = int(round(position * duration * fs / step)) * step
+        starts.append(max(0, min(start, last)))
+    return starts
+
+def probe(filename):
+    """
+    Return (duration, samplerate) of the first audio stream of filename, or
+    None if ffprobe can't tell.
+    """
+    command = [FFPROBE, '-v', 'error', '-select_streams', 'a:0',
+               '-show_entries', 'format=duration:stream=sample_rate', '-of', 'default=noprint_wrappers=1', filename]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    values = dict(line.strip().split('=', 1) for line in output.splitlines() if '=' in line)
+    try:
+        return float(values['duration']), int(values['sample_rate'])
+    except (KeyError, ValueError):
+        return None
+
+def read_pcm(filename, limit=None, start=0, channels=None, fs=None):
+    """
+    Decode a window of filename with ffmpeg.
+
+    Samples are read into a buffer of the window's size as ffmpeg produces
+    them, ffmpeg stops after limit seconds.
+
+    channels: int, have ffmpeg mix down to that many channels, None for all
+    fs: int, have ffmpeg resample to that rate, None for the file's rate
+    return: (channels, samplerate)
+    raises: CouldntDecodeError if ffmpeg fails, OSError if ffmpeg can't be run
+    """
+    command = [FFMPEG, '-nostdin', '-v', 'error']
+    if start:
+        command += ['-ss', '%.6f' % start]
+    command += ['-i', filename, '-vn', '-map_metadata', '-1', '-fflags', '+bitexact',
+                '-acodec', 'pcm_s16le', '-f', 'wav']
+    if channels:
+        command += ['-ac', str(channels)]
+    if fs:
+        command += ['-ar', str(fs)]
+    if limit:
+        command += ['-t', str(limit)]
+    command.append('-')
+    # a broken file makes ffmpeg complain for every frame, more than
+    # fits into a pipe that is only read at the end
+    with tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+        try:
+            channels, fs = read_wav_header(proc.stdout)
+            if limit:
+                data = read_samples(proc.stdout, int(limit * fs) * channels)
+            else:
+                data = read_all_samples(proc.stdout)
+        except CouldntDecodeError:
+            data = None
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if data is None or (returncode and not len(data)):
+            errors.seek(0)
+            messages = errors.read().strip().splitlines() or ['exit code ' + str(returncode)]
+            raise CouldntDecodeError('Decoding ' + filename + ' failed: ' + messages[-1])
+    # whole frames only
+    data = data[:len(data) - len(data) % channels]
+    return [data[chn::channels] for chn in range(channels)], fs
+
+def read_wav_header(stream):
+    """
+    Read the header of the WAV file ffmpeg writes to stream.
+
+    return: (channels, samplerate), stream is positioned at the first sample
+    raises: CouldntDecodeError if there is no WAV header
+    """
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != 'RIFF' or header[8:12] != 'WAVE':
+        raise CouldntDecodeError('No WAV header')
+    channels = fs = None
+    while True:
+        chunk_header = stream.read(8)
+        if len(chunk_header) < 8:
+            raise CouldntDecodeError('No data chunk')
+        chunk_id, size = chunk_header[:4], struct.unpack('<I', chunk_header[4:])[0]
+        if chunk_id == 'data':
+            if channels is None:
+                raise CouldntDecodeError('No fmt chunk')
+            return channels, fs
+        data = stream.read(size + size % 2)
+        if chunk_id == 'fmt ':
+            channels, fs = struct.unpack('<HI', data[2:8])
+
+def read_samples(stream, count):
+    """
+    Read up to count 16 bit samples from stream into a new array.
+
+    return: numpy array of int16, shorter than count if stream ended before
+    """
+    data = np.empty(count, np.int16)
+    view = memoryview(data.view(np.uint8))
+    pos = 0
+    while pos < len(view):
+        read = stream.readinto(view[pos:])
+        if not read:
+            break
+        pos += read
+    return data[:pos // 2]
+
+def read_all_samples(stream):
+    """Read 16 bit samples from stream until it ends"""
+    chunks = []
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    data = ''.join(chunks)
+    return np.frombuffer(data[:len(data) - len(data) % 2], np.int16)
@@ -0,0 +1,146 @@
+"""
+mud_fingerprint.py - fingerprint audio with numpy array operations
+
+Produces the same hashes as dejavu.fingerprint.fingerprint, so songs
+fingerprinted by either one are recognized by the other, but:
+
+- the spectrogram is computed with one real FFT over blocks of windows,
+  instead of a complex FFT per window of matplotlib's specgram
+- local maxima are found by growing a cross shaped maximum filter,
+  instead of scipy's maximum_filter with the 841 cell diamond footprint
+- peaks are paired with their neighbours with array operations, only the
+  sha1 of every pair is computed in Python
+
+See dev/bench_fingerprint.py for a comparison with dejavu.
+"""
+
+import hashlib
+
+import numpy as np
+
+from dejavu.fingerprint import (DEFAULT_FS, DEFAULT_WINDOW_SIZE, DEFAULT_OVERLAP_RATIO,
+                                DEFAULT_FAN_VALUE, DEFAULT_AMP_MIN, PEAK_NEIGHBORHOOD_SIZE,
+                                MIN_HASH_TIME_DELTA, MAX_HASH_TIME_DELTA, FINGERPRINT_REDUCTION)
+
+# windows transformed at once, bounds the memory used for long tracks
+FFT_BLOCK_SIZE = 1024
+
+
+def fingerprint(channel_samples, Fs=DEFAULT_FS,
+                wsize=DEFAULT_WINDOW_SIZE,
+                wratio=DEFAULT_OVERLAP_RATIO,
+                fan_value=DEFAULT_FAN_VALUE,
+                amp_min=DEFAULT_AMP_MIN):
+    """
+    Return the hashes of one channel, like dejavu.fingerprint.fingerprint.
+
+    channel_samples: numpy array of samples
+    return: list of (hash, offset) tuples, in the order dejavu yields them
+    """
+    arr2D = spectrogram(channel_samples, Fs, wsize, int(wsize * wratio))
+    freqs, times = find_peaks(arr2D, amp_min)
+    return generate_hashes(freqs, times, fan_value)
+
+def spectrogram(samples, Fs=DEFAULT_FS, wsize=DEFAULT_WINDOW_SIZE, noverlap=DEFAULT_WINDOW_SIZE // 2):
+    """
+    Return the power spectral density of samples in dB, as dejavu computes it.
+
+    The scaling is that of matplotlib.mlab.specgram, and -inf (silence) is
+    replaced by 0.
+
+    samples: numpy array of samples
+    Fs: int, sampling rate
+    wsize: int, samples per window
+    noverlap: int, samples two consecutive windows have in common
+    return: 2D numpy array, frequencies x windows
+    """
+    samples = np.asarray(samples)
+    if len(samples) < wsize:
+        samples = np.concatenate([samples, np.zeros(wsize - len(samples), samples.dtype)])
+    step = wsize - noverlap
+    num_windows = (len(samples) - noverlap) // step
+    window = np.hanning(wsize)
+    # the same scaling as specgram with scale_by_freq: one sided spectrum,
+    # without doubling the DC and Nyquist frequencies of an even wsize
+    scale = np.empty(wsize // 2 + 1)
+    scale[:] = 2. / Fs / (window ** 2).sum()
+    scale[0] /= 2
+    if not wsize % 2:
+        scale[-1] /= 2
+    result = np.empty((wsize // 2 + 1, num_windows))
+    stride = samples.strides[0]
+    for start in range(0, num_windows, FFT_BLOCK_SIZE):
+        count = min(FFT_BLOCK_SIZE, num_windows - start)
+        windows = np.lib.stride_tricks.as_strided(
+            samples[start * step:], shape=(count, wsize), strides=(step * stride, stride))
+        spectrum = np.fft.rfft(windows * window, axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        result[:, start:start + count] = (power * scale).T
+    with np.errstate(divide='ignore'):
+        result = 10 * np.log10(result)
+    result[result == -np.inf] = 0
+    return result
+
+def grow(arr2D, steps, function):
+    """
+    Apply function to every cell and its four neighbours, steps times.
+
+    With np.maximum this is scipy's maximum_filter with the footprint of
+    dejavu (iterate_structure of the cross, steps times) in 'reflect' mode:
+    a cell outside the array would be a copy of the cell at the edge, which
+    is looked at anyway. With np.logical_or it's the binary dilation with
+    that footprint.
+    """
+    result = arr2D.copy()
+    for i in range(steps):
+        current = result.copy()
+        function(result[1:], current[:-1], out=result[1:])
+        function(result[:-1], current[1:], out=result[:-1])
+        function(result[:, 1:], current[:, :-1], out=result[:, 1:])
+        function(result[:, :-1], current[:, 1:], out=result[:, :-1])
+    return result
+
+def find_peaks(arr2D, amp_min=DEFAULT_AMP_MIN):
+    """
+    Find the peaks dejavu.fingerprint.get_2D_peaks finds.
+
+    arr2D: 2D numpy array, as returned by spectrogram
+    amp_min: minimum amplitude of a peak
+    return: (freqs, times), numpy arrays of the frequency and time index of
+            every peak, sorted by time and frequency
+    """
+    peaks = (grow(arr2D, PEAK_NEIGHBORHOOD_SIZE, np.maximum) == arr2D) & (arr2D > amp_min)
+    if amp_min < 0:
+        # dejavu removes maxima in silent areas, with amp_min >= 0 they
+        # are below the minimum anyway
+        background = arr2D == 0
+        eroded_background = ~grow(~background, PEAK_NEIGHBORHOOD_SIZE, np.logical_or)
+        peaks &= ~eroded_background
+    times, freqs = np.nonzero(peaks.T)
+    return freqs, times
+
+def generate_hashes(freqs, times, fan_value=DEFAULT_FAN_VALUE):
+    """
+    Pair every peak with the next fan_value - 1 peaks and hash the pairs,
+    like dejavu.fingerprint.generate_hashes.
+
+    freqs, times: numpy arrays, as returned by find_peaks
+    return: list of (hash, offset) tuples
+    """
+    num_peaks = len(freqs)
+    if num_peaks == 0:
+        return []
+    # row i holds the indexes of the peaks paired with peak i, in dejavu's order
+    partners = np.arange(num_peaks)[:, np.newaxis] + np.arange(1, fan_value)[np.newaxis, :]
+    valid = partners < num_peaks
+    partners = np.minimum(partners, num_peaks - 1)
+    t_delta = times[partners] - times[:, np.newaxis]
+    valid &= (t_delta >= MIN_HASH_TIME_DELTA) & (t_delta <= MAX_HASH_TIME_DELTA)
+    firsts = np.nonzero(valid)[0]
+    freq1 = freqs[firsts].tolist()
+    freq2 = freqs[partners[valid]].tolist()
+    t_delta = t_delta[valid].tolist()
+    t1 = times[firsts].tolist()
+    sha1 = hashlib.sha1
+    return [(sha1('%d|%d|%d' % pair).hexdigest()[:FINGERPRINT_REDUCTION], offset)
+            for pair, offset in zip(zip(freq1, freq2, t_delta), t1)]
@@ -0,0 +1,249 @@
+"""
+mud_index.py - look up fingerprints in memory instead of in the database
+
+Recognizing a song means looking up thousands of hashes. dejavu sends them to
+the fingerprints table in batches of SELECT ... WHERE hash IN (...), which
+makes the database the bottleneck once the table has tens of millions of
+rows. FingerprintIndex loads the whole table into sorted numpy arrays once,
+and answers the same lookups with a binary search.
+"""
+
+import binascii
+import itertools
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger('mud.index')
+
+# rows added to the delta arrays before they are merged into the main arrays
+DEFAULT_MAX_DELTA = 1000000
+
+# rows converted to arrays at once when loading from the database
+LOAD_CHUNK_SIZE = 100000
+
+# song ids just below the highest one in the index that are looked for
+# again, as other processes may still be inserting these songs
+MAX_PENDING_SONG_IDS = 1000
+
+# seconds a song id is looked for again. Ids that don't show up by then
+# belong to songs that were deleted or rolled back.
+DEFAULT_PENDING_TIMEOUT = 600
+
+HASH_DTYPE = 'S10'
+SONG_ID_DTYPE = np.uint32
+OFFSET_DTYPE = np.uint32
+
+
+class Fingerprints(object):
+    """Fingerprints in three arrays of the same length, sorted by hash"""
+
+    def __init__(self, hashes=None, song_ids=None, offsets=None):
+        """
+        hashes: numpy array of HASH_DTYPE, sorted
+        song_ids: numpy array of SONG_ID_DTYPE
+        offsets: numpy array of OFFSET_DTYPE
+        """
+        self.hashes = np.array([], HASH_DTYPE) if hashes is None else hashes
+        self.song_ids = np.array([], SONG_ID_DTYPE) if song_ids is None else song_ids
+        self.offsets = np.array([], OFFSET_DTYPE) if offsets is None else offsets
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @property
+    def nbytes(self):
+        return self.hashes.nbytes + self.song_ids.nbytes + self.offsets.nbytes
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Return sorted Fingerprints of rows.
+
+        rows: iterable of (hash, song_id, offset), hash being the 10 bytes
+              stored in the database. Consumed in chunks, so it can be a
+              generator over millions of rows.
+        """
+        rows = iter(rows)
+        chunks = []
+        while True:
+            chunk = list(itertools.islice(rows, LOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            hashes, song_ids, offsets = zip(*chunk)
+            chunks.append((
+                np.array([str(h) for h in hashes], HASH_DTYPE),
+                np.array(song_ids, SONG_ID_DTYPE),
+                np.array(offsets, OFFSET_DTYPE)))
+        if not chunks:
+            return cls()
+        hashes, song_ids, offsets = [np.concatenate(arrays) for arrays in zip(*chunks)]
+        order = np.argsort(hashes, kind='mergesort')
+        return cls(hashes[order], song_ids[order], offsets[order])
+
+    def merge(self, other):
+        """
+        Return new Fingerprints with the rows of self and other.
+
+        other: Fingerprints, sorted as well. Merging costs a copy of both,
+               no sorting.
+        """
+        positions = self.hashes.searchsorted(other.hashes)
+        return Fingerprints(
+            np.insert(self.hashes, positions, other.hashes),
+            np.insert(self.song_ids, positions, other.song_ids),
+            np.insert(self.offsets, positions, other.offsets))
+
+    def lookup(self, hashes):
+        """
+        Find all rows matching hashes.
+
+        hashes: numpy array of HASH_DTYPE
+        return: (query_index, song_ids, offsets), the index of the matching
+                hash in hashes, and song_id and offset of every matching row
+        """
+        first = self.hashes.searchsorted(hashes, 'left')
+        last = self.hashes.searchsorted(hashes, 'right')
+        counts = last - first
+        total = counts.sum()
+        query_index = np.repeat(np.arange(len(hashes)), counts)
+        # position of every match relative to the first match of its hash
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = first[query_index] + within
+        return query_index, self.song_ids[rows], self.offsets[rows]
+
+
+class FingerprintIndex(object):
+    """
+    All fingerprints of a database in memory, for recognition.
+
+    The index is loaded on first use. New songs fingerprinted by this
+    process are added with add, songs fingerprinted by other processes are
+    picked up from the database before every lookup. Only songs with an id
+    above the highest one in the index are fetched, and the ids below it
+    that were missing, for pending_timeout seconds: a song inserted by
+    another process may commit after songs with a higher id. New rows go
+    to small delta arrays first, which are merged into the main arrays
+    every max_delta rows.
+
+    Every fingerprint takes 18 bytes, see nbytes.
+    """
+
+    def __init__(self, db, max_delta=DEFAULT_MAX_DELTA, pending_timeout=DEFAULT_PENDING_TIMEOUT):
+        """
+        db: MudDatabase, to load fingerprints from
+        max_delta: int, rows kept in the delta arrays before merging
+        pending_timeout: int, seconds missing song ids are looked for again
+        """
+        self.db = db
+        self.max_delta = max_delta
+        self.pending_timeout = pending_timeout
+        self.main = None
+        self.delta = Fingerprints()
+        # song ids in the index, the highest of them, and missing song ids
+        # below it -> time they were found missing
+        self.song_ids = set()
+        self.max_song_id = 0
+        self.pending_song_ids = {}
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of the index, in bytes"""
+        if self.main is None:
+            return 0
+        return self.main.nbytes + self.delta.nbytes
+
+    def __len__(self):
+        if self.main is None:
+            return 0
+        return len(self.main) + len(self.delta)
+
+    def load(self):
+        """Load all fingerprints from the database, if not done yet"""
+        if self.main is not None:
+            return
+        start = time.time()
+        self.song_ids = set(self.db.select_fingerprinted_song_ids())
+        self._advance(self.song_ids)
+        # songs fingerprinted while loading are picked up by the next update
+        self.main = Fingerprints.from_rows(self.db.select_fingerprints(max_song_id=self.max_song_id))
+        logger.info('Loaded ' + str(len(self.main)) + ' fingerprints of ' + str(len(self.song_ids)) +
+                    ' songs in ' + '%.1f' % (time.time() - start) + ' seconds, using ' +
+                    str(self.nbytes / 2 ** 20) + ' MiB')
+
+    def add(self, song_id, hashes):
+        """
+        Add the fingerprints of a new song.
+
+        song_id: int
+        hashes: iterable of (hash, offset), hash in hex, as stored by
+                MudDatabase.insert_fingerprinted_song
+        """
+        if self.main is None:
+            # will be loaded from the database
+            return
+        self._add([song_id], ((binascii.unhexlify(h), song_id, offset) for h, offset in hashes))
+
+    def _advance(self, song_ids):
+        """
+        Raise max_song_id to the highest of song_ids, just added to the
+        index, and remember the ids skipped as pending.
+        """
+        for song_id in song_ids:
+            self.pending_song_ids.pop(song_id, None)
+        top = max(song_ids) if song_ids else 0
+        if top <= self.max_song_id:
+            return
+        now = time.time()
+        for song_id in xrange(max(self.max_song_id + 1, top - MAX_PENDING_SONG_IDS), top):
+            if song_id not in self.song_ids:
+                self.pending_song_ids[song_id] = now
+        self.max_song_id = top
+
+    def _add(self, song_ids, rows):
+        """Add rows of (hash, song_id, offset), the fingerprints of song_ids"""
+        self.song_ids.update(song_ids)
+        self._advance(song_ids)
+        self.delta = self.delta.merge(Fingerprints.from_rows(rows))
+        if len(self.delta) >= self.max_delta:
+            self.main = self.main.merge(self.delta)
+            self.delta = Fingerprints()
+            logger.info('Fingerprint index has ' + str(len(self.main)) + ' fingerprints of ' +
+                        str(len(self.song_ids)) + ' songs, using ' + str(self.nbytes / 2 ** 20) + ' MiB')
+
+    def update(self):
+        """Add songs other processes have fingerprinted since the last update"""
+        expired = time.time() - self.pending_timeout
+        for song_id, since in self.pending_song_ids.items():
+            if since < expired:
+                del self.pending_song_ids[song_id]
+        new_song_ids = [song_id for song_id in self.db.select_fingerprinted_song_ids(
+                            self.max_song_id, sorted(self.pending_song_ids))
+                        if song_id not in self.song_ids]
+        if not new_song_ids:
+            return
+        logger.debug('Adding ' + str(len(new_song_ids)) + ' new songs to the fingerprint index')
+        self._add(new_song_ids, self.db.select_fingerprints(song_ids=new_song_ids))
+
+    def return_matches(self, hashes):
+        """
+        Return the (song_id, offset_diff) tuples associated with a list of
+        (sha1, sample_offset) values, like SQLDatabase.return_matches.
+        """
+        self.load()
+        self.update()
+        # as in dejavu, the last offset of a hash wins
+        mapper = {}
+        for h, offset in hashes:
+            mapper[binascii.unhexlify(h)] = offset
+        if not mapper:
+            return []
+        query = np.array(mapper.keys(), HASH_DTYPE)
+        query_offsets = np.array(mapper.values(), np.int64)
+        matches = []
+        for fingerprints in (self.main, self.delta):
+            query_index, song_ids, offsets = fingerprints.lookup(query)
+            diffs = offsets.astype(np.int64) - query_offsets[query_index]
+            matches.extend(zip(song_ids.tolist(), diffs.tolist()))
+        return matches
@@ -0,0 +1,194 @@
+"""
+mud_scanner.py - walk a directory tree with several threads
+
+On network storage every directory listing and stat is a round trip, so a
+single threaded os.walk spends most of its time waiting. ParallelScanner
+lists several directories at once and yields files as they are found.
+"""
+
+import logging
+import os
+import Queue
+import stat as stat_module
+import sys
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger('mud.scanner')
+
+DEFAULT_SCAN_THREADS = 8
+# seconds between two progress messages
+REPORT_INTERVAL = 10
+# found files waiting to be consumed, before the threads have to wait
+MAX_QUEUED_FILES = 10000
+
+_DONE = object()
+
+
+class _Failure(object):
+    """An unexpected exception of a thread, raised again by __iter__"""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class ParallelScanner(object):
+    """
+    Find files below a directory, listing directories with a pool of threads.
+
+    Every file is stat()ed exactly once (with scandir, directories are told
+    apart from files without a stat at all), and files are yielded while
+    the walk is still going on. Symlinks to directories are not followed,
+    like os.walk does by default.
+
+    With known_dirs, directories whose mtime is the same as when they were
+    listed before are not listed again: no file was added, removed or
+    renamed in them. Their subdirectories are walked, their files are not
+    yielded. Files rewritten in place don't change the mtime of their
+    directory, they go unnoticed.
+    """
+
+    def __init__(self, root_dir, endings, threads=DEFAULT_SCAN_THREADS, known_dirs=None):
+        """
+        root_dir: string, directory to walk
+        endings: tuple of strings, only files ending with one of these are yielded
+        threads: int, number of directories listed at the same time
+        known_dirs: dict, directory -> (mtime, list of subdirectories) as
+                    found when it was listed before
+        """
+        self.root_dir = root_dir
+        self.endings = endings
+        self.threads = threads
+        self.known_dirs = known_dirs or {}
+        self.num_dirs = 0
+        self.num_files = 0
+        # directory -> stat of all directories walked, and the directories
+        # of them that were not listed again
+        self.dirs = {}
+        self.unchanged_dirs = set()
+        self._dir_queue = Queue.Queue()
+        self._file_queue = Queue.Queue(maxsize=MAX_QUEUED_FILES)
+        self._lock = threading.Lock()
+        # directories queued or being listed
+        self._outstanding = 0
+
+    def __iter__(self):
+        """Yield (path, stat) for all matching files"""
+        start = time.time()
+        next_report = start + REPORT_INTERVAL
+        self._queue_dir(self.root_dir)
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+        while True:
+            try:
+                item = self._file_queue.get(timeout=1)
+            except Queue.Empty:
+                item = None
+            if time.time() > next_report:
+                self._report(start)
+                next_report = time.time() + REPORT_INTERVAL
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            if item is not None:
+                yield item
+        self._report(start)
+
+    def _report(self, start):
+        """Log directories and files per second"""
+        elapsed = max(time.time() - start, 0.001)
+        logger.info('Scanned %d directories (%.1f/s) and found %d files (%.1f/s) in %.1f seconds' % (
+            self.num_dirs, self.num_dirs / elapsed, self.num_files, self.num_files / elapsed, elapsed))
+
+    def _queue_dir(self, path):
+        with self._lock:
+            self._outstanding += 1
+        self._dir_queue.put(path)
+
+    def _work(self):
+        """Thread: list directories until the walk is complete"""
+        while True:
+            path = self._dir_queue.get()
+            if path is _DONE:
+                return
+            try:
+                self._walk_dir(path)
+            except OSError as err:
+                logger.warning('Could not list ' + path + ': ' + str(err))
+            except Exception:
+                self._file_queue.put(_Failure(sys.exc_info()))
+            finally:
+                self._dir_done()
+
+    def _dir_done(self):
+        """Count a directory as walked, and end the walk after the last one"""
+        with self._lock:
+            self._outstanding -= 1
+            self.num_dirs += 1
+            done = self._outstanding == 0
+        if done:
+            for i in range(self.threads):
+                self._dir_queue.put(_DONE)
+            self._file_queue.put(_DONE)
+
+    def _walk_dir(self, path):
+        """List path, or only queue its known subdirectories if it is unchanged"""
+        stat = os.stat(path)
+        known = self.known_dirs.get(path)
+        if known is not None and known[0] == stat.st_mtime:
+            with self._lock:
+                self.dirs[path] = stat
+                self.unchanged_dirs.add(path)
+            for subdir in known[1]:
+                self._queue_dir(subdir)
+            return
+        self._list_dir(path)
+        with self._lock:
+            self.dirs[path] = stat
+
+    def _list_dir(self, path):
+        """Queue subdirectories of path and pass on matching files"""
+        if scandir:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    self._queue_dir(entry.path)
+                elif entry.name.endswith(self.endings) and entry.is_file():
+                    self._found(entry.path, entry.stat)
+            return
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            try:
+                stat = os.lstat(entry_path)
+            except OSError:
+                continue
+            if stat_module.S_ISDIR(stat.st_mode):
+                self._queue_dir(entry_path)
+            elif name.endswith(self.endings):
+                if stat_module.S_ISLNK(stat.st_mode):
+                    self._found(entry_path, lambda: os.stat(entry_path))
+                elif stat_module.S_ISREG(stat.st_mode):
+                    self._found(entry_path, lambda: stat)
+
+    def _found(self, path, get_stat):
+        """Pass on a matching file, get_stat returns its stat result"""
+        try:
+            stat = get_stat()
+        except OSError:
+            # gone since listing the directory
+            return
+        if not stat_module.S_ISREG(stat.st_mode):
+            return
+        with self._lock:
+            self.num_files += 1
+        self._file_queue.put((path, stat))
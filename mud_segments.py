@@ -0,0 +1,540 @@
+"""
+mud_segments.py - keep fingerprints in memory-mapped segment files
+
+In MariaDB every fingerprint is an InnoDB row with its own overhead plus an
+index entry, and looking them up means a round trip of SELECT ... IN
+queries. SegmentStore keeps them in a directory of immutable segment
+files instead, 16 bytes per fingerprint, sorted by hash:
+
+    header   8 bytes magic, 8 bytes number of fingerprints (little endian)
+    hashes   uint64, the first 16 hex digits of every hash, sorted
+    song_ids uint32, in the order of hashes
+    offsets  uint32, in the order of hashes
+
+Every column is contiguous, so a lookup is a binary search over the mapped
+hashes and only touches the pages it needs. The song ids and offsets of the
+matches are read afterwards.
+
+New songs are written as small segments. Like in an LSM tree, segments of
+similar size are merged into one in a background thread once there are
+FANOUT of them, so the number of files stays logarithmic. The live
+segments are listed in MANIFEST, which is only replaced (never edited) while
+holding a lock on LOCK, so several processes can add songs and read at the
+same time. Merged segments are deleted, processes that still have them
+mapped keep reading them until they notice the new MANIFEST.
+
+The fingerprints of a song are prepared as a pending segment before its
+database transaction commits, and only published in MANIFEST after it did.
+A rolled back song id may be used again by the next song, its
+fingerprints must never be found. Merges drop the fingerprints of songs
+that are not in the database (anymore), and publish or drop the pending
+segments of processes that died, depending on whether their song made it.
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import mud_index
+
+logger = logging.getLogger('mud.segments')
+
+MAGIC = 'MUDSEG01'
+HEADER_SIZE = 16
+
+HASH_DTYPE = np.dtype('<u8')
+SONG_ID_DTYPE = np.dtype('<u4')
+OFFSET_DTYPE = np.dtype('<u4')
+RECORD_SIZE = HASH_DTYPE.itemsize + SONG_ID_DTYPE.itemsize + OFFSET_DTYPE.itemsize
+
+# segments of a level are merged once there are that many of them
+DEFAULT_FANOUT = 8
+# fingerprints in a segment of level 0, levels grow by FANOUT
+LEVEL_SIZE = 2 ** 16
+# fingerprints sorted at once while merging
+MERGE_CHUNK_SIZE = 2 ** 20
+
+MANIFEST = 'MANIFEST'
+LOCK = 'LOCK'
+MERGE_LOCK = 'MERGE'
+SEGMENT_SUFFIX = '.seg'
+TMP_SUFFIX = '.tmp'
+PENDING_SUFFIX = '.pending'
+
+
+def hash_prefixes(hashes):
+    """
+    Return the hash prefixes stored in segments.
+
+    hashes: iterable of hashes in hex, as returned by dejavu.fingerprint
+    return: numpy array of HASH_DTYPE
+    """
+    return np.array([int(h[:16], 16) for h in hashes], HASH_DTYPE)
+
+def segment_level(count, fanout=DEFAULT_FANOUT):
+    """Return the merge level of a segment with count fingerprints"""
+    level = 0
+    size = LEVEL_SIZE
+    while count >= size:
+        level += 1
+        size *= fanout
+    return level
+
+def pid_alive(pid):
+    """Return whether a process with pid exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class Segment(object):
+    """A segment file, mapped read-only"""
+
+    def __init__(self, path):
+        """
+        path: string, path of the segment file
+        raises: IOError if the file does not exist, ValueError if it's not a segment
+        """
+        self.path = path
+        with open(path, 'rb') as seg_file:
+            header = seg_file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:8] != MAGIC:
+            raise ValueError(path + ' is not a fingerprint segment')
+        self.count = int(np.frombuffer(header[8:], HASH_DTYPE)[0])
+        self.fingerprints = mud_index.Fingerprints(*self._columns(path, 'r', self.count))
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _columns(path, mode, count):
+        """Map the three columns of a segment file with count fingerprints"""
+        if count == 0:
+            return (np.array([], HASH_DTYPE), np.array([], SONG_ID_DTYPE), np.array([], OFFSET_DTYPE))
+        columns = []
+        offset = HEADER_SIZE
+        for dtype in (HASH_DTYPE, SONG_ID_DTYPE, OFFSET_DTYPE):
+            columns.append(np.memmap(path, dtype, mode, offset, (count,)))
+            offset += dtype.itemsize * count
+        return columns
+
+    @classmethod
+    def create(cls, path, count):
+        """
+        Create a segment file for count fingerprints.
+
+        return: (hashes, song_ids, offsets), writable maps of the columns.
+                Flush them and fsync the file before using the segment.
+        """
+        with open(path, 'wb') as seg_file:
+            seg_file.write(MAGIC + np.array([count], HASH_DTYPE).tostring())
+            seg_file.truncate(HEADER_SIZE + RECORD_SIZE * count)
+        return cls._columns(path, 'r+', count)
+
+    @classmethod
+    def write(cls, path, hashes, song_ids, offsets):
+        """
+        Write a segment file of unsorted fingerprints.
+
+        hashes, song_ids, offsets: numpy arrays of the same length
+        """
+        order = np.lexsort((offsets, song_ids, hashes))
+        columns = cls.create(path, len(order))
+        for column, values in zip(columns, (hashes, song_ids, offsets)):
+            column[:] = values[order]
+        sync(path, columns)
+
+
+def sync(path, columns):
+    """Flush the maps of a new segment file to disk"""
+    for column in columns:
+        if isinstance(column, np.memmap):
+            column.flush()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SegmentStore(object):
+    """
+    Fingerprints of a mud instance in a directory of segment files.
+
+    Has the same add and return_matches as mud_index.FingerprintIndex, so
+    mud uses either for recognition.
+    """
+
+    def __init__(self, path, fanout=DEFAULT_FANOUT, merge=True, songs=None):
+        """
+        path: string, directory of the store, created if needed
+        fanout: int, number of segments of a level merged into one
+        merge: bool, merge segments in the background after adding songs
+        songs: function returning a dict of song id -> key (the file hash)
+               of the songs in the database, see prepare. Without it,
+               merges keep all fingerprints and pending segments of dead
+               processes are dropped.
+        """
+        self.path = path
+        self.fanout = fanout
+        self.merge_enabled = merge
+        self.songs = songs
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self.segments = {}
+        self.manifest_stat = None
+        self.tmp_counter = 0
+        self.merge_thread = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self.refresh()
+        return sum(len(segment) for segment in self.segments.values())
+
+    @property
+    def nbytes(self):
+        """Disk space used by the live segments, in bytes"""
+        self.refresh()
+        return sum(HEADER_SIZE + RECORD_SIZE * len(segment) for segment in self.segments.values())
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _tmp_file(self, suffix=TMP_SUFFIX):
+        """Return the path of a new temporary file, named after this process"""
+        with self._lock:
+            self.tmp_counter += 1
+            return self._file(str(os.getpid()) + '.' + str(self.tmp_counter) + suffix)
+
+    def _flock(self, name, blocking=True):
+        """
+        Lock the file name in the store directory.
+
+        return: the open lock file, close it to release the lock, or None
+                if not blocking and another process holds the lock
+        """
+        lock_file = open(self._file(name), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            lock_file.close()
+            if not blocking and err.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return lock_file
+
+    def read_manifest(self):
+        """Return the names of the live segments, oldest first"""
+        try:
+            with open(self._file(MANIFEST)) as manifest:
+                return [line.strip() for line in manifest if line.strip()]
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                return []
+            raise
+
+    def _write_manifest(self, names):
+        """Replace MANIFEST, the caller holds LOCK"""
+        tmp_path = self._tmp_file()
+        with open(tmp_path, 'w') as manifest:
+            manifest.write(''.join(name + '\n' for name in names))
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        os.rename(tmp_path, self._file(MANIFEST))
+
+    def _next_name(self, names):
+        """Return the name of a new segment, the caller holds LOCK"""
+        last = max([int(name[:-len(SEGMENT_SUFFIX)]) for name in names] or [0])
+        return '%012d%s' % (last + 1, SEGMENT_SUFFIX)
+
+    def refresh(self):
+        """Map segments added by other processes, drop merged ones"""
+        try:
+            stat = os.stat(self._file(MANIFEST))
+            stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        except OSError:
+            stat = None
+        if stat == self.manifest_stat:
+            return
+        while True:
+            names = self.read_manifest()
+            try:
+                segments = {}
+                for name in names:
+                    segments[name] = self.segments.get(name) or Segment(self._file(name))
+                break
+            except IOError as err:
+                # merged and deleted since reading MANIFEST, read it again
+                if err.errno != errno.ENOENT:
+                    raise
+        self.segments = segments
+        self.manifest_stat = stat
+
+    def add(self, song_id, hashes):
+        """
+        Add the fingerprints of a new song.
+
+        song_id: int
+        hashes: iterable of (hash, offset), hash in hex, as returned by
+                dejavu.fingerprint.fingerprint
+        """
+        pending_path = self.prepare(song_id, hashes)
+        if pending_path is not None:
+            self.publish(pending_path)
+
+    def prepare(self, song_id, hashes, key=''):
+        """
+        Write the fingerprints of a new song to a pending segment, which is
+        not used until it is published.
+
+        song_id: int
+        hashes: iterable of (hash, offset), hash in hex, as returned by
+                dejavu.fingerprint.fingerprint
+        key: string without dots, identifying the song along with its id,
+             as returned by songs
+        return: string, path of the pending segment, None if there are no hashes
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return None
+        pending_path = self._tmp_file('.' + str(song_id) + '.' + key + PENDING_SUFFIX)
+        Segment.write(pending_path,
+                      hash_prefixes([h for h, offset in hashes]),
+                      np.array([song_id] * len(hashes), SONG_ID_DTYPE),
+                      np.array([offset for h, offset in hashes], OFFSET_DTYPE))
+        return pending_path
+
+    def publish(self, pending_path):
+        """Add a pending segment to the live segments, once its song is committed"""
+        self._publish(pending_path)
+        if self.merge_enabled:
+            self.merge_in_background()
+
+    def _publish(self, path):
+        """Rename the segment file at path to a new segment in MANIFEST"""
+        lock = self._flock(LOCK)
+        try:
+            names = self.read_manifest()
+            name = self._next_name(names)
+            os.rename(path, self._file(name))
+            self._write_manifest(names + [name])
+        finally:
+            lock.close()
+
+    def discard(self, pending_path):
+        """Delete a pending segment, its song was not committed"""
+        try:
+            os.remove(pending_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def add_fingerprints(self, hashes, song_ids, offsets):
+        """
+        Write fingerprints to a new segment.
+
+        hashes, song_ids, offsets: numpy arrays of the same length, unsorted
+        """
+        tmp_path = self._tmp_file()
+        Segment.write(tmp_path, hashes, song_ids, offsets)
+        self.publish(tmp_path)
+
+    def import_rows(self, rows, chunk_size=MERGE_CHUNK_SIZE):
+        """
+        Add fingerprints read from the database, in segments of chunk_size.
+
+        rows: iterable of (hash, song_id, offset), hash being the 10 bytes
+              stored in the database, as yielded by MudDatabase.select_fingerprints
+        return: int, number of fingerprints added
+        """
+        rows = iter(rows)
+        count = 0
+        while True:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    break
+            if not chunk:
+                break
+            hashes, song_ids, offsets = zip(*chunk)
+            self.add_fingerprints(hash_prefixes(str(h).encode('hex') for h in hashes),
+                                  np.array(song_ids, SONG_ID_DTYPE), np.array(offsets, OFFSET_DTYPE))
+            count += len(chunk)
+            logger.info('Added ' + str(count) + ' fingerprints to ' + self.path)
+        return count
+
+    def return_matches(self, hashes):
+        """
+        Return the (song_id, offset_diff) tuples associated with a list of
+        (sha1, sample_offset) values, like SQLDatabase.return_matches.
+        """
+        self.refresh()
+        # as in dejavu, the last offset of a hash wins
+        mapper = {}
+        for h, offset in hashes:
+            mapper[int(h[:16], 16)] = offset
+        if not mapper:
+            return []
+        query = np.array(mapper.keys(), HASH_DTYPE)
+        query_offsets = np.array(mapper.values(), np.int64)
+        matches = []
+        for segment in self.segments.values():
+            query_index, song_ids, offsets = segment.fingerprints.lookup(query)
+            diffs = offsets.astype(np.int64) - query_offsets[query_index]
+            matches.extend(zip(song_ids.tolist(), diffs.tolist()))
+        return matches
+
+    def merge_in_background(self):
+        """Start a merge thread, unless one is running already"""
+        with self._lock:
+            if self.merge_thread is not None and self.merge_thread.is_alive():
+                return
+            self.merge_thread = threading.Thread(target=self.merge)
+            self.merge_thread.daemon = True
+            self.merge_thread.start()
+
+    def close(self):
+        """Wait for a running merge to finish"""
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+
+    def merge(self):
+        """
+        Merge segments until no level has fanout segments.
+
+        Only one process merges at a time, if another one does already this
+        returns right away.
+        """
+        merge_lock = self._flock(MERGE_LOCK, blocking=False)
+        if merge_lock is None:
+            return
+        try:
+            self._remove_stale_files()
+            self._recover_pending()
+            while True:
+                names = self._merge_candidates()
+                if not names:
+                    break
+                self._merge(names)
+        except Exception:
+            logger.exception('Merging segments in ' + self.path + ' failed')
+        finally:
+            merge_lock.close()
+
+    def _merge_candidates(self):
+        """Return the names of the segments of the lowest full level"""
+        self.refresh()
+        levels = {}
+        for name in sorted(self.segments):
+            levels.setdefault(segment_level(len(self.segments[name]), self.fanout), []).append(name)
+        for level in sorted(levels):
+            if len(levels[level]) >= self.fanout:
+                return levels[level]
+        return []
+
+    def _merge(self, names):
+        """
+        Merge the segments names into one and replace them in MANIFEST,
+        dropping the fingerprints of songs that are not in the database.
+        """
+        start = time.time()
+        segments = [self.segments[name].fingerprints for name in names]
+        total = sum(len(segment) for segment in segments)
+        # read after the segments, which were only published once their
+        # songs were committed
+        song_ids = None
+        if self.songs is not None:
+            song_ids = np.array(sorted(self.songs()), SONG_ID_DTYPE)
+            count = 0
+            for segment in segments:
+                for first in range(0, len(segment), MERGE_CHUNK_SIZE):
+                    count += np.in1d(segment.song_ids[first:first + MERGE_CHUNK_SIZE], song_ids).sum()
+        else:
+            count = total
+        tmp_path = self._tmp_file()
+        columns = Segment.create(tmp_path, count)
+        # hashes are evenly distributed, so splitting the key space at every
+        # MERGE_CHUNK_SIZE-th hash of each segment keeps the chunks small
+        pivots = np.unique(np.concatenate(
+            [segment.hashes[::MERGE_CHUNK_SIZE] for segment in segments] + [np.array([0], HASH_DTYPE)]))
+        bounds = [segment.hashes.searchsorted(pivots) for segment in segments]
+        pos = 0
+        for i in range(len(pivots)):
+            chunk = []
+            for segment, segment_bounds in zip(segments, bounds):
+                first = segment_bounds[i]
+                last = segment_bounds[i + 1] if i + 1 < len(pivots) else len(segment)
+                chunk.append((segment.hashes[first:last], segment.song_ids[first:last],
+                              segment.offsets[first:last]))
+            hashes, chunk_song_ids, offsets = [np.concatenate(arrays) for arrays in zip(*chunk)]
+            if song_ids is not None:
+                keep = np.in1d(chunk_song_ids, song_ids)
+                hashes, chunk_song_ids, offsets = hashes[keep], chunk_song_ids[keep], offsets[keep]
+            order = np.lexsort((offsets, chunk_song_ids, hashes))
+            for column, values in zip(columns, (hashes, chunk_song_ids, offsets)):
+                column[pos:pos + len(order)] = values[order]
+            pos += len(order)
+        sync(tmp_path, columns)
+        del columns
+        lock = self._flock(LOCK)
+        try:
+            live = self.read_manifest()
+            name = self._next_name(live)
+            os.rename(tmp_path, self._file(name))
+            # segments added while merging stay
+            self._write_manifest([n for n in live if n not in names] + [name])
+        finally:
+            lock.close()
+        for merged in names:
+            os.remove(self._file(merged))
+        logger.info('Merged ' + str(len(names)) + ' segments with ' + str(count) + ' fingerprints in ' +
+                    '%.1f' % (time.time() - start) + ' seconds')
+        if count < total:
+            logger.info('Dropped ' + str(total - count) + ' fingerprints of songs not in the database')
+
+    def _remove_stale_files(self):
+        """Remove temporary files of processes that died, the caller holds MERGE"""
+        for tmp_path in glob.glob(self._file('*' + TMP_SUFFIX)):
+            try:
+                pid = int(os.path.basename(tmp_path).split('.')[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not pid_alive(pid):
+                logger.debug('Removing stale ' + tmp_path)
+                os.remove(tmp_path)
+
+    def _recover_pending(self):
+        """
+        Publish the pending segments of processes that died after their
+        song was committed, drop the others. The caller holds MERGE.
+        """
+        songs = None
+        for pending_path in glob.glob(self._file('*' + PENDING_SUFFIX)):
+            try:
+                pid, counter, song_id, key = os.path.basename(pending_path)[:-len(PENDING_SUFFIX)].split('.')
+                pid, song_id = int(pid), int(song_id)
+            except ValueError:
+                continue
+            if pid == os.getpid() or pid_alive(pid):
+                continue
+            if songs is None:
+                songs = self.songs() if self.songs is not None else {}
+            if songs.get(song_id) == key:
+                logger.info('Publishing ' + pending_path + ', its song was committed')
+                self._publish(pending_path)
+            else:
+                logger.debug('Removing stale ' + pending_path)
+                os.remove(pending_path)
@@ -0,0 +1,346 @@
+"""
+mud_sketch.py - tell unique songs apart without fingerprinting them
+
+Most songs of a collection have no duplicate, yet every one of them is
+fingerprinted and recognized by dejavu. A sketch is a much cheaper
+description of a song: its duration, read from the MP3 frame headers, and
+one 32 bit word per second of audio. Like in the fingerprints of Haitsma
+and Kalker, every bit compares the energy of two neighbouring frequency
+bands, here over two seconds and relative to the song's median of that
+difference, so it does not change with the bitrate, the volume or a start
+shifted by a fraction of a second.
+
+SketchIndex finds the songs with a similar duration and sketch (a small
+share of differing bits) via locality sensitive hashing: every word is
+put into a few tables, each keyed by a different subset of its bits and the
+duration. Any two songs share a key now and then, near ones share several,
+so only songs sharing MIN_SHARED_KEYS keys are compared bit by bit. Songs
+with no such candidate are unique.
+"""
+
+import errno
+import logging
+import os
+import struct
+
+import numpy as np
+
+import mud_decoder
+import mud_tags
+
+logger = logging.getLogger('mud.sketch')
+
+# seconds decoded for a sketch, and the rate and channels they are decoded to
+SKETCH_SECONDS = 30
+SKETCH_FS = 11025
+
+# frequency bands compared by the bits of a word, in Hz
+NUM_BANDS = 33
+MIN_FREQ = 300
+MAX_FREQ = 2000
+
+# spectrogram of a sketch
+FFT_SIZE = 2048
+FFT_STEP = 1024
+
+# words a sketch needs, shorter songs can't be told apart reliably
+MIN_WORDS = 5
+
+# two sketches are near if their durations differ by at most
+# DURATION_TOLERANCE seconds or DURATION_TOLERANCE_RATIO, and
+# less than MAX_BIT_ERROR_RATE of the bits differ, with the best shift of at
+# most MAX_SHIFT seconds
+DURATION_TOLERANCE = 2.
+DURATION_TOLERANCE_RATIO = 0.02
+MAX_BIT_ERROR_RATE = 0.35
+MAX_SHIFT = 3
+
+# locality sensitive hashing: tables, bits of a word per key, and width of
+# the duration buckets in seconds
+LSH_TABLES = 4
+LSH_BITS = 14
+DURATION_BUCKET = 5.
+# keys two songs must share to be compared. Unrelated songs of a similar
+# duration share one key about every fourth time, three only every 250th,
+# while even noisy copies share a lot more
+MIN_SHARED_KEYS = 3
+
+# MPEG audio frame headers, indexed by the version bits (3: MPEG 1, 2: MPEG 2, 0: MPEG 2.5)
+# and the layer bits (3: layer I, 2: layer II, 1: layer III)
+MPEG_BITRATES = {
+    (1, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+# bytes searched for the first frame header
+MAX_SYNC_SEARCH = 2 ** 16
+
+
+class FrameHeader(object):
+    """The fields of an MPEG audio frame header mud needs"""
+
+    def __init__(self, data):
+        """
+        data: string, 4 bytes
+        raises: ValueError if data is no valid frame header
+        """
+        b0, b1, b2, b3 = bytearray(data[:4])
+        self.version = (b1 >> 3) & 3
+        self.layer = (b1 >> 1) & 3
+        bitrate_index = b2 >> 4
+        sample_rate_index = (b2 >> 2) & 3
+        if (b0 != 0xff or b1 & 0xe0 != 0xe0 or self.version == 1 or self.layer == 0 or
+                bitrate_index in (0, 15) or sample_rate_index == 3):
+            raise ValueError('No frame header')
+        version_group = 1 if self.version == 3 else 2
+        self.bitrate = MPEG_BITRATES[(version_group, self.layer)][bitrate_index] * 1000
+        self.sample_rate = MPEG_SAMPLE_RATES[self.version][sample_rate_index]
+        padding = (b2 >> 1) & 1
+        self.mono = (b3 >> 6) == 3
+        if self.layer == 3:
+            self.samples = 384
+            self.length = (12 * self.bitrate // self.sample_rate + padding) * 4
+        else:
+            self.samples = 1152 if self.layer == 2 or version_group == 1 else 576
+            self.length = self.samples // 8 * self.bitrate // self.sample_rate + padding
+        # the Xing header follows the side information of layer III
+        if version_group == 1:
+            self.side_info = 17 if self.mono else 32
+        else:
+            self.side_info = 9 if self.mono else 17
+
+
+def mp3_duration(path):
+    """
+    Return the duration of an mp3 file in seconds, without decoding it.
+
+    The number of frames is taken from the Xing or VBRI header of VBR files,
+    for CBR files it follows from the bitrate and the file size.
+
+    path: string, path of an mp3 file
+    return: float, or None if no frame header is found
+    """
+    with open(path, 'rb') as mp3_file:
+        start = 0
+        header = mp3_file.read(10)
+        if len(header) == 10 and header[:3] == 'ID3':
+            start = 10 + mud_tags.syncsafe(header[6:10]) + (10 if ord(header[5]) & 0x10 else 0)
+        mp3_file.seek(start)
+        data = mp3_file.read(MAX_SYNC_SEARCH)
+        file_size = os.fstat(mp3_file.fileno()).st_size
+        has_id3v1 = False
+        if file_size >= 128:
+            mp3_file.seek(-128, 2)
+            has_id3v1 = mp3_file.read(3) == 'TAG'
+    pos = data.find('\xff')
+    while 0 <= pos <= len(data) - 4:
+        try:
+            frame = FrameHeader(data[pos:pos + 4])
+            # a second frame right after the first one, not just a stray 0xff
+            if pos + frame.length + 4 <= len(data):
+                FrameHeader(data[pos + frame.length:pos + frame.length + 4])
+            break
+        except ValueError:
+            pos = data.find('\xff', pos + 1)
+    else:
+        return None
+    xing = pos + 4 + frame.side_info
+    vbri = pos + 4 + 32
+    frames = None
+    if data[xing:xing + 4] in ('Xing', 'Info'):
+        if struct.unpack('>I', data[xing + 4:xing + 8])[0] & 1:
+            frames = struct.unpack('>I', data[xing + 8:xing + 12])[0]
+    elif data[vbri:vbri + 4] == 'VBRI':
+        frames = struct.unpack('>I', data[vbri + 14:vbri + 18])[0]
+    if frames is not None:
+        return float(frames) * frame.samples / frame.sample_rate
+    audio_size = file_size - start - pos - (128 if has_id3v1 else 0)
+    return audio_size * 8. / frame.bitrate
+
+def duration(path):
+    """Return the duration of path in seconds, or None if unknown"""
+    if path.lower().endswith('.mp3'):
+        try:
+            seconds = mp3_duration(path)
+        except (IOError, struct.error):
+            seconds = None
+        if seconds is not None:
+            return seconds
+    probed = mud_decoder.probe(path)
+    return probed[0] if probed else None
+
+def decode(path, seconds=SKETCH_SECONDS):
+    """
+    Decode the first seconds of path, downmixed and resampled for sketching.
+
+    return: (samples, samplerate), samples a numpy array
+    raises: CouldntDecodeError
+    """
+    try:
+        channels, fs = mud_decoder.read_pcm(path, seconds, channels=1, fs=SKETCH_FS)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        # no ffmpeg, dejavu's decoder keeps the channels and rate of the file
+        channels, fs, file_hash = mud_decoder.read(path, seconds)
+    if not channels:
+        return np.array([], np.float64), fs
+    return np.mean(channels, axis=0), fs
+
+def band_matrix(fs):
+    """Return a matrix summing the FFT bins of every band"""
+    edges = np.logspace(np.log10(MIN_FREQ), np.log10(MAX_FREQ), NUM_BANDS + 1)
+    bins = np.fft.rfftfreq(FFT_SIZE, 1. / fs)
+    band = np.searchsorted(edges, bins, 'right') - 1
+    matrix = np.zeros((len(bins), NUM_BANDS))
+    in_band = (band >= 0) & (band < NUM_BANDS)
+    matrix[np.nonzero(in_band)[0], band[in_band]] = 1
+    return matrix
+
+def sketch(samples, fs):
+    """
+    Return the sketch of samples, one 32 bit word per whole second but the last.
+
+    samples: numpy array, mono
+    fs: int, samplerate
+    return: numpy array of uint32
+    """
+    num_frames = (len(samples) - FFT_SIZE) // FFT_STEP + 1
+    num_seconds = int(((num_frames - 1) * FFT_STEP + FFT_SIZE) // fs) if num_frames > 0 else 0
+    if num_seconds < 2:
+        return np.array([], np.uint32)
+    samples = np.asarray(samples, np.float64)
+    frames = np.lib.stride_tricks.as_strided(
+        samples, shape=(num_frames, FFT_SIZE), strides=(FFT_STEP * samples.strides[0], samples.strides[0]))
+    spectrum = np.fft.rfft(frames * np.hanning(FFT_SIZE), axis=1)
+    energy = (spectrum.real ** 2 + spectrum.imag ** 2).dot(band_matrix(fs))
+    # energy per second, of the frames starting in that second
+    second_starts = (np.arange(num_seconds) * fs + FFT_STEP - 1) // FFT_STEP
+    energy = np.add.reduceat(energy, second_starts, axis=0)
+    # every word looks at two seconds, so a song starting half a second
+    # later still shares three quarters of the audio of every word
+    energy = energy[:-1] + energy[1:]
+    log_energy = np.log(energy + 1e-10)
+    band_diff = log_energy[:, :-1] - log_energy[:, 1:]
+    bits = band_diff > np.median(band_diff, axis=0)
+    return bits.dot(1 << np.arange(NUM_BANDS - 1, dtype=np.uint64)).astype(np.uint32)
+
+def pack(words):
+    """Return a sketch as string of little endian 32 bit words, for the database"""
+    return np.asarray(words, '<u4').tostring()
+
+def unpack(data):
+    """Return the sketch packed into data by pack"""
+    return np.frombuffer(data or '', '<u4').astype(np.uint32)
+
+def bit_error_rate(words1, words2, max_shift=MAX_SHIFT):
+    """
+    Return the lowest share of differing bits of two sketches, shifted
+    against each other by up to max_shift words.
+    """
+    best = 1.
+    for shift in range(-max_shift, max_shift + 1):
+        first = words1[max(shift, 0):]
+        second = words2[max(-shift, 0):]
+        length = min(len(first), len(second))
+        if length < MIN_WORDS:
+            continue
+        errors = np.unpackbits((first[:length] ^ second[:length]).view(np.uint8)).sum()
+        best = min(best, float(errors) / (32 * length))
+    return best
+
+def durations_near(duration1, duration2):
+    """Return whether two durations could be those of the same song"""
+    tolerance = max(DURATION_TOLERANCE, DURATION_TOLERANCE_RATIO * max(duration1, duration2))
+    return abs(duration1 - duration2) <= tolerance
+
+
+class SketchIndex(object):
+    """
+    Sketches of many songs, for finding the near neighbours of each.
+
+    Keys are kept in one sorted numpy array, rather than a dict, so a
+    collection of 100000 songs takes some 100 MB.
+    """
+
+    def __init__(self, items):
+        """
+        items: iterable of (item, duration, words), duration in seconds,
+               words as returned by sketch. Items without duration or with
+               too short a sketch can't be indexed, they are never unique.
+        """
+        self.items = []
+        self.durations = []
+        self.words = []
+        self.unknown = []
+        for item, seconds, words in items:
+            if seconds is None or len(words) < MIN_WORDS:
+                self.unknown.append(item)
+                continue
+            self.items.append(item)
+            self.durations.append(seconds)
+            self.words.append(words)
+        # bits of a word making up the key of every table
+        random = np.random.RandomState(0)
+        self.masks = [np.uint32(sum(1 << int(bit) for bit in random.choice(32, LSH_BITS, replace=False)))
+                      for table in range(LSH_TABLES)]
+        keys = []
+        indexes = []
+        for index in range(len(self.items)):
+            item_keys = self._keys(self.durations[index], self.words[index])
+            keys.append(item_keys)
+            indexes.append(np.repeat(np.uint32(index), len(item_keys)))
+        keys = np.concatenate(keys) if keys else np.array([], np.uint64)
+        indexes = np.concatenate(indexes) if indexes else np.array([], np.uint32)
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.key_items = indexes[order]
+
+    def __len__(self):
+        return len(self.items) + len(self.unknown)
+
+    def _keys(self, seconds, words, bucket_offset=0):
+        """Return the keys of words in all tables, as uint64"""
+        bucket = np.uint64(max(int(seconds // DURATION_BUCKET) + bucket_offset, 0))
+        keys = []
+        for table, mask in enumerate(self.masks):
+            keys.append((bucket << np.uint64(36)) | (np.uint64(table) << np.uint64(32)) |
+                        (words & mask).astype(np.uint64))
+        return np.unique(np.concatenate(keys))
+
+    def _candidates(self, index):
+        """Return the indexes of items sharing at least MIN_SHARED_KEYS keys with item index"""
+        query = np.concatenate([self._keys(self.durations[index], self.words[index], offset)
+                                for offset in (-1, 0, 1)])
+        first = self.keys.searchsorted(query, 'left')
+        last = self.keys.searchsorted(query, 'right')
+        counts = last - first
+        rows = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        # keys are unique per item and table, items are in one duration
+        # bucket only, so every row is another shared key
+        candidates, shared = np.unique(self.key_items[rows], return_counts=True)
+        return candidates[(shared >= MIN_SHARED_KEYS) & (candidates != index)]
+
+    def has_neighbour(self, index):
+        """Return whether the indexed item index has a near neighbour"""
+        for candidate in self._candidates(index):
+            if (durations_near(self.durations[index], self.durations[candidate]) and
+                    bit_error_rate(self.words[index], self.words[candidate]) < MAX_BIT_ERROR_RATE):
+                return True
+        return False
+
+    def neighbourless(self, items=None):
+        """
+        Yield the indexed items that have no near neighbour, the unique ones.
+
+        items: set of the items to look at, all by default. Their neighbours
+               are searched among all items.
+        """
+        for index, item in enumerate(self.items):
+            if (items is None or item in items) and not self.has_neighbour(index):
+                yield item
@@ -0,0 +1,247 @@
+"""
+mud_sqlite.py - keep the dejavu tables in an SQLite file instead of MariaDB
+
+For a single host this saves running a database server, and small queries
+don't have to go over the network. Select it per instance in
+settings.dejavu_configs:
+
+    {   'database_type': 'sqlite',
+        'database': {
+            'path': '/var/lib/mud/mud.db',},
+        'fingerprint_limit' : 30, },
+
+The SQL of dejavu and mud is reused where it runs on SQLite as well. MySQLdb
+placeholders are translated by the cursor, and UNHEX() and NOW() are
+provided as SQL functions.
+"""
+
+import binascii
+import os
+import Queue
+import sqlite3
+import time
+
+from MySQLdb.cursors import SSDictCursor
+from dejavu.database import Database
+from dejavu.database_sql import SQLDatabase, DictCursor
+
+# seconds to wait for the write lock, while another process holds it
+DEFAULT_TIMEOUT = 60
+
+# cursor types that return rows as dicts
+DICT_CURSOR_TYPES = (DictCursor, SSDictCursor)
+
+
+def unhex(value):
+    """SQL function UNHEX, as in MySQL"""
+    if value is None:
+        return None
+    return buffer(binascii.unhexlify(value))
+
+def now():
+    """SQL function NOW, as in MySQL"""
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+def connect(path, timeout=DEFAULT_TIMEOUT):
+    """
+    Open the database file at path, creating it if needed.
+
+    path: string, path of the database file
+    timeout: int, seconds to wait for locks held by other connections
+    return: sqlite3.Connection, in autocommit mode. Transactions are started
+            and ended by Cursor.
+    """
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                           check_same_thread=False)
+    # return text as utf-8 encoded strings, like MySQLdb does
+    conn.text_factory = str
+    conn.create_function('UNHEX', 1, unhex)
+    conn.create_function('NOW', 0, now)
+    # readers don't block the writer and vice versa
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA foreign_keys=ON')
+    # file paths are case sensitive
+    conn.execute('PRAGMA case_sensitive_like=ON')
+    return conn
+
+
+class CursorWrapper(object):
+    """
+    sqlite3 cursor taking MySQLdb style placeholders, returning rows as
+    dicts if asked to.
+    """
+
+    def __init__(self, cursor, dict_rows=False):
+        """
+        cursor: sqlite3.Cursor
+        dict_rows: bool, return rows as dicts of column name -> value
+        """
+        self.cursor = cursor
+        self.dict_rows = dict_rows
+
+    @staticmethod
+    def _statement(statement):
+        return statement.replace('%s', '?')
+
+    def execute(self, statement, params=None):
+        self.cursor.execute(self._statement(statement), params or ())
+
+    def executemany(self, statement, rows):
+        self.cursor.executemany(self._statement(statement), rows)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def _row(self, row):
+        if row is None or not self.dict_rows:
+            return row
+        return dict(zip([column[0] for column in self.cursor.description], row))
+
+    def fetchone(self):
+        return self._row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self.cursor:
+            yield self._row(row)
+
+    def close(self):
+        self.cursor.close()
+
+
+class Cursor(object):
+    """
+    Like dejavu.database_sql.Cursor, for SQLite: every with block is one
+    transaction. Rows are read as they are iterated, so there is no
+    difference between DictCursor and SSDictCursor.
+
+    Connections are cached per database file and process, so a forked
+    process never uses the connections of its parent.
+    """
+    _cache = {}
+
+    def __init__(self, path, cursor_type=None, immediate=False, timeout=DEFAULT_TIMEOUT):
+        """
+        path: string, path of the database file
+        cursor_type: a MySQLdb cursor class, DictCursor and SSDictCursor return dicts
+        immediate: bool, take the write lock at the start of the transaction,
+                   not with the first write
+        timeout: int, seconds to wait for locks held by other connections
+        """
+        self.key = (os.getpid(), path)
+        try:
+            self.conn = self._cache.setdefault(self.key, Queue.Queue(maxsize=5)).get_nowait()
+        except Queue.Empty:
+            self.conn = connect(path, timeout)
+        self.dict_rows = cursor_type in DICT_CURSOR_TYPES
+        self.immediate = immediate
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE' if self.immediate else 'BEGIN')
+        self.cursor = CursorWrapper(self.conn.cursor(), self.dict_rows)
+        return self.cursor
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.cursor.close()
+        if extype is None:
+            self.conn.execute('COMMIT')
+        else:
+            try:
+                self.conn.execute('ROLLBACK')
+            except sqlite3.OperationalError:
+                # sqlite rolled back already
+                pass
+        try:
+            self._cache[self.key].put_nowait(self.conn)
+        except Queue.Full:
+            self.conn.close()
+
+def cursor_factory(**factory_options):
+    """Return a function creating Cursors, like dejavu.database_sql.cursor_factory"""
+    def cursor(**options):
+        options.update(factory_options)
+        return Cursor(**options)
+    return cursor
+
+
+class SQLiteDatabase(SQLDatabase, Database):
+    """
+    dejavu database with the songs and fingerprints tables in an SQLite file.
+
+    Listing Database as a base class as well registers it with
+    dejavu.database.get_database as database_type 'sqlite'.
+    """
+
+    type = 'sqlite'
+
+    # fingerprints are looked up by hash, so they are stored in hash order
+    CREATE_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+             `%s` blob not null,
+             `%s` integer not null,
+             `%s` integer not null,
+         PRIMARY KEY (%s, %s, %s),
+         FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) WITHOUT ROWID;""" % (
+        SQLDatabase.FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+        Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+        Database.FIELD_SONG_ID, SQLDatabase.SONGS_TABLENAME, Database.FIELD_SONG_ID
+    )
+
+    # for deleting the fingerprints of a song
+    CREATE_FINGERPRINTS_SONG_INDEX = """
+        CREATE INDEX IF NOT EXISTS `%s_%s` ON `%s` (%s);""" % (
+        SQLDatabase.FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID,
+        SQLDatabase.FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID)
+
+    CREATE_SONGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` integer primary key autoincrement,
+            `%s` varchar(250) not null,
+            `%s` tinyint default 0,
+            `%s` blob not null
+    );""" % (
+        SQLDatabase.SONGS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONGNAME,
+        SQLDatabase.FIELD_FINGERPRINTED, Database.FIELD_FILE_SHA1,
+    )
+
+    INSERT_FINGERPRINT = """
+        INSERT OR IGNORE INTO %s (%s, %s, %s) values
+            (UNHEX(%%s), %%s, %%s);
+    """ % (SQLDatabase.FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+           Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    def __init__(self, **options):
+        """
+        options: path, the database file, and optionally timeout, seconds
+                 to wait for other processes writing to the database
+        """
+        Database.__init__(self)
+        self.cursor = cursor_factory(**options)
+        self._options = options
+
+    def setup(self):
+        """
+        Creates any non-existing tables required for dejavu to function.
+
+        This also removes all songs that have been added but have no
+        fingerprints associated with them.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_SONGS_TABLE)
+            cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+            cur.execute(self.CREATE_FINGERPRINTS_SONG_INDEX)
+            cur.execute(self.DELETE_UNFINGERPRINTED)
+
+    def __setstate__(self, state):
+        self._options, = state
+        self.cursor = cursor_factory(**self._options)
@@ -0,0 +1,184 @@
+"""
+mud_tags.py - read artist, title and album of mp3 files
+
+This is a minimal ID3 reader. It only looks at the frames mud stores, and
+skips over everything else (pictures, lyrics, ...) without reading it, so
+it is a lot cheaper than loading the file with eyed3.
+"""
+
+from StringIO import StringIO
+import struct
+import zlib
+
+# frame ids of the tags we want, for ID3v2.2 and ID3v2.3/4
+FRAMES = {
+    2: {'TP1': 'artist', 'TT2': 'title', 'TAL': 'album'},
+    3: {'TPE1': 'artist', 'TIT2': 'title', 'TALB': 'album'},
+    4: {'TPE1': 'artist', 'TIT2': 'title', 'TALB': 'album'},
+}
+
+ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+
+class TagError(Exception):
+    """The tag is there, but broken or using features not supported here"""
+
+
+def read_tags(path):
+    """
+    Read artist, title and album of path.
+
+    path: string, path to an mp3 file
+    return: dict with 'artist', 'title' and 'album' as unicode (missing
+            ones are None), or None if the file has no ID3 tag
+    raises: IOError if the file can't be read, TagError if the tag can't be parsed
+    """
+    with open(path, 'rb') as audio_file:
+        tags = read_id3v2(audio_file)
+        if tags is None:
+            tags = read_id3v1(audio_file)
+    return tags
+
+def syncsafe(data):
+    """Return the integer encoded in the 7 bit bytes of data"""
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+def unsynchronise(data):
+    """Undo the ID3 unsynchronisation scheme"""
+    return data.replace('\xff\x00', '\xff')
+
+def read_id3v2(audio_file):
+    """
+    Read the ID3v2 tag at the start of audio_file.
+
+    audio_file: file object, positioned at the start of the file
+    return: dict as returned by read_tags, or None if there is no ID3v2 tag
+    """
+    header = audio_file.read(10)
+    if len(header) < 10 or header[:3] != 'ID3':
+        return None
+    version = ord(header[3])
+    flags = ord(header[5])
+    size = syncsafe(header[6:10])
+    if version not in FRAMES:
+        raise TagError('Unsupported ID3 version 2.' + str(version))
+    if version == 2 and flags & 0x40:
+        raise TagError('Compressed ID3v2.2 tag')
+    if flags & 0x80 and version < 4:
+        # the whole tag is unsynchronised, so frame sizes only make sense
+        # after undoing that
+        data = unsynchronise(audio_file.read(size))
+        size = len(data)
+        tag_data = StringIO(data)
+        read, skip = tag_data.read, lambda n: tag_data.seek(n, 1)
+    else:
+        read, skip = audio_file.read, lambda n: audio_file.seek(n, 1)
+    pos = 0
+    if flags & 0x40:
+        ext_size = read(4)
+        if version == 3:
+            ext_size = struct.unpack('>I', ext_size)[0]
+        else:
+            ext_size = syncsafe(ext_size) - 4
+        skip(ext_size)
+        pos += 4 + ext_size
+    wanted = FRAMES[version]
+    tags = {'artist': None, 'title': None, 'album': None}
+    found = 0
+    header_size = 6 if version == 2 else 10
+    while pos + header_size <= size and found < len(wanted):
+        frame_header = read(header_size)
+        if len(frame_header) < header_size or frame_header[0] == '\x00':
+            # padding
+            break
+        if version == 2:
+            frame_id = frame_header[:3]
+            frame_size = struct.unpack('>I', '\x00' + frame_header[3:6])[0]
+            frame_flags = 0
+        else:
+            frame_id = frame_header[:4]
+            if version == 3:
+                frame_size = struct.unpack('>I', frame_header[4:8])[0]
+            else:
+                frame_size = syncsafe(frame_header[4:8])
+            frame_flags = struct.unpack('>H', frame_header[8:10])[0]
+        pos += header_size + frame_size
+        if pos > size:
+            raise TagError('Frame ' + repr(frame_id) + ' exceeds tag size')
+        if frame_id not in wanted:
+            skip(frame_size)
+            continue
+        data = read(frame_size)
+        tags[wanted[frame_id]] = decode_text_frame(frame_data(data, version, frame_flags))
+        found += 1
+    return tags
+
+def frame_data(data, version, frame_flags):
+    """
+    Undo compression and unsynchronisation of a single frame.
+
+    data: string, frame content as stored in the file
+    version: int, minor version of the ID3v2 tag
+    frame_flags: int, the frame's format flags
+    """
+    if version == 3:
+        if frame_flags & 0x0040:
+            raise TagError('Encrypted frame')
+        if frame_flags & 0x0020:
+            data = data[1:]
+        if frame_flags & 0x0080:
+            data = zlib.decompress(data[4:])
+    elif version == 4:
+        if frame_flags & 0x0004:
+            raise TagError('Encrypted frame')
+        if frame_flags & 0x0040:
+            data = data[1:]
+        if frame_flags & 0x0001:
+            data = data[4:]
+        if frame_flags & 0x0002:
+            data = unsynchronise(data)
+        if frame_flags & 0x0008:
+            data = zlib.decompress(data)
+    return data
+
+def decode_text_frame(data):
+    """
+    Return the first value of a text frame as unicode.
+
+    data: string, frame content starting with the encoding byte
+    """
+    if not data:
+        return None
+    encoding = ENCODINGS.get(ord(data[0]))
+    if encoding is None:
+        raise TagError('Unknown text encoding ' + str(ord(data[0])))
+    try:
+        text = data[1:].decode(encoding)
+    except UnicodeDecodeError as err:
+        raise TagError(str(err))
+    # ID3v2.4 separates multiple values with null characters
+    return text.split(u'\x00')[0]
+
+def read_id3v1(audio_file):
+    """
+    Read the ID3v1 tag at the end of audio_file.
+
+    audio_file: file object
+    return: dict as returned by read_tags, or None if there is no ID3v1 tag
+    """
+    try:
+        audio_file.seek(-128, 2)
+    except IOError:
+        # file shorter than a tag
+        return None
+    data = audio_file.read(128)
+    if data[:3] != 'TAG':
+        return None
+    fields = {'title': data[3:33], 'artist': data[33:63], 'album': data[63:93]}
+    tags = {}
+    for name, value in fields.iteritems():
+        tags[name] = value.split('\x00')[0].decode('latin-1') or None
+    return tags
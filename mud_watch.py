@@ -0,0 +1,333 @@
+"""
+mud_watch.py - keep the mud database up to date while music files come and go
+
+Changes below the music base dir are picked up with inotify, if pyinotify is
+installed, otherwise by polling the directory tree. New files are fingerprinted
+as soon as they are completely written, deleted and moved files are updated
+in the songfiles table right away.
+"""
+
+import errno
+import logging
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+logger = logging.getLogger('mud.watch')
+
+# seconds a file's size and mtime must stay the same before it is fingerprinted
+DEFAULT_SETTLE_TIME = 5
+# seconds between two walks of the directory tree if inotify is not available
+DEFAULT_POLL_INTERVAL = 60
+
+SONG_FILE_ENDINGS = ('.mp3', '.MP3')
+
+
+def is_song_file(path):
+    """Return True if path looks like a sound file mud cares about"""
+    return path.endswith(SONG_FILE_ENDINGS)
+
+def file_signature(path):
+    """Return (size, mtime, inode) of path, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+def walk_song_files(root_dir):
+    """Yield the paths of all sound files below root_dir"""
+    for root, sub_folders, files in os.walk(root_dir):
+        for filepath in files:
+            if is_song_file(filepath):
+                yield os.path.join(root, filepath)
+
+
+class ChangeQueue(object):
+    """
+    Collect file system changes and hand them out once they have settled.
+
+    Created or modified files are held back until their size and mtime did not
+    change for settle_time seconds, so files that are still being written are
+    not fingerprinted. Deletes are held back as long, so a file that is
+    deleted and created again shortly after (e.g. by a tag editor) is handled
+    as a changed file. Moves are handed out right away.
+
+    A file or directory moved away is a delete, unless the move turns out
+    to stay inside the watched tree. Its pending changes are kept until then,
+    and follow it to its new path.
+
+    Changes are tuples:
+        ('created', path)
+        ('deleted', path, is_dir)
+        ('moved', old_path, new_path, is_dir)
+    """
+
+    def __init__(self, settle_time=DEFAULT_SETTLE_TIME):
+        """
+        settle_time: int, seconds a change must be quiet before it is handed out
+        """
+        self.settle_time = settle_time
+        # path -> [change, due time, file signature]
+        self.pending = {}
+        # path moved away -> {path: entry} of the pending changes it took along
+        self.moved_away = {}
+        self.ready = []
+
+    def created(self, path):
+        """path was created or written to"""
+        self.moved_away.pop(path, None)
+        self.pending[path] = [('created', path), time.time() + self.settle_time,
+                              file_signature(path)]
+
+    def deleted(self, path, is_dir=False):
+        """path was deleted, or moved out of the watched tree"""
+        self.moved_away.pop(path, None)
+        self._take_pending(path, is_dir)
+        self.pending[path] = [('deleted', path, is_dir), time.time() + self.settle_time, None]
+
+    def moved_from(self, path, is_dir=False):
+        """path was moved away, a delete unless moved is called for it"""
+        self.moved_away[path] = self._take_pending(path, is_dir)
+        self.pending[path] = [('deleted', path, is_dir), time.time() + self.settle_time, None]
+
+    def moved(self, old_path, new_path, is_dir=False):
+        """old_path was moved to new_path, inside the watched tree"""
+        entries = self.moved_away.pop(old_path, None)
+        if entries is None:
+            entries = self._take_pending(old_path, is_dir)
+        else:
+            # the delete of moved_from
+            self.pending.pop(old_path, None)
+        entry = entries.pop(old_path, None)
+        if not is_dir and entry and entry[0][0] == 'created':
+            # not settled yet, so not in the database either
+            self.created(new_path)
+            return
+        self.pending.pop(new_path, None)
+        self.ready.append(('moved', old_path, new_path, is_dir))
+        prefix = old_path.rstrip('/') + '/'
+        for pending_path, below in entries.iteritems():
+            below_path = new_path.rstrip('/') + '/' + pending_path[len(prefix):]
+            if below[0][0] == 'created':
+                self.created(below_path)
+            else:
+                # the rows are moved along with the directory first
+                self.pending[below_path] = [('deleted', below_path, below[0][2]), below[1], None]
+
+    def _take_pending(self, path, is_dir):
+        """Remove and return {path: entry} of the pending changes of path and below it"""
+        taken = {}
+        if path in self.pending:
+            taken[path] = self.pending.pop(path)
+        if is_dir:
+            prefix = path.rstrip('/') + '/'
+            for pending_path in [p for p in self.pending if p.startswith(prefix)]:
+                taken[pending_path] = self.pending.pop(pending_path)
+        return taken
+
+    def pop_changes(self):
+        """Return the list of changes that are ready, and forget about them"""
+        now = time.time()
+        for path, entry in self.pending.items():
+            change, due, signature = entry
+            if due > now:
+                continue
+            if change[0] == 'created':
+                current = file_signature(path)
+                if current is None:
+                    # gone again before it settled
+                    del self.pending[path]
+                    continue
+                if current != signature:
+                    entry[1] = now + self.settle_time
+                    entry[2] = current
+                    continue
+            del self.pending[path]
+            if change[0] == 'deleted':
+                self.moved_away.pop(path, None)
+            self.ready.append(change)
+        ready = self.ready
+        self.ready = []
+        return ready
+
+
+class PollingWatcher(object):
+    """
+    Find changes by walking the directory tree every poll_interval seconds
+    and comparing size, mtime and inode of the files with the previous walk.
+    """
+
+    def __init__(self, base_dir, poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        base_dir: string, directory to watch
+        poll_interval: int, seconds between two walks
+        """
+        self.base_dir = base_dir
+        self.poll_interval = poll_interval
+        self.snapshot = self._take_snapshot()
+        self.next_poll = time.time() + poll_interval
+
+    def _take_snapshot(self):
+        """Return {path: (size, mtime, inode)} for all sound files"""
+        snapshot = {}
+        for path in walk_song_files(self.base_dir):
+            signature = file_signature(path)
+            if signature:
+                snapshot[path] = signature
+        return snapshot
+
+    def check(self, queue, timeout):
+        """
+        Wait up to timeout seconds, and put changes into queue if it is time
+        for the next walk.
+
+        queue: ChangeQueue
+        timeout: float, seconds
+        """
+        wait = self.next_poll - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            return
+        self.next_poll = time.time() + self.poll_interval
+        snapshot = self._take_snapshot()
+        gone = {}
+        for path, signature in self.snapshot.iteritems():
+            if path not in snapshot:
+                gone[signature] = path
+        for path, signature in snapshot.iteritems():
+            old_signature = self.snapshot.get(path)
+            if old_signature == signature:
+                continue
+            if old_signature is None and signature in gone:
+                queue.moved(gone.pop(signature), path)
+            else:
+                queue.created(path)
+        for path in gone.itervalues():
+            queue.deleted(path)
+        self.snapshot = snapshot
+
+
+if pyinotify:
+    class _EventHandler(pyinotify.ProcessEvent):
+        """Translate inotify events into ChangeQueue calls"""
+
+        def my_init(self, queue=None):
+            self.queue = queue
+
+        def _created_dir(self, path):
+            # files might have been added before the watch was in place
+            for song_file in walk_song_files(path):
+                self.queue.created(song_file)
+
+        def process_IN_CREATE(self, event):
+            if event.dir:
+                self._created_dir(event.pathname)
+
+        def process_IN_CLOSE_WRITE(self, event):
+            if is_song_file(event.pathname):
+                self.queue.created(event.pathname)
+
+        def process_IN_DELETE(self, event):
+            if event.dir or is_song_file(event.pathname):
+                self.queue.deleted(event.pathname, event.dir)
+
+        def process_IN_MOVED_FROM(self, event):
+            # becomes a move if the matching IN_MOVED_TO shows up
+            if event.dir or is_song_file(event.pathname):
+                self.queue.moved_from(event.pathname, event.dir)
+
+        def process_IN_MOVED_TO(self, event):
+            src_path = getattr(event, 'src_pathname', None)
+            if event.dir:
+                if src_path:
+                    self.queue.moved(src_path, event.pathname, True)
+                else:
+                    self._created_dir(event.pathname)
+            elif src_path and is_song_file(src_path):
+                if is_song_file(event.pathname):
+                    self.queue.moved(src_path, event.pathname)
+                else:
+                    self.queue.deleted(src_path)
+            elif is_song_file(event.pathname):
+                self.queue.created(event.pathname)
+
+
+class InotifyWatcher(object):
+    """Find changes with inotify, watching the whole directory tree"""
+
+    MASK = (pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE |
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO) if pyinotify else 0
+
+    def __init__(self, base_dir, queue):
+        """
+        base_dir: string, directory to watch
+        queue: ChangeQueue, to put changes into
+        """
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager, _EventHandler(queue=queue))
+        self.watch_manager.add_watch(base_dir, self.MASK, rec=True, auto_add=True)
+
+    def check(self, queue, timeout):
+        """
+        Wait up to timeout seconds for events and put them into queue.
+
+        queue: ChangeQueue, the one given to __init__
+        timeout: float, seconds
+        """
+        if self.notifier.check_events(timeout=int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+
+def watch(mud_inst, base_dir, settle_time=DEFAULT_SETTLE_TIME, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Watch base_dir and keep the database of mud_inst up to date, until interrupted.
+
+    First the database is brought up to date with an incremental scan and
+    by fingerprinting all new files, then changes are applied as they come in.
+
+    mud_inst: mud.mud, the primary instance
+    base_dir: string, the music base dir
+    settle_time: int, seconds a new file must stay unchanged before it is fingerprinted
+    poll_interval: int, seconds between two walks if inotify is not available
+    """
+    queue = ChangeQueue(settle_time)
+    if pyinotify:
+        logger.info('Watching ' + base_dir + ' with inotify')
+        watcher = InotifyWatcher(base_dir, queue)
+    else:
+        logger.info('pyinotify not available, polling ' + base_dir +
+                    ' every ' + str(poll_interval) + ' seconds')
+        watcher = PollingWatcher(base_dir, poll_interval)
+    # catch up with whatever happened while nobody was watching
+    mud_inst.scan_files(incremental=True)
+    mud_inst.build_collection()
+    while True:
+        watcher.check(queue, 1)
+        for change in queue.pop_changes():
+            try:
+                apply_change(mud_inst, change)
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                logger.warning('Could not handle ' + repr(change) + ': ' + str(err))
+
+def apply_change(mud_inst, change):
+    """
+    Apply a change as returned by ChangeQueue.pop_changes to the database.
+
+    mud_inst: mud.mud
+    change: tuple, see ChangeQueue
+    """
+    logger.debug('Applying ' + repr(change))
+    if change[0] == 'created':
+        mud_inst.refresh_song_file(change[1].decode('utf-8'))
+    elif change[0] == 'deleted':
+        mud_inst.remove_song_files(change[1].decode('utf-8'), change[2])
+    elif change[0] == 'moved':
+        mud_inst.move_song_files(change[1].decode('utf-8'), change[2].decode('utf-8'), change[3])
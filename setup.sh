@@ -13,6 +13,7 @@ install_dependencies(){
     sudo pip install --allow-external PyAudio --allow-unverified PyAudio PyAudio
     sudo pip install pydub 
     sudo pip install PyDejavu
+    sudo pip install pyinotify
     # configure mariadb
     sudo sed -i '/\[mysqld\]/a  innodb_file_per_table = 1' /etc/my.cnf.d/server.cnf
     sudo systemctl start mariadb
@@ -35,6 +36,32 @@ music_base_dir = '/tmp'
 # localtion and name of the log file
 log_file = 'mud.log'
 
+# number of rows written to the database in one statement when scanning
+insert_batch_size = 1000
+
+# number of directories listed at the same time when scanning. On network
+# storage more threads help, check the directories per second reported by -s
+scan_threads = 8
+
+# number of threads reading mp3 tags while fingerprinting
+tag_threads = 4
+
+# building the collection (-b): seconds a file stays claimed by one mud process,
+# and number of claims after which a file that never got finished is given up
+claim_lease_time = 1800
+max_claim_attempts = 3
+
+# fingerprinting: 'mud' (numpy, faster) or 'dejavu', both produce the same hashes
+fingerprint_engine = 'mud'
+
+# number of files decoded at the same time when sketching (-k)
+sketch_threads = 4
+
+# watch mode (-w): seconds a new file must stay unchanged before it is
+# fingerprinted, and seconds between two scans if inotify is not available
+watch_settle_time = 5
+watch_poll_interval = 60
+
 # dejavu db settings
 dejavu_configs = [
 EOF
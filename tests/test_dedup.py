@@ -0,0 +1,134 @@
+import unittest
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import zlib
+
+from ..dedup import dedup
+
+# module settings changed by the tests, restored after each
+SETTINGS = ['partial_hash_size', 'read_size', 'read_ahead', 'use_mmap', 'mmap_window_size',
+            'jobs', 'jobs_per_device', 'cache', 'algorithm', 'verify', 'simulate']
+
+
+# two strings with the same crc32
+CRC32_COLLISION = ('09685295', '12060020')
+
+
+class testDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict((name, getattr(dedup, name)) for name in SETTINGS)
+        dedup.partial_hash_size = 16
+        dedup.read_size = 8
+        dedup.simulate = False
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if dedup.cache is not None:
+            dedup.cache.close()
+        for name, value in self.settings.items():
+            setattr(dedup, name, value)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_group_by_size(self):
+        """
+        Files are grouped by size in the order given, sizes no other file has are dropped
+        """
+        a = self.write('a', 'abc')
+        b = self.write('b', 'abcd')
+        c = self.write('c', 'xyz')
+        d = self.write('d', 'x')
+        groups = dedup.group_by_size([a, b, c, d, os.path.join(self.tmpdir, 'missing')])
+        self.assertListEqual(groups, [(3, [a, c])])
+
+    def test_split_groups(self):
+        """
+        Files with the same start and end are told apart by their whole content,
+        read into buffers or through mmap
+        """
+        middle = 'm' * 100
+        a = self.write('a', 'start' + middle + 'end')
+        b = self.write('b', 'start' + middle + 'end')
+        c = self.write('c', 'start' + middle[:50] + 'x' + middle[51:] + 'end')
+        d = self.write('d', 'other' + middle + 'end')
+        groups = [(108, [a, b, c, d])]
+        partial = dedup.split_groups(groups, dedup.partial_chunks)
+        self.assertListEqual(partial, [(108, [a, b, c])])
+        self.assertListEqual(dedup.split_groups(partial, dedup.full_chunks), [(108, [a, b])])
+        dedup.use_mmap = True
+        self.assertListEqual(dedup.split_groups(partial, dedup.full_chunks), [(108, [a, b])])
+
+    def test_full_chunks_mmap_windows(self):
+        """
+        Files larger than the mmap window are mapped a window at a time
+        """
+        data = os.urandom(3 * mmap.ALLOCATIONGRANULARITY + 100)
+        path = self.write('a', data)
+        dedup.use_mmap = True
+        dedup.mmap_window_size = mmap.ALLOCATIONGRANULARITY
+        dedup.read_size = 1000
+        checksums = dedup.calculate_checksums([(path, len(data))], dedup.full_chunks)
+        self.assertEqual(checksums[path], hashlib.sha256(data).hexdigest())
+
+    def test_calculate_checksums_threads(self):
+        """
+        Several threads reading and hashing calculate the same checksums,
+        with as few buffers as possible
+        """
+        dedup.jobs = 3
+        dedup.jobs_per_device = 2
+        dedup.read_ahead = 1
+        tasks = []
+        expected = {}
+        for i in range(20):
+            data = os.urandom(i * 37)
+            path = self.write(str(i), data)
+            tasks.append((path, len(data)))
+            expected[path] = hashlib.sha256(data).hexdigest()
+        tasks.append((os.path.join(self.tmpdir, 'missing'), 1))
+        self.assertDictEqual(dedup.calculate_checksums(tasks, dedup.full_chunks), expected)
+        partial = dedup.calculate_checksums(tasks, dedup.partial_chunks)
+        self.assertEqual(partial[tasks[0][0]], hashlib.sha256('').hexdigest())
+        data = open(tasks[10][0], 'rb').read()
+        self.assertEqual(partial[tasks[10][0]], hashlib.sha256(data[:16] + data[-16:]).hexdigest())
+
+    def test_cache(self):
+        """
+        Cached checksums are used until the file changes, even if its size stays the same
+        """
+        dedup.cache = dedup.open_cache(os.path.join(self.tmpdir, 'cache.db'))
+        path = self.write('a', 'abc')
+        self.assertEqual(dedup.calculate_checksums([(path, 3)], dedup.full_chunks)[path],
+                         hashlib.sha256('abc').hexdigest())
+        dedup.cache.execute("UPDATE checksums SET checksum = 'cached'")
+        self.assertEqual(dedup.calculate_checksums([(path, 3)], dedup.full_chunks)[path], 'cached')
+        # partial checksums are cached apart from full ones
+        self.assertEqual(dedup.calculate_checksums([(path, 3)], dedup.partial_chunks)[path],
+                         hashlib.sha256('abc').hexdigest())
+        self.write('a', 'xyz')
+        mtime = os.stat(path).st_mtime
+        os.utime(path, (mtime + 10, mtime + 10))
+        self.assertEqual(dedup.calculate_checksums([(path, 3)], dedup.full_chunks)[path],
+                         hashlib.sha256('xyz').hexdigest())
+
+    def test_verify_crc32_collision(self):
+        """
+        Files with the same crc32 are only duplicates if they have the same content
+        """
+        data1, data2 = CRC32_COLLISION
+        self.assertEqual(zlib.crc32(data1), zlib.crc32(data2))
+        a = self.write('a', data1)
+        b = self.write('b', data2)
+        c = self.write('c', data1)
+        self.assertListEqual(dedup.verify_groups([(8, [a, b, c])]), [(8, [a, c])])
+        dedup.algorithm = 'crc32'
+        self.assertListEqual(dedup.get_duplicates([a, b, c]), [c])
@@ -2,6 +2,7 @@ import unittest
 import os
 import sys
 import subprocess
+import threading
 import time
 import mock
 import warnings
@@ -121,14 +122,16 @@ class testMud(unittest.TestCase):
         subprocess.call(['rm', '-rf', self.music_base_dir])
         db_teardown()
 
-    @mock.patch('mud.mud.mud.add_song_file', gp_mock.add_song_file )
-    def test_scan_files(self):
+    @mock.patch('mud.mud.mud.add_song_files')
+    def test_scan_files(self, add_song_files):
         """
         Files in testdir scanned correctly
         """
+        scanned = []
+        add_song_files.side_effect = scanned.extend
         self.mud.scan_files()
-        for f in [g for g in self.files if g.endswith('.mp3') ]:
-            self.gp_mock.add_song_file.assert_any_call(self.music_base_dir + f)
+        self.assertListEqual(sorted(path for path, stat in scanned),
+            sorted(self.music_base_dir + f for f in self.files if f.endswith('.mp3')))
 
     def test_insertfiles(self):
         """
@@ -147,6 +150,78 @@ class testMud(unittest.TestCase):
         self.assertListEqual(sorted(new_files), sorted(self.files))
 
 
+    def test_insert_songfiles(self):
+        """
+        Files are inserted in batches, existing files are skipped
+        """
+        rows = [(f, None, None, None) for f in self.files]
+        self.assertEqual(self.mud.db.insert_songfiles(rows[:2], batch_size=3), 2)
+        self.assertEqual(self.mud.db.insert_songfiles(iter(rows), batch_size=3), len(self.files) - 2)
+        self.assertListEqual(sorted(self.mud.list_new_files()), sorted(self.files))
+
+    def test_claim_song_files(self):
+        """
+        Claimed files are handed out once, released files again, and files
+        claimed too often are marked as poison
+        """
+        for f in self.files:
+            self.mud.add_song_file(f)
+        claimed = self.mud.db.claim_song_files('host:1', 2, max_attempts=2)
+        self.assertEqual(len(claimed), 2)
+        others = self.mud.db.claim_song_files('host:2', 10, max_attempts=2)
+        self.assertListEqual(sorted(claimed + others), sorted(self.files))
+        self.mud.db.release_song_files('host:2')
+        self.assertListEqual(sorted(self.mud.db.claim_song_files('host:2', 10, max_attempts=2)), sorted(others))
+        self.assertListEqual(self.mud.db.select_claim_workers(), ['host:1', 'host:2'])
+        self.mud.db.expire_claims('host:1')
+        self.assertListEqual(sorted(self.mud.db.claim_song_files('host:3', 10, max_attempts=2)), sorted(claimed))
+        self.mud.db.expire_claims('host:3')
+        self.assertListEqual(self.mud.db.claim_song_files('host:3', 10, max_attempts=2), [])
+        self.assertEqual(self.mud.db.park_poison_files(max_attempts=2), 2)
+        self.assertEqual(self.mud.db.select_num_errors('PoisonFile'), 2)
+
+    def test_build_collection_parallel_crash(self):
+        """
+        A file killing its worker is handed out again, then marked as
+        WorkerCrashed, while the other files get their song ids
+        """
+        self.mud.scan_files()
+        crashing_file = self.music_base_dir + '/foo/bar/file2.mp3'
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'DEADBEEF', [])
+
+        def fake_fingerprint_files(num, inst_num, task_queue, result_queue):
+            result_queue.put((num, None, None))
+            while True:
+                song_file = task_queue.get()
+                if song_file is None:
+                    break
+                if song_file == crashing_file:
+                    os._exit(1)
+                result_queue.put((num, song_file, song_id))
+        with mock.patch('mud.mud.fingerprint_files', fake_fingerprint_files):
+            self.mud.build_collection(jobs=2)
+        self.assertEqual(self.mud.db.select_num_errors('WorkerCrashed'), 1)
+        for song_file in ['/foo/file1.mp3', '/foo/baz/file3.mp3']:
+            row = self.mud.db.select_file_stats_by_path(self.music_base_dir + song_file)
+            self.assertEqual(row['song_id'], song_id)
+
+    @mock.patch('mud.mud.mud.get_song_id')
+    def test_build_collection_poison(self, get_song_id):
+        """
+        A file making build_collection raise keeps its attempts and is
+        marked as poison, instead of stopping every later run
+        """
+        self.mud.scan_files()
+        get_song_id.side_effect = ValueError('broken')
+        for i in range(mud.DEFAULT_MAX_CLAIM_ATTEMPTS):
+            with self.assertRaises(ValueError):
+                self.mud.build_collection()
+        get_song_id.side_effect = None
+        get_song_id.return_value = mud.ERROR_CODES['CouldntDecodeError']
+        self.mud.build_collection()
+        self.assertEqual(get_song_id.call_count, mud.DEFAULT_MAX_CLAIM_ATTEMPTS + 2)
+        self.assertEqual(self.mud.db.select_num_errors('PoisonFile'), 1)
+
     @unittest.skipIf(SKIP_LONG_TESTS, 'Tested successfully, runs very long')
     def test_get_song_id(self):
         """
@@ -167,12 +242,37 @@ class testMud(unittest.TestCase):
         sid = self.mud.get_song_id(emty_file)
         self.assertEqual(sid, -1)
 
-    def fake_fingerprint(junk1, junk2 ):
-        pass
-    def fake_recognize(junk1, junk2, junk3):
+    def test_insert_fingerprinted_song(self):
+        """
+        Fingerprints are stored with their hash, song id and offset in the right columns
+        """
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'DEADBEEF', [('0123456789abcdef0123', 42)])
+        with self.mud.db.cursor() as cur:
+            cur.execute('SELECT HEX(hash), song_id, offset FROM fingerprints')
+            rows = list(cur)
+        self.assertListEqual(rows, [('0123456789ABCDEF0123', song_id, 42)])
+
+    def test_insert_fingerprinted_song_store(self):
+        """
+        Fingerprints in a segment store are published only once the song is committed
+        """
+        store = mock.Mock()
+        store.prepare.return_value = 'pending'
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'deadbeef', [('0123456789abcdef0123', 42)], store)
+        store.prepare.assert_called_once_with(song_id, [('0123456789abcdef0123', 42)], 'DEADBEEF')
+        store.publish.assert_called_once_with('pending')
+        self.assertDictEqual(self.mud.db.select_song_hashes(), {song_id: 'DEADBEEF'})
+        store.reset_mock()
+        with mock.patch.object(self.mud.db, 'UPDATE_SONG_FINGERPRINTED', 'NOT SQL'):
+            with self.assertRaises(Exception):
+                self.mud.db.insert_fingerprinted_song('other', 'beef', [('0123456789abcdef0123', 42)], store)
+        store.discard.assert_called_once_with('pending')
+        self.assertFalse(store.publish.called)
+        self.assertDictEqual(self.mud.db.select_song_hashes(), {song_id: 'DEADBEEF'})
+
+    def fake_fingerprint_and_recognize(junk1, junk2, junk3=None):
         return None
-    @mock.patch('dejavu.Dejavu.fingerprint_file', fake_fingerprint)
-    @mock.patch('dejavu.Dejavu.recognize', fake_recognize)
+    @mock.patch('mud.mud.mud.fingerprint_and_recognize', fake_fingerprint_and_recognize)
     def test_get_song_id_None(self):
         """
         Song object of none is handled
@@ -181,7 +281,84 @@ class testMud(unittest.TestCase):
         sid = self.mud.get_song_id(emty_file)
         self.assertEqual(sid, -2)
 
+    def test_get_song_id_decodes_once(self):
+        """
+        Song file is decoded only once for fingerprinting and recognizing
+        """
+        import numpy
+        emty_file = self.music_base_dir + self.files[0]
+        with mock.patch('mud.mud_decoder.read') as read:
+            read.return_value = ([numpy.zeros(44100, numpy.int16)], 44100, 'DEADBEEF')
+            self.mud.get_song_id(emty_file)
+            read.assert_called_once_with(emty_file, self.mud.djv.limit, 0)
+
+    def test_trim_decoded(self):
+        """
+        Audio decoded for a higher fingerprint_limit is reused, cut to the instance's limit
+        """
+        import numpy
+        other = mock.Mock(fingerprint_start=0, djv=mock.Mock(limit=30))
+        self.mud.djv.limit = 10
+        self.assertTrue(self.mud.reuses(other))
+        windows, fs, file_hash = self.mud.trim_decoded(([(0, [numpy.zeros(30 * 100, numpy.int16)])], 100, 'DEADBEEF'))
+        self.assertEqual(len(windows[0][1][0]), 10 * 100)
+        other.djv.limit = 5
+        self.assertFalse(self.mud.reuses(other))
+        other.djv.limit = [(5, 0.5)]
+        self.assertFalse(self.mud.reuses(other))
+
+    @mock.patch('mud.mud.get_tags', mock.Mock(return_value=('artist', 'title', 'album')))
+    def test_run_tiers(self):
+        """
+        Groups are split by what the next instance recognizes, audio is decoded
+        once per file, and files with a song id are not fingerprinted again
+        """
+        import numpy
+        files = [self.music_base_dir + f for f in self.files[:3]]
+        self.mud.scan_files()
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'AA', [])
+        for song_file in files:
+            self.mud.db.update_songfile(song_file, song_id, 'artist', 'title', 'album')
+        songs = {}
+        calls = []
+        def fake_fingerprint_and_recognize(inst, song_file, decoded=None):
+            calls.append((song_file, decoded))
+            name = 'b' if song_file == files[2] else 'a'
+            if name not in songs:
+                songs[name] = inst.db.insert_fingerprinted_song(name, name.upper() * 2, [])
+            return {'song_id': songs[name]}
+        decoded = ([(0, [numpy.zeros(100, numpy.int16)])], 10, 'DEADBEEF')
+        with mock.patch('mud.mud.mud.fingerprint_and_recognize', fake_fingerprint_and_recognize):
+            with mock.patch('mud.mud.mud.decode', mock.Mock(return_value=decoded)) as decode:
+                self.assertListEqual(mud.run_tiers(self.mud), [1])
+                self.assertEqual(decode.call_count, 3)
+                self.assertItemsEqual([song_file for song_file, audio in calls], files)
+                self.assertNotIn(None, [audio for song_file, audio in calls])
+                tier = mud.mud(1)
+                self.assertListEqual([tier.db.select_file_stats_by_path(song_file)['song_id'] for song_file in files],
+                                     [songs['a'], songs['a'], songs['b']])
+                # an interrupted run starts again where it stopped
+                self.assertListEqual(mud.run_tiers(self.mud), [1])
+                self.assertEqual(len(calls), 3)
+
+    def test_tier_song_id_claimed(self):
+        """
+        A file another process claimed is not fingerprinted again, its song id is waited for
+        """
+        tier = mud.mud(1)
+        song_file = self.music_base_dir + self.files[0]
+        tier.add_song_file(song_file.decode('utf-8'))
+        self.assertListEqual(tier.db.claim_song_files('other', 1), [song_file])
+        song_id = tier.db.insert_fingerprinted_song('song', 'AA', [])
+        def other_finishes(seconds):
+            tier.db.update_songfile(song_file, song_id, 'artist', 'title', 'album')
+        with mock.patch('mud.mud.time.sleep', other_finishes):
+            with mock.patch('mud.mud.mud.get_song_id') as get_song_id:
+                self.assertEqual(tier.tier_song_id(song_file, tier, {}), song_id)
+        self.assertFalse(get_song_id.called)
+
     @mock.patch('eyed3.load', gp_mock.fake_load)
+    @mock.patch('mud.mud_tags.read_tags', mock.Mock(side_effect=ValueError))
     def test_update_songfile(self):
         """
         Song ID updated correctly
@@ -206,16 +383,98 @@ class testMud(unittest.TestCase):
         self.assertTrue(len(dups) > 0)
 
 
-    @mock.patch('mud.mud.MudDatabase.delete_song_file', gp_mock.delete_song_file )
-    def test_check_files(self):
+    def test_yield_duplicates(self):
+        """
+        Only song ids with more than one file are yielded, with all their files
+        """
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'DEADBEEF', [])
+        other_song_id = self.mud.db.insert_fingerprinted_song('other song', 'BEEFDEAD', [])
+        for f in self.files:
+            self.mud.add_song_file(f)
+        self.mud.db.update_songfile(self.files[0], song_id, '', '', '')
+        self.mud.db.update_songfile(self.files[1], song_id, '', '', '')
+        self.mud.db.update_songfile(self.files[2], other_song_id, '', '', '')
+        dups = list(self.mud.yield_duplicates())
+        self.assertEqual(len(dups), 1)
+        self.assertListEqual(sorted(f['file_path'] for f in dups[0]), sorted(self.files[:2]))
+
+    def test_yield_duplicates_paged(self):
+        """
+        Paged and resumed duplicates are the same as in one go, and counted in the database
+        """
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'DEADBEEF', [])
+        other_song_id = self.mud.db.insert_fingerprinted_song('other song', 'BEEFDEAD', [])
+        for f in self.files:
+            self.mud.add_song_file(f)
+        for f, sid in zip(self.files, [song_id, song_id, other_song_id, other_song_id]):
+            self.mud.db.update_songfile(f, sid, '', '', '')
+        dups = list(self.mud.yield_duplicates())
+        self.assertEqual(len(dups), 2)
+        self.assertEqual(self.mud.count_duplicates(), 2)
+        self.assertListEqual(list(self.mud.yield_duplicates(page_size=1)), dups)
+        token = mud.duplicates_resume_token(dups[0])
+        self.assertListEqual(list(self.mud.yield_duplicates(resume_token=token)), dups[1:])
+
+    def test_scan_files_incremental(self):
+        """
+        Incremental scan adds new files, resets changed ones and keeps moved ones
+        """
+        changed_file = self.music_base_dir + self.files[0]
+        moved_file = self.music_base_dir + self.files[1]
+        new_path = self.music_base_dir + '/foo/baz/moved.mp3'
+        self.mud.scan_files()
+        song_id = self.mud.db.insert_fingerprinted_song('song', 'DEADBEEF', [])
+        self.mud.db.update_songfile(changed_file, song_id, '', '', '')
+        self.mud.db.update_songfile(moved_file, song_id, '', '', '')
+        with open(changed_file, 'w') as f:
+            f.write('changed')
+        os.rename(moved_file, new_path)
+        open(self.music_base_dir + '/foo/new.mp3', 'w').close()
+        self.mud.scan_files(incremental=True)
+        paths = [row['file_path'] for row in self.mud.db.select_all_song_files()]
+        self.assertIn(self.music_base_dir + '/foo/new.mp3', paths)
+        self.assertIn(new_path, paths)
+        self.assertNotIn(moved_file, paths)
+        new_files = list(self.mud.list_new_files())
+        self.assertIn(changed_file, new_files)
+        self.assertNotIn(new_path, new_files)
+
+    def test_scan_files_incremental_unchanged_dirs(self):
+        """
+        Only directories changed since the last incremental scan are listed,
+        removed directories are forgotten
+        """
+        past = time.time() - 100
+        for d in ['', '/foo'] + self.dirs:
+            os.utime(self.music_base_dir + d, (past, past))
+        self.mud.scan_files(incremental=True)
+        open(self.music_base_dir + '/foo/bar/new.mp3', 'w').close()
+        subprocess.call(['rm', '-rf', self.music_base_dir + '/foo/baz'])
+        listed = []
+        list_dir = mud.mud_scanner.ParallelScanner._list_dir
+
+        def record_list_dir(scanner, path):
+            listed.append(path)
+            list_dir(scanner, path)
+        with mock.patch('mud.mud_scanner.ParallelScanner._list_dir', record_list_dir):
+            self.mud.scan_files(incremental=True)
+        self.assertListEqual(sorted(listed), [self.music_base_dir + '/foo', self.music_base_dir + '/foo/bar'])
+        paths = [row['file_path'] for row in self.mud.db.select_all_song_files()]
+        self.assertIn(self.music_base_dir + '/foo/bar/new.mp3', paths)
+        dirs = sorted(row['dir_path'] for row in self.mud.db.select_song_dirs())
+        self.assertListEqual(dirs, [self.music_base_dir, self.music_base_dir + '/foo', self.music_base_dir + '/foo/bar'])
+
+    @mock.patch('mud.mud.MudDatabase.delete_song_files')
+    def test_check_files(self, delete_song_files):
         """
         Files no longer present are deleted from database
         """
         test_file = self.music_base_dir + self.files[0]
         self.mud.scan_files()
+        file_id = self.mud.db.select_file_stats_by_path(test_file)['file_id']
         os.remove(test_file)
         self.mud.check_files()
-        self.gp_mock.delete_song_file.assert_called_once_with(test_file)
+        delete_song_files.assert_called_once_with([file_id])
         # create file again
         open(test_file, 'w').close()
 
@@ -233,3 +492,36 @@ class testMud(unittest.TestCase):
         # create file again and add to database
         open(test_file, 'w').close()
         self.mud.scan_files()
+
+
+class testPrefetch(unittest.TestCase):
+
+    def test_prefetch(self):
+        """
+        All rows are yielded in order, errors of the reading thread are raised
+        """
+        self.assertListEqual(list(mud.prefetch(iter(range(10)), 3, max_batches=1)), range(10))
+
+        def broken_rows():
+            yield 1
+            raise ValueError('broken')
+        with self.assertRaises(ValueError):
+            list(mud.prefetch(broken_rows(), 3))
+
+    def test_prefetch_closed(self):
+        """
+        Closing the rows early stops the reading thread and closes the source
+        """
+        closed = []
+        def source_rows():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                closed.append(True)
+        num_threads = threading.active_count()
+        rows = mud.prefetch(source_rows(), 3, max_batches=1)
+        self.assertListEqual([next(rows) for i in range(4)], range(4))
+        rows.close()
+        self.assertListEqual(closed, [True])
+        self.assertEqual(threading.active_count(), num_threads)
@@ -0,0 +1,49 @@
+import unittest
+import io
+import struct
+import numpy as np
+from pydub.exceptions import CouldntDecodeError
+
+from .. import mud_decoder
+
+
+def wav_stream(samples, channels=2, fs=44100):
+    """A WAV file as ffmpeg writes it to a pipe, with a LIST chunk and unknown sizes"""
+    return io.BytesIO(
+        'RIFF' + struct.pack('<I', 0xffffffff) + 'WAVE' +
+        'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, fs, fs * channels * 2, channels * 2, 16) +
+        'LIST' + struct.pack('<I', 3) + 'abc\x00' +
+        'data' + struct.pack('<I', 0xffffffff) + samples.astype('<i2').tostring())
+
+
+class testDecoder(unittest.TestCase):
+
+    def test_read_wav_header(self):
+        """
+        Channels and sample rate are read, the stream is left at the first sample
+        """
+        stream = wav_stream(np.array([7, 8], np.int16), channels=1, fs=22050)
+        self.assertEqual(mud_decoder.read_wav_header(stream), (1, 22050))
+        self.assertListEqual(mud_decoder.read_all_samples(stream).tolist(), [7, 8])
+
+    def test_read_wav_header_error(self):
+        with self.assertRaises(CouldntDecodeError):
+            mud_decoder.read_wav_header(io.BytesIO('ID3\x03'))
+
+    def test_read_samples(self):
+        """
+        No more than count samples are read, less if the stream ends before
+        """
+        stream = wav_stream(np.arange(10, dtype=np.int16))
+        mud_decoder.read_wav_header(stream)
+        self.assertListEqual(mud_decoder.read_samples(stream, 4).tolist(), [0, 1, 2, 3])
+        self.assertListEqual(mud_decoder.read_samples(stream, 10).tolist(), [4, 5, 6, 7, 8, 9])
+
+    def test_window_starts(self):
+        """
+        Windows start at multiples of step and are moved to fit into the file
+        """
+        self.assertListEqual(mud_decoder.window_starts([(5, 0.2), (5, 0.5), (5, 0.99)], 100., 100, 16),
+                             [2000, 5008, 9488])
+        # longer than the file
+        self.assertListEqual(mud_decoder.window_starts([(5, 0.5)], 3., 100), [0])
@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+from dejavu import fingerprint
+from scipy.ndimage.filters import maximum_filter
+from scipy.ndimage.morphology import generate_binary_structure, iterate_structure
+
+from .. import mud_fingerprint
+
+
+def test_signal(seconds, fs=44100):
+    """Two tones and noise, as 16 bit samples"""
+    random = np.random.RandomState(0)
+    t = np.arange(seconds * fs) / float(fs)
+    signal = np.sin(2 * np.pi * 440 * t) + 0.5 * np.sin(2 * np.pi * 1234 * t * (1 + t / 100))
+    return (3000 * signal + random.normal(0, 1000, len(t))).astype(np.int16)
+
+
+class testFingerprint(unittest.TestCase):
+
+    def test_same_hashes_as_dejavu(self):
+        """
+        Hashes and offsets are the ones of dejavu, in the same order
+        """
+        samples = test_signal(10)
+        expected = [(h, int(offset)) for h, offset in fingerprint.fingerprint(samples, Fs=44100)]
+        self.assertTrue(len(expected) > 0)
+        self.assertListEqual(mud_fingerprint.fingerprint(samples, Fs=44100), expected)
+
+    def test_short_signal(self):
+        """
+        Signals shorter than a window are padded like specgram does
+        """
+        samples = test_signal(0.01)
+        expected = [(h, int(offset)) for h, offset in fingerprint.fingerprint(samples, Fs=44100)]
+        self.assertListEqual(mud_fingerprint.fingerprint(samples, Fs=44100), expected)
+
+    def test_grow(self):
+        """
+        Growing the cross is the maximum filter with dejavu's footprint
+        """
+        arr2D = np.random.RandomState(1).normal(size=(60, 80))
+        neighborhood = iterate_structure(generate_binary_structure(2, 1), 7)
+        np.testing.assert_array_equal(mud_fingerprint.grow(arr2D, 7, np.maximum),
+                                      maximum_filter(arr2D, footprint=neighborhood))
+
+    def test_no_peaks(self):
+        self.assertListEqual(mud_fingerprint.fingerprint(np.zeros(44100, np.int16)), [])
@@ -0,0 +1,103 @@
+import unittest
+import binascii
+import mock
+
+from .. import mud_index
+
+
+def fingerprint_rows(song_id, hashes):
+    """Rows as read from the database, for (hex hash, offset) tuples"""
+    return [(binascii.unhexlify(h), song_id, offset) for h, offset in hashes]
+
+
+class testFingerprints(unittest.TestCase):
+
+    def test_lookup(self):
+        """
+        All rows of every hash are found, sorted or merged
+        """
+        rows = fingerprint_rows(1, [('aa' * 10, 5), ('bb' * 10, 7), ('aa' * 10, 9)])
+        rows += fingerprint_rows(2, [('aa' * 10, 3), ('cc' * 10, 1)])
+        all_at_once = mud_index.Fingerprints.from_rows(rows)
+        merged = mud_index.Fingerprints.from_rows(rows[:2]).merge(
+            mud_index.Fingerprints.from_rows(rows[2:]))
+        query = mud_index.np.array([binascii.unhexlify('aa' * 10), binascii.unhexlify('dd' * 10)],
+                                   mud_index.HASH_DTYPE)
+        for fingerprints in (all_at_once, merged):
+            self.assertEqual(len(fingerprints), 5)
+            query_index, song_ids, offsets = fingerprints.lookup(query)
+            self.assertListEqual(sorted(zip(query_index.tolist(), song_ids.tolist(), offsets.tolist())),
+                                 [(0, 1, 5), (0, 1, 9), (0, 2, 3)])
+
+
+class testFingerprintIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.songs = {
+            1: [('aa' * 10, 5), ('bb' * 10, 7)],
+            2: [('aa' * 10, 3), ('cc' * 10, 1)],
+            }
+        self.db = mock.Mock()
+        self.db.select_fingerprinted_song_ids.side_effect = self.song_ids
+        self.db.select_fingerprints.side_effect = self.fingerprints
+        self.index = mud_index.FingerprintIndex(self.db, max_delta=3)
+
+    def song_ids(self, after_song_id=0, song_ids=None):
+        return sorted(song_id for song_id in self.songs
+                      if song_id > after_song_id or song_id in (song_ids or []))
+
+    def fingerprints(self, max_song_id=None, song_ids=None):
+        rows = []
+        for song_id, hashes in sorted(self.songs.items()):
+            if (song_ids is None and song_id <= max_song_id) or (song_ids and song_id in song_ids):
+                rows += fingerprint_rows(song_id, hashes)
+        return rows
+
+    def test_return_matches(self):
+        """
+        Matches are returned like dejavu does, the last offset of a hash counts
+        """
+        matches = self.index.return_matches([('AA' * 10, 0), ('aa' * 10, 1), ('bb' * 10, 2)])
+        self.assertListEqual(sorted(matches), [(1, 4), (1, 5), (2, 2)])
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.nbytes, 4 * 18)
+
+    def test_new_songs(self):
+        """
+        Songs of this and other processes are found after they are fingerprinted
+        """
+        self.index.load()
+        self.index.add(3, [('dd' * 10, 10)])
+        self.songs[4] = [('dd' * 10, 20), ('ee' * 10, 0)]
+        matches = self.index.return_matches([('dd' * 10, 0)])
+        self.assertListEqual(sorted(matches), [(3, 10), (4, 20)])
+        # the delta has been merged into the main arrays
+        self.assertEqual(len(self.index.main), 7)
+        self.db.select_fingerprints.assert_called_with(song_ids=[4])
+
+    def test_update_new_songs_only(self):
+        """
+        Lookups only fetch songs above the highest song id in the index,
+        and songs with a lower id committed late
+        """
+        fetched = []
+
+        def song_ids(*args):
+            song_ids = self.song_ids(*args)
+            fetched.extend(song_ids)
+            return song_ids
+        self.db.select_fingerprinted_song_ids.side_effect = song_ids
+        self.index.load()
+        self.index.add(3, [('dd' * 10, 10)])
+        self.songs[3] = [('dd' * 10, 10)]
+        # song 4 is still being inserted by another process when 5 is there
+        self.songs[5] = [('ee' * 10, 30)]
+        self.assertListEqual(self.index.return_matches([('ee' * 10, 0)]), [(5, 30)])
+        self.songs[4] = [('ee' * 10, 20)]
+        self.assertListEqual(sorted(self.index.return_matches([('ee' * 10, 0)])), [(4, 20), (5, 30)])
+        self.assertEqual(self.index.pending_song_ids, {})
+        del fetched[:]
+        for i in range(10):
+            self.index.return_matches([('aa' * 10, 0)])
+        self.assertListEqual(fetched, [])
+        self.assertEqual(self.db.select_fingerprints.call_count, 3)
@@ -0,0 +1,67 @@
+import unittest
+import os
+import subprocess
+
+import mock
+
+from .. import mud_scanner
+
+
+class testParallelScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.music_base_dir = '/tmp/mud_scanner'
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+        self.dirs = ['/foo/bar', '/foo/baz', '/qux']
+        self.files = ['/foo/file1.mp3', '/foo/bar/file2.mp3', '/foo/baz/file3.mp3', '/foo/baz/file3.mp4']
+        for d in self.dirs:
+            os.makedirs(self.music_base_dir + d)
+        for f in self.files:
+            open(self.music_base_dir + f, 'w').close()
+        os.symlink(self.music_base_dir + '/foo', self.music_base_dir + '/qux/link.mp3')
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+
+    def test_scan(self):
+        """
+        All matching files are found once, with their stat
+        """
+        scanner = mud_scanner.ParallelScanner(self.music_base_dir, ('.mp3',), threads=3)
+        found = list(scanner)
+        self.assertListEqual(sorted(path for path, stat in found),
+            sorted(self.music_base_dir + f for f in self.files if f.endswith('.mp3')))
+        for path, stat in found:
+            self.assertEqual(stat.st_ino, os.stat(path).st_ino)
+        self.assertEqual(scanner.num_dirs, 5)
+        self.assertEqual(scanner.num_files, 3)
+
+    def test_scan_known_dirs(self):
+        """
+        Directories with the mtime they were listed with are not listed
+        again, their known subdirectories are
+        """
+        foo = self.music_base_dir + '/foo'
+        known_dirs = {
+            foo: (os.stat(foo).st_mtime, [foo + '/bar', foo + '/baz']),
+            foo + '/bar': (0, []),
+            }
+        scanner = mud_scanner.ParallelScanner(self.music_base_dir, ('.mp3',), threads=3, known_dirs=known_dirs)
+        found = sorted(path for path, stat in scanner)
+        self.assertListEqual(found, [foo + '/bar/file2.mp3', foo + '/baz/file3.mp3'])
+        self.assertSetEqual(scanner.unchanged_dirs, set([foo]))
+        self.assertEqual(len(scanner.dirs), 5)
+
+    def test_scan_error(self):
+        """
+        Unexpected errors while listing a directory are raised by the scan
+        """
+        list_dir = mud_scanner.ParallelScanner._list_dir
+        def fake_list_dir(scanner, path):
+            if path.endswith('/baz'):
+                raise UnicodeDecodeError('utf8', '', 0, 1, 'invalid')
+            list_dir(scanner, path)
+        scanner = mud_scanner.ParallelScanner(self.music_base_dir, ('.mp3',), threads=3)
+        with mock.patch.object(mud_scanner.ParallelScanner, '_list_dir', fake_list_dir):
+            with self.assertRaises(UnicodeDecodeError):
+                list(scanner)
@@ -0,0 +1,110 @@
+import unittest
+import hashlib
+import os
+import shutil
+import tempfile
+
+from .. import mud_segments
+
+
+def song_hashes(song_num, count=100):
+    """(hash, offset) tuples as returned by dejavu.fingerprint.fingerprint"""
+    return [(hashlib.sha1(str(i % 37)).hexdigest()[:20], song_num * 1000 + i) for i in range(count)]
+
+
+class testSegmentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = mud_segments.SegmentStore(self.path, fanout=2, merge=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def expected_matches(self, songs, query):
+        """What SQLDatabase.return_matches would return"""
+        mapper = dict(query)
+        return sorted((song_id, offset - mapper[h])
+                      for song_id, hashes in songs.items() for h, offset in hashes if h in mapper)
+
+    def test_return_matches(self):
+        """
+        Fingerprints are found in all segments, before and after merging
+        """
+        songs = {}
+        for song_id in range(1, 6):
+            songs[song_id] = song_hashes(song_id)
+            self.store.add(song_id, songs[song_id])
+        query = [(hashlib.sha1(str(i)).hexdigest()[:20], i) for i in range(3)]
+        self.assertListEqual(sorted(self.store.return_matches(query)), self.expected_matches(songs, query))
+        self.assertEqual(len(self.store.segments), 5)
+        self.store.merge()
+        self.assertListEqual(mud_segments.SegmentStore(self.path).read_manifest(), ['000000000006.seg'])
+        self.assertListEqual(sorted(self.store.return_matches(query)), self.expected_matches(songs, query))
+        self.assertEqual(len(self.store), 500)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, '000000000006.seg')),
+                         mud_segments.HEADER_SIZE + 500 * mud_segments.RECORD_SIZE)
+
+    def test_other_process(self):
+        """
+        Segments added and merged by another store on the same directory are picked up
+        """
+        other = mud_segments.SegmentStore(self.path, fanout=2, merge=False)
+        query = [(song_hashes(1)[0][0], 0)]
+        self.assertListEqual(self.store.return_matches(query), [])
+        other.add(1, song_hashes(1))
+        other.add(2, song_hashes(2))
+        self.assertEqual(len(self.store.return_matches(query)), 6)
+        other.merge()
+        self.assertEqual(len(self.store.return_matches(query)), 6)
+        self.assertEqual(len(self.store.segments), 1)
+
+    def test_prepare_publish(self):
+        """
+        Prepared fingerprints are found only once published, discarded ones never
+        """
+        query = [(song_hashes(1)[0][0], 0)]
+        pending_path = self.store.prepare(1, song_hashes(1), 'AB')
+        self.assertListEqual(self.store.return_matches(query), [])
+        self.store.publish(pending_path)
+        self.assertEqual(len(self.store.return_matches(query)), 3)
+        pending_path = self.store.prepare(2, song_hashes(2), 'CD')
+        self.store.discard(pending_path)
+        self.assertFalse(os.path.exists(pending_path))
+        self.assertEqual(len(self.store.return_matches(query)), 3)
+        self.assertListEqual(self.store.read_manifest(), ['000000000001.seg'])
+
+    def test_merge_drops_missing_songs(self):
+        """
+        Merging drops the fingerprints of songs that are not in the database
+        """
+        songs = {1: 'AB', 3: 'EF'}
+        store = mud_segments.SegmentStore(self.path, fanout=2, merge=False, songs=lambda: songs)
+        for song_id in range(1, 4):
+            store.add(song_id, song_hashes(song_id))
+        store.merge()
+        self.assertEqual(len(store), 200)
+        query = [(song_hashes(1)[0][0], 0)]
+        self.assertListEqual(sorted(set(song_id for song_id, diff in store.return_matches(query))), [1, 3])
+
+    def test_recover_pending(self):
+        """
+        Pending segments of dead processes are published if their song was committed
+        """
+        songs = {1: 'AB', 2: 'CD'}
+        store = mud_segments.SegmentStore(self.path, fanout=2, merge=False, songs=lambda: songs)
+        for song_id, key in ((1, 'AB'), (2, 'XX'), (3, 'EF')):
+            pending_path = store.prepare(song_id, song_hashes(song_id), key)
+            os.rename(pending_path, os.path.join(self.path, '999999.' + str(song_id) + '.' +
+                                                 str(song_id) + '.' + key + mud_segments.PENDING_SUFFIX))
+        store.merge()
+        self.assertListEqual([name for name in os.listdir(self.path)
+                              if name.endswith(mud_segments.PENDING_SUFFIX)], [])
+        self.assertEqual(len(store), 100)
+        query = [(song_hashes(1)[0][0], 0)]
+        self.assertListEqual(sorted(set(song_id for song_id, diff in store.return_matches(query))), [1])
+
+    def test_segment_level(self):
+        self.assertEqual(mud_segments.segment_level(0), 0)
+        self.assertEqual(mud_segments.segment_level(mud_segments.LEVEL_SIZE), 1)
+        self.assertEqual(mud_segments.segment_level(mud_segments.LEVEL_SIZE * 8, fanout=8), 2)
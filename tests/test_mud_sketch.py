@@ -0,0 +1,139 @@
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+from .. import mud_sketch
+
+# MPEG 1 layer III, 128 kbit/s, 44100 Hz, stereo: 417 bytes per frame
+FRAME_HEADER = '\xff\xfb\x90\x00'
+FRAME_LENGTH = 417
+
+
+def song(seed, seconds=20, fs=mud_sketch.SKETCH_FS):
+    """A few tones changing every quarter of a second"""
+    random = np.random.RandomState(seed)
+    t = np.arange(int(0.25 * fs)) / float(fs)
+    notes = []
+    for i in range(seconds * 4):
+        freqs = random.uniform(mud_sketch.MIN_FREQ, mud_sketch.MAX_FREQ, 3)
+        notes.append(sum(np.sin(2 * np.pi * freq * t) for freq in freqs))
+    return np.concatenate(notes) * 5000
+
+
+class testSketch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_mp3(self, frames):
+        path = os.path.join(self.tmpdir, 'song.mp3')
+        with open(path, 'wb') as mp3_file:
+            # empty ID3v2 tag
+            mp3_file.write('ID3\x03\x00\x00\x00\x00\x00\x00')
+            for frame in frames:
+                mp3_file.write(frame.ljust(FRAME_LENGTH, '\x00'))
+            mp3_file.write('TAG'.ljust(128, '\x00'))
+        return path
+
+    def test_mp3_duration_cbr(self):
+        """
+        Without a Xing header, the duration follows from the file size
+        """
+        path = self.write_mp3([FRAME_HEADER] * 100)
+        self.assertAlmostEqual(mud_sketch.mp3_duration(path), 100 * FRAME_LENGTH * 8 / 128000.)
+
+    def test_mp3_duration_xing(self):
+        """
+        The number of frames of VBR files is read from the Xing header
+        """
+        xing = FRAME_HEADER + '\x00' * 32 + 'Xing' + struct.pack('>II', 1, 1000)
+        path = self.write_mp3([xing, FRAME_HEADER])
+        self.assertAlmostEqual(mud_sketch.mp3_duration(path), 1000 * 1152 / 44100.)
+
+    def test_mp3_duration_no_frames(self):
+        path = os.path.join(self.tmpdir, 'song.mp3')
+        with open(path, 'wb') as mp3_file:
+            mp3_file.write('\xff\x00 no mp3' * 100)
+        self.assertIsNone(mud_sketch.mp3_duration(path))
+
+    def test_pack(self):
+        words = np.array([0, 1, 2 ** 32 - 1], np.uint32)
+        self.assertListEqual(mud_sketch.unpack(mud_sketch.pack(words)).tolist(), words.tolist())
+        self.assertEqual(len(mud_sketch.unpack('')), 0)
+
+    def test_bit_error_rate(self):
+        """
+        A quieter, noisy copy starting a bit later is near, another song is not
+        """
+        fs = mud_sketch.SKETCH_FS
+        samples = song(1)
+        words = mud_sketch.sketch(samples, fs)
+        self.assertEqual(len(words), 18)
+        noise = np.random.RandomState(2).normal(0, 300, len(samples))
+        copy = mud_sketch.sketch((samples * 0.5 + noise)[int(0.3 * fs):], fs)
+        other = mud_sketch.sketch(song(3), fs)
+        self.assertLess(mud_sketch.bit_error_rate(words, copy), mud_sketch.MAX_BIT_ERROR_RATE)
+        self.assertGreater(mud_sketch.bit_error_rate(words, other), mud_sketch.MAX_BIT_ERROR_RATE)
+
+    def test_too_short(self):
+        self.assertEqual(len(mud_sketch.sketch(np.zeros(1000), mud_sketch.SKETCH_FS)), 0)
+
+    def test_index_neighbourless(self):
+        """
+        Only songs with neither a near duration nor a near sketch are unique,
+        songs without duration never are
+        """
+        fs = mud_sketch.SKETCH_FS
+        words = mud_sketch.sketch(song(1), fs)
+        copy = mud_sketch.sketch(song(1) * 0.7, fs)
+        other = mud_sketch.sketch(song(3), fs)
+        index = mud_sketch.SketchIndex([
+            ('song', 200., words),
+            ('copy', 201., copy),
+            ('other', 200.5, other),
+            ('long copy', 300., words),
+            ('unknown', None, words),
+        ])
+        self.assertEqual(len(index), 5)
+        self.assertListEqual(sorted(index.neighbourless()), ['long copy', 'other'])
+
+    def test_index_neighbourless_items(self):
+        """
+        Only the given items are looked at, their neighbours are searched among all
+        """
+        fs = mud_sketch.SKETCH_FS
+        words = mud_sketch.sketch(song(1), fs)
+        index = mud_sketch.SketchIndex([
+            ('song', 200., words),
+            ('copy', 200., words),
+            ('other', 200., mud_sketch.sketch(song(3), fs)),
+            ('another', 300., mud_sketch.sketch(song(4), fs)),
+        ])
+        self.assertListEqual(list(index.neighbourless(set(['song', 'other']))), ['other'])
+
+    def test_index_candidates_unrelated(self):
+        """
+        Unrelated songs of the same duration are rarely compared bit by bit,
+        noisy copies always are
+        """
+        fs = mud_sketch.SKETCH_FS
+        samples = song(0)
+        noise = np.random.RandomState(2).normal(0, 2000, len(samples))
+        items = [(seed, 200., mud_sketch.sketch(song(seed), fs)) for seed in range(100)]
+        items.append(('copy', 200., mud_sketch.sketch((samples * 0.6 + noise)[int(0.3 * fs):], fs)))
+        index = mud_sketch.SketchIndex(items)
+        num_candidates = sum(len(index._candidates(i)) for i in range(100))
+        self.assertLess(num_candidates, 100)
+        self.assertIn(100, index._candidates(0))
+        self.assertListEqual(sorted(index.neighbourless(set(['copy', 0]))), [])
+
+    def test_durations_near(self):
+        self.assertTrue(mud_sketch.durations_near(180., 181.5))
+        self.assertFalse(mud_sketch.durations_near(180., 184.))
+        self.assertTrue(mud_sketch.durations_near(3600., 3660.))
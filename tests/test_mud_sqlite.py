@@ -0,0 +1,82 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from .. import mud
+
+
+class testMudSQLiteDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = mud.MudSQLiteDatabase(path=os.path.join(self.tmp_dir, 'mud.db'))
+        self.db.setup()
+        self.files = ['/foo/file1.mp3', '/foo/bar/file2.mp3', '/Foo/baz/file3.mp3']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_mud_database(self):
+        """
+        The database class is chosen by database_type
+        """
+        self.assertIs(mud.get_mud_database(None), mud.MudDatabase)
+        self.assertIs(mud.get_mud_database('sqlite'), mud.MudSQLiteDatabase)
+        with self.assertRaises(TypeError):
+            mud.get_mud_database('postgres')
+
+    def test_insert_songfiles(self):
+        """
+        Files are inserted once, paths are case sensitive
+        """
+        rows = [(f, 1, 2.0, 3) for f in self.files]
+        self.assertEqual(self.db.insert_songfiles(rows), 3)
+        self.assertEqual(self.db.insert_songfiles(rows), 0)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.insert_songfile(self.files[0])
+        self.assertListEqual(sorted(self.db.select_new_files()),
+            sorted({'file_path': f} for f in self.files))
+        self.assertListEqual(sorted(row['file_path'] for row in self.db.select_files_below('/foo')),
+            sorted(self.files[:2]))
+
+    def test_fingerprints(self):
+        """
+        Fingerprints are stored and matched, and deleted together with their song
+        """
+        song_id = self.db.insert_fingerprinted_song('song', 'DEADBEEF' * 5,
+            [('abcdef0123456789abcd', 10), ('00ff00ff00ff00ff00ff', 20)])
+        self.assertEqual(self.db.get_num_fingerprints(), 2)
+        self.assertListEqual(list(self.db.return_matches([('abcdef0123456789abcd', 4)])), [(song_id, 6)])
+        self.assertEqual(list(self.db.get_songs())[0]['file_sha1'], 'DEADBEEF' * 5)
+        with self.db.cursor() as cur:
+            cur.execute('DELETE FROM songs')
+        self.assertEqual(self.db.get_num_fingerprints(), 0)
+
+    def test_duplicates(self):
+        """
+        Files sharing a song are found as duplicates
+        """
+        song_id = self.db.insert_fingerprinted_song('song', 'DEADBEEF' * 5, [])
+        self.db.insert_songfiles((f, None, None, None) for f in self.files)
+        self.db.update_songfiles([(song_id, '', '', '', f) for f in self.files[:2]], [])
+        dups = list(self.db.select_duplicate_files())
+        self.assertEqual(len(dups), 1)
+        self.assertListEqual([row['file_path'] for row in dups[0]], self.files[:2])
+        self.assertEqual(self.db.select_num_duplicate_groups(), 1)
+
+    def test_claim_song_files(self):
+        """
+        Claims work as with MariaDB
+        """
+        self.db.insert_songfiles((f, None, None, None) for f in self.files)
+        claimed = self.db.claim_song_files('host:1', 2, max_attempts=2)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(len(self.db.claim_song_files('host:2', 10, max_attempts=2)), 1)
+        self.assertListEqual(self.db.select_claim_workers(), ['host:1', 'host:2'])
+        self.db.expire_claims('host:1')
+        self.assertListEqual(self.db.claim_song_files('host:3', 10, max_attempts=2), claimed)
+        self.db.expire_claims('host:3')
+        self.assertEqual(self.db.park_poison_files(max_attempts=2), 2)
+        self.assertEqual(self.db.select_num_errors('PoisonFile'), 2)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import struct
+import subprocess
+
+from .. import mud_tags
+
+
+def syncsafe(value):
+    """Encode value as 4 syncsafe bytes"""
+    return ''.join(chr((value >> shift) & 0x7f) for shift in (21, 14, 7, 0))
+
+def id3v2_frame(frame_id, text, encoding=3, version=3):
+    data = chr(encoding) + text
+    if version == 3:
+        size = struct.pack('>I', len(data))
+    else:
+        size = syncsafe(len(data))
+    return frame_id + size + '\x00\x00' + data
+
+def id3v2_tag(frames, version=3):
+    body = ''.join(frames) + '\x00' * 32
+    return 'ID3' + chr(version) + '\x00\x00' + syncsafe(len(body)) + body
+
+def id3v1_tag(title, artist, album):
+    return 'TAG' + title.ljust(30, '\x00') + artist.ljust(30, '\x00') + album.ljust(30, '\x00') + '\x00' * 35
+
+
+class testReadTags(unittest.TestCase):
+
+    def setUp(self):
+        self.music_base_dir = '/tmp/mud_tags'
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+        os.makedirs(self.music_base_dir)
+        self.audio = '\xff\xfb\x90\x00' * 256
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+
+    def write(self, name, content):
+        path = os.path.join(self.music_base_dir, name)
+        with open(path, 'wb') as song_file:
+            song_file.write(content)
+        return path
+
+    def test_id3v23(self):
+        """
+        Wanted frames are read in all encodings, others are skipped
+        """
+        tag = id3v2_tag([
+            id3v2_frame('APIC', 'x' * 10000),
+            id3v2_frame('TIT2', u'Tïtle'.encode('utf-8')),
+            id3v2_frame('TPE1', u'Ärtist'.encode('utf-16'), encoding=1),
+            id3v2_frame('TALB', 'Album', encoding=0),
+            ])
+        path = self.write('v23.mp3', tag + self.audio)
+        self.assertDictEqual(mud_tags.read_tags(path),
+            {'artist': u'Ärtist', 'title': u'Tïtle', 'album': u'Album'})
+
+    def test_id3v24(self):
+        """
+        Missing frames are None, only the first of several values is used
+        """
+        tag = id3v2_tag([id3v2_frame('TIT2', 'Title\x00Other', version=4)], version=4)
+        path = self.write('v24.mp3', tag + self.audio)
+        self.assertDictEqual(mud_tags.read_tags(path),
+            {'artist': None, 'title': u'Title', 'album': None})
+
+    def test_id3v1(self):
+        """
+        Files with only an ID3v1 tag are read too
+        """
+        path = self.write('v1.mp3', self.audio + id3v1_tag('Title', 'Artist', 'Album'))
+        self.assertDictEqual(mud_tags.read_tags(path),
+            {'artist': u'Artist', 'title': u'Title', 'album': u'Album'})
+
+    def test_no_tag(self):
+        """
+        None is returned for files without a tag, even short ones
+        """
+        self.assertIsNone(mud_tags.read_tags(self.write('none.mp3', self.audio)))
+        self.assertIsNone(mud_tags.read_tags(self.write('short.mp3', 'ID')))
+
+    def test_broken_tag(self):
+        """
+        Frames larger than the tag raise TagError
+        """
+        tag = id3v2_tag([id3v2_frame('TIT2', 'Title')])
+        tag = tag[:10] + 'TIT2' + struct.pack('>I', 100000) + tag[18:]
+        path = self.write('broken.mp3', tag + self.audio)
+        with self.assertRaises(mud_tags.TagError):
+            mud_tags.read_tags(path)
+
+    def test_missing_file(self):
+        """
+        IOError is raised for files that can't be read
+        """
+        with self.assertRaises(IOError):
+            mud_tags.read_tags(os.path.join(self.music_base_dir, 'missing.mp3'))
@@ -0,0 +1,108 @@
+import unittest
+import os
+import subprocess
+
+from .. import mud_watch
+
+
+class testChangeQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.music_base_dir = '/tmp/mud_watch'
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+        os.makedirs(self.music_base_dir + '/foo')
+        self.queue = mud_watch.ChangeQueue(settle_time=0)
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+
+    def test_created_settled(self):
+        """
+        Created files are handed out once they exist and stopped changing
+        """
+        song_file = self.music_base_dir + '/foo/file1.mp3'
+        open(song_file, 'w').close()
+        self.queue.created(song_file)
+        self.queue.created(self.music_base_dir + '/foo/gone.mp3')
+        self.assertListEqual(self.queue.pop_changes(), [('created', song_file)])
+        self.assertListEqual(self.queue.pop_changes(), [])
+
+    def test_created_then_moved(self):
+        """
+        A file moved before it settled is handed out as created under its new name
+        """
+        tmp_file = self.music_base_dir + '/foo/file1.mp3.part'
+        song_file = self.music_base_dir + '/foo/file1.mp3'
+        open(song_file, 'w').close()
+        self.queue.created(tmp_file)
+        # inotify reports IN_MOVED_FROM before IN_MOVED_TO
+        self.queue.moved_from(tmp_file)
+        self.queue.moved(tmp_file, song_file)
+        self.assertListEqual(self.queue.pop_changes(), [('created', song_file)])
+
+    def test_created_then_dir_moved(self):
+        """
+        Files of a directory moved before they settled are handed out as
+        created below its new name, deleted ones as deleted
+        """
+        song_file = self.music_base_dir + '/foo/file1.mp3'
+        open(song_file, 'w').close()
+        self.queue.created(self.music_base_dir + '/bar/file1.mp3')
+        self.queue.deleted(self.music_base_dir + '/bar/file2.mp3')
+        self.queue.moved_from(self.music_base_dir + '/bar', True)
+        self.queue.moved(self.music_base_dir + '/bar', self.music_base_dir + '/foo', True)
+        changes = self.queue.pop_changes()
+        self.assertTupleEqual(changes[0], ('moved', self.music_base_dir + '/bar', self.music_base_dir + '/foo', True))
+        self.assertListEqual(sorted(changes[1:]), [
+            ('created', song_file),
+            ('deleted', self.music_base_dir + '/foo/file2.mp3', False),
+        ])
+
+    def test_created_then_moved_away(self):
+        """
+        A file moved out of the watched tree before it settled is deleted
+        """
+        tmp_file = self.music_base_dir + '/foo/file1.mp3'
+        self.queue.created(tmp_file)
+        self.queue.moved_from(tmp_file)
+        self.assertListEqual(self.queue.pop_changes(), [('deleted', tmp_file, False)])
+        self.assertDictEqual(self.queue.moved_away, {})
+
+    def test_deleted_then_moved(self):
+        """
+        A delete followed by a move of the same path is a move
+        """
+        self.queue.deleted('/a/b.mp3')
+        self.queue.moved('/a/b.mp3', '/a/c.mp3')
+        self.assertListEqual(self.queue.pop_changes(), [('moved', '/a/b.mp3', '/a/c.mp3', False)])
+
+
+class testPollingWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.music_base_dir = '/tmp/mud_watch'
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+        os.makedirs(self.music_base_dir + '/foo')
+        for f in ['/foo/file1.mp3', '/foo/file2.mp3', '/foo/file3.mp4']:
+            open(self.music_base_dir + f, 'w').close()
+        self.queue = mud_watch.ChangeQueue(settle_time=0)
+        self.watcher = mud_watch.PollingWatcher(self.music_base_dir, poll_interval=0)
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.music_base_dir])
+
+    def test_changes(self):
+        """
+        Created, deleted and moved files are found
+        """
+        base = self.music_base_dir
+        os.rename(base + '/foo/file1.mp3', base + '/moved.mp3')
+        os.remove(base + '/foo/file2.mp3')
+        with open(base + '/new.mp3', 'w') as f:
+            f.write('new')
+        self.watcher.check(self.queue, 0)
+        self.assertListEqual(sorted(self.queue.pop_changes()), [
+            ('created', base + '/new.mp3'),
+            ('deleted', base + '/foo/file2.mp3', False),
+            ('moved', base + '/foo/file1.mp3', base + '/moved.mp3', False),
+        ])